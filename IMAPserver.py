@@ -1,15 +1,30 @@
+import bisect
+import collections
 import email
+import email.parser
+import email.utils
 import os
 import random
-from io import BytesIO
 import sys
 from zope.interface import implementer
-import pickle
 
 from twisted.cred import checkers, portal,credentials
-from twisted.internet import protocol, reactor, defer
+from twisted.internet import protocol, reactor, defer, task
 from twisted.mail import imap4, maildir
 from twisted.cred import error as credError
+from twisted.python import failure, filepath, log
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+from diskio import deferToDisk
+import mailmetadata
+from mailmetadata import MetadataStore
+import mimestructure
+import prefork
+import searchindex
 
 @implementer(imap4.IAccount)
 class IMAPUserAccount(object):
@@ -17,6 +32,8 @@ class IMAPUserAccount(object):
     def __init__(self, userDir):
         self.dir = userDir
         self.mailboxCache = {}
+        self.mailboxNames = []
+        self.mailboxNamesTime = None
 
     def _getMailbox(self, path, create=False):
 
@@ -53,16 +70,25 @@ class IMAPUserAccount(object):
 
     def listMailboxes(self, ref, wildcard):
         """
-        Lista los mail boxes existentes.
+        Lista los mail boxes existentes. El directorio se lee en el pool de disco.
         """
-        for box in os.listdir(self.dir):
-            yield box, self._getMailbox(box)
+        return deferToDisk(self._readMailboxNames, self.mailboxNamesTime).addCallback(self._cbMailboxNames)
 
-    def select(self, path, rw=True):
+    def _readMailboxNames(self, knownTime):
         """
-        Retorna un objeto implementando IMailbox para la direccion otorgada.
+        Lee el directorio del usuario solo si cambio su mtime. Corre en el pool de disco.
         """
-        return self._getMailbox(path)
+        dirTime = os.stat(self.dir).st_mtime_ns
+        if dirTime == knownTime:
+            return dirTime, None
+        return dirTime, sorted(os.listdir(self.dir))
+
+    def _cbMailboxNames(self, result):
+        dirTime, names = result
+        if names is not None:
+            self.mailboxNames = names
+            self.mailboxNamesTime = dirTime
+        return [(box, self._getMailbox(box)) for box in self.mailboxNames]
 
     def create(self, path):
         """
@@ -93,9 +119,7 @@ class IMAPUserAccount(object):
         """
         box = self._getMailbox(path)
 
-        box.metadata['subscribed'] = True
-
-        box.saveMetadata()
+        box.metadataStore.set('subscribed', True)
 
         return True
 
@@ -106,12 +130,25 @@ class IMAPUserAccount(object):
 
         box = self._getMailbox(path)
 
-        box.metadata['subscribed'] = False
-
-        box.saveMetadata()
+        box.metadataStore.set('subscribed', False)
 
         return True
 
+    def flush(self):
+        """
+        Escribe los cambios de metadata pendientes de los buzones abiertos de la cuenta. Retorna un Deferred que
+        se dispara cuando llegaron al log.
+        """
+        return defer.DeferredList([box.metadataStore.flush() for box in self.mailboxCache.values()])
+
+    def close(self):
+        """
+        Libera los buzones abiertos de la cuenta.
+        """
+        for box in self.mailboxCache.values():
+            box.close()
+        self.mailboxCache = {}
+
     def isSubscribed(self, path):
         """
         Retorna un booleano con la informacion de si se encuentra suscrito a un mailbox.
@@ -120,11 +157,170 @@ class IMAPUserAccount(object):
 
     def select(self, path, rw=False):
         """
-        Retorna el mailbox seleccionado con la direccion otorgada.
+        Retorna una MailboxView de la sesion sobre el mailbox de la cuenta con la direccion otorgada. SELECT (rw)
+        reclama los mensajes recientes; EXAMINE y STATUS no los cambian.
         """
-        return self._getMailbox(path)
+        box = self._getMailbox(path)
+
+        def synced(ignored):
+            if rw:
+                box.claimRecent()
+            return MailboxView(box)
+
+        return box.sync().addCallback(synced)
+
+_notifier = None
+
+def getNotifier():
+    """
+    Retorna el INotify compartido por todos los buzones, o None si inotify no esta disponible.
+    """
+    global _notifier
+    if _notifier is None and inotify is not None:
+        try:
+            _notifier = inotify.INotify()
+            _notifier.startReading()
+        except Exception:
+            _notifier = False
+    return _notifier or None
 
 class ExtendedMaildir(maildir.MaildirMailbox):
+
+    """
+    Maildir que lleva la cuenta de los archivos de cur/ y new/ sin volver a leer el directorio completo.
+    Con inotify los cambios llegan como eventos; sin inotify solo se vuelve a leer un subdirectorio
+    cuando cambia su mtime.
+    """
+
+    watchMask = 0
+
+    if inotify is not None:
+        watchMask = inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_DELETE | inotify.IN_MOVED_FROM
+
+    def __init__(self, path):
+        maildir.MaildirMailbox.__init__(self, path)
+        self.known = {}
+        for name in ('cur', 'new'):
+            self.known[name] = set()
+        for messagePath in self.list:
+            self.known[os.path.basename(os.path.dirname(messagePath))].add(messagePath)
+        self.added = {}
+        self.removed = set()
+        # Archivos que el servidor esta moviendo a .Trash en el pool; un listado hecho antes no los agrega.
+        self.moving = set()
+        self.mtimes = self._directoryTimes()
+        self.watched = False
+        self.changed = None
+        notifier = getNotifier()
+        if notifier is not None:
+            try:
+                for name in ('cur', 'new'):
+                    notifier.watch(filepath.FilePath(os.path.join(path, name)), self.watchMask,
+                                   callbacks=[self._notified])
+                self.watched = True
+            except Exception:
+                self.watched = False
+
+    def _directoryTimes(self):
+        return dict((name, os.stat(os.path.join(self.path, name)).st_mtime_ns) for name in ('cur', 'new'))
+
+    def scan(self):
+        """
+        Retorna un Deferred con el listado de los subdirectorios cuyo mtime cambio, leido en el pool de disco.
+        Con inotify los cambios ya llegaron como eventos y no hace falta leer nada.
+        """
+        if self.watched:
+            return defer.succeed({})
+        return deferToDisk(scanDirectories, self.path, dict(self.mtimes))
+
+    def _notified(self, ignored, path, mask):
+        """
+        Recibe un evento de inotify para un archivo de cur/ o new/.
+        """
+        path = os.fsdecode(path.path)
+        if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+            self._fileAdded(path)
+        else:
+            self._fileRemoved(path)
+        if self.changed is not None:
+            self.changed()
+
+    def delivered(self, path):
+        """
+        Registra un mensaje entregado por el servidor SMTP del mismo proceso, sin esperar a inotify.
+        """
+        self._fileAdded(path)
+        if self.changed is not None:
+            self.changed()
+
+    def _fileAdded(self, path):
+        known = self.known[os.path.basename(os.path.dirname(path))]
+        if path not in known:
+            known.add(path)
+            self.removed.discard(path)
+            self.added[path] = None
+
+    def _fileRemoved(self, path):
+        known = self.known[os.path.basename(os.path.dirname(path))]
+        if path in known:
+            known.discard(path)
+            if path in self.added:
+                del self.added[path]
+            else:
+                self.removed.add(path)
+
+    def _rescan(self, name, current):
+        """
+        Compara el contenido actual de un subdirectorio con los archivos conocidos.
+        """
+        for path in sorted(current - self.known[name] - self.moving):
+            self._fileAdded(path)
+        for path in self.known[name] - current:
+            self._fileRemoved(path)
+
+    def refresh(self, scanned):
+        """
+        Aplica el listado que retorno scan y retorna los archivos agregados y eliminados desde la ultima llamada.
+        """
+        for name, (mtime, current) in scanned.items():
+            self.mtimes[name] = mtime
+            self._rescan(name, current)
+        added, removed = list(self.added), self.removed
+        self.added, self.removed = {}, set()
+        return added, removed
+
+    def forget(self, path):
+        """
+        Olvida un archivo que el propio servidor movio fuera del buzon.
+        """
+        self.known[os.path.basename(os.path.dirname(path))].discard(path)
+
+    def moveToTrash(self, paths):
+        """
+        Mueve los mensajes a .Trash/cur en una sola operacion del pool de disco, como deleteMessage.
+        Retorna un Deferred que se dispara cuando terminaron de moverse.
+        """
+        moves = [(path, os.path.join(self.path, '.Trash', 'cur', os.path.basename(path))) for path in paths]
+        for path, trashFile in moves:
+            self.forget(path)
+            self.moving.add(path)
+            self.deleted[path] = trashFile
+
+        def moved(result):
+            self.moving.difference_update(paths)
+            return result
+
+        return deferToDisk(moveFiles, moves).addBoth(moved)
+
+    def stopWatching(self):
+        """
+        Deja de recibir eventos de inotify para este buzon.
+        """
+        if self.watched:
+            for name in ('cur', 'new'):
+                getNotifier().ignore(filepath.FilePath(os.path.join(self.path, name)))
+            self.watched = False
+
     def __iter__(self):
         return iter(self.list)
 
@@ -135,53 +331,97 @@ class ExtendedMaildir(maildir.MaildirMailbox):
         return self.list[i]
 
 
-@implementer(imap4.IMailbox)
+def scanDirectories(path, mtimes):
+    """
+    Corre en el pool de disco: lista cur/ y new/ si su mtime es distinto del de mtimes y retorna
+    {subdirectorio: (mtime, archivos)} solo con los que cambiaron.
+    """
+    scanned = {}
+    for name in ('cur', 'new'):
+        directory = os.path.join(path, name)
+        mtime = os.stat(directory).st_mtime_ns
+        if mtime != mtimes[name]:
+            scanned[name] = (mtime, set(os.path.join(directory, f) for f in os.listdir(directory)))
+    return scanned
+
+def moveFiles(moves):
+    """
+    Corre en el pool de disco: renombra cada (origen, destino). Un origen que ya no existe lo borro otro
+    cliente y se saltea.
+    """
+    for source, target in moves:
+        try:
+            os.rename(source, target)
+        except FileNotFoundError:
+            pass
+
+openMailboxes = {}
+
+def deliveryReceived(inboxDir, messagePath):
+    """
+    Avisa a un buzon abierto que el servidor SMTP del mismo proceso le entrego un mensaje.
+    Se registra con smtpserver.deliveryObservers.append(IMAPserver.deliveryReceived).
+    """
+    box = openMailboxes.get(os.path.abspath(inboxDir))
+    if box is not None:
+        box.maildir.delivered(messagePath)
+
+@implementer(imap4.IMailbox, imap4.ISearchableMailbox)
 class IMAPMailbox(object):
 
+    pollInterval = 5
+
+    # El protocolo lo apaga antes de un FETCH que no necesita los encabezados (FLAGS, UID, INTERNALDATE, RFC822.SIZE).
+    fetchHeaders = True
+
+    # El protocolo lo prende antes de un FETCH de ENVELOPE, BODY, BODYSTRUCTURE o de una parte (BODY[2.1]).
+    fetchStructure = False
+
     def __init__(self, path):
         self.maildir = ExtendedMaildir(path)
+        self.maildir.changed = self._maildirChanged
         self.listeners = []
+        # Vistas de las sesiones que tienen el buzon seleccionado; reciben los mensajes agregados y eliminados.
+        self.views = []
+        self.pendingSync = None
+        self.poller = None
+        # Sincronizacion que corre en el pool y Deferreds de las pedidas mientras tanto, que esperan la siguiente.
+        self.syncing = None
+        self.syncWaiters = []
+        openMailboxes[os.path.abspath(path)] = self
         self.uniqueValidityIdentifier = random.randint(1000000, 9999999)
-        self.metadataFile = os.path.join(path, '.imap-metadata.pickle')
+        self.claimedRecentUID = None
+        self.metadataStore = MetadataStore(path)
+        self.metadata = self.metadataStore.data
+        self.searchIndex = searchindex.getIndex(path)
 
-        if os.path.exists(self.metadataFile):
-            self.metadata = pickle.load(open(self.metadataFile, 'r+b'))
-        else:
-            self.metadata = {}
+        self.initMetadata()
 
-            self.initMetadata()
+        self._assignUIDs()
 
-            self.listeners = []
+        self._forgetMissing()
 
-            self._assignUIDs()
+        self._sortByUID()
+
+        # Agregados al indice de busqueda que todavia corren en el pool; SEARCH los espera.
+        self.indexing = set()
+
+        self._index(self.maildir.list)
 
     def initMetadata(self):
         """
         Inicia el metadata utilizado para realizar el fetch con la secuencia de user ids de los mensajes.
         """
 
-        if not 'flags' in self.metadata:
-
-            self.metadata['flags'] = {}
-
         if not 'uidvalidity' in self.metadata:
 
-
-            self.metadata['uidvalidity'] = random.randint(1000000, 9999999)
-
-        if not 'uids' in self.metadata:
-
-            self.metadata['uids'] = {}
-
-        if not 'uidnext' in self.metadata:
-
-            self.metadata['uidnext'] = 1
+            self.metadataStore.setDefault('uidvalidity', random.randint(1000000, 9999999))
 
     def saveMetadata(self):
         """
-        Guarda la informacion del metadata en un archivo utilizando pickle.
+        Compacta el log del metadata en una nueva foto del archivo pickle.
         """
-        pickle.dump(self.metadata, open(self.metadataFile, 'w+b'))
+        return self.metadataStore.compact()
 
     def _assignUIDs(self):
 
@@ -194,37 +434,234 @@ class IMAPMailbox(object):
 
             if not messageFile in self.metadata['uids']:
 
-                self.metadata['uids'][messageFile] = self.metadata['uidnext']
+                self.metadataStore.assignUID(messageFile)
+
+    def _forgetMissing(self):
+
+        """
+        Borra del metadata los mensajes que se eliminaron mientras el buzon estaba cerrado (otro cliente de correo
+        o rm); si no, sus uids y flags siguen contando en STATUS. Antes de borrar uno se confirma que el archivo
+        no exista, porque otro proceso puede haberle asignado uid a un mensaje nuevo despues del listado.
+        """
+        listed = set(os.path.basename(messagePath) for messagePath in self.maildir)
 
-                self.metadata['uidnext'] += 1
+        for messageFile in [name for name in self.metadata['uids'] if name not in listed]:
 
-                self.saveMetadata()
+            if not any(os.path.exists(os.path.join(self.maildir.path, name, messageFile)) for name in ('cur', 'new')):
 
-    def getHierarchicalDelimiter(self):
-        return "."
+                self.metadataStore.expunge(messageFile)
 
-    def getFlags(self):
-        return [r'Seen', r'Unseen', r'Deleted', r'Flagged', r'Answered', r'Recent']
+    def _sortByUID(self):
 
-    def getUnseenCount(self):
-        def messageIsUnseen(filename):
+        """
+        Ordena los mensajes por uid y construye la lista ordenada de uids, paralela a los numeros de secuencia.
+        """
+        uids = self.metadata['uids']
 
-            filename = os.path.basename(filename)
+        messages = sorted((uids[os.path.basename(messagePath)], messagePath) for messagePath in self.maildir
+                          if os.path.basename(messagePath) in uids)
 
-            uid = self.metadata['uids'].get(filename)
+        self.maildir.list = [messagePath for uid, messagePath in messages]
 
-            flags = self.metadata['flags'].get(uid, [])
+        self.uidList = [uid for uid, messagePath in messages]
+
+    def sync(self):
+
+        """
+        Incorpora los mensajes entregados o eliminados desde el ultimo comando sin releer el buzon completo.
+        El listado de cur/ y new/ se lee en el pool de disco. Las sincronizaciones pedidas mientras una corre
+        comparten la siguiente, asi un listado viejo nunca se aplica despues de uno nuevo.
+        Retorna un Deferred que se dispara con (agregados, eliminados).
+        """
+        d = defer.Deferred()
+
+        self.syncWaiters.append(d)
+
+        if self.syncing is None:
+
+            self._startSync()
+
+        return d
+
+    def _startSync(self):
+
+        waiters, self.syncWaiters = self.syncWaiters, []
+
+        def done(result):
+
+            self.syncing = None
+
+            for waiter in waiters:
+
+                if isinstance(result, failure.Failure):
+
+                    waiter.errback(result)
+
+                else:
+
+                    waiter.callback(result)
+
+            if self.syncWaiters and self.syncing is None:
+
+                self._startSync()
+
+        self.syncing = self.maildir.scan()
+
+        self.syncing.addCallback(self._applySync)
+
+        self.syncing.addBoth(done)
+
+    def _applySync(self, scanned):
+
+        """
+        Aplica en el reactor el listado leido en el pool. El log del metadata se lee aca: sin cambios de otros
+        procesos cuesta dos stat, y con cambios se lee bajo el mismo flock que usa assignUID.
+        """
+        self.metadataStore.refresh()
+
+        added, removed = self.maildir.refresh(scanned)
+
+        if removed:
+
+            uids = [self.metadata['uids'].get(os.path.basename(messagePath)) for messagePath in removed]
+
+            for messagePath in removed:
+
+                self.metadataStore.expunge(os.path.basename(messagePath))
+
+                messageCache.invalidate(messagePath)
+
+            self.maildir.list = [messagePath for messagePath in self.maildir.list if messagePath not in removed]
+
+            self._sortByUID()
 
-            if not r'Seen' in flags:
-                return True
+            self._unindex(removed)
 
-        return len(filter(messageIsUnseen, self.maildir))
+            for view in list(self.views):
+
+                view.messagesRemoved([uid for uid in uids if uid is not None])
+
+        appended = [(self._appendMessage(messagePath), messagePath) for messagePath in added]
+
+        if added:
+
+            self._index(added)
+
+            if self.claimedRecentUID is not None:
+
+                self.claimRecent()
+
+            for view in list(self.views):
+
+                view.messagesAdded(appended)
+
+            for listener in self.listeners:
+
+                listener.newMessages(self.getMessageCount(), self.getRecentCount())
+
+        return added, removed
+
+    def _maildirChanged(self):
+
+        """
+        Programa una sincronizacion cuando cambia el maildir y hay clientes esperando en IDLE.
+        Varios eventos seguidos se agrupan en una sola sincronizacion.
+        """
+        if (self.listeners or self.views) and self.pendingSync is None:
+
+            self.pendingSync = reactor.callLater(0, self._syncForListeners)
+
+    def _syncForListeners(self):
+
+        self.pendingSync = None
+
+        self.sync().addErrback(log.err)
+
+    def _appendMessage(self, messagePath):
+
+        """
+        Agrega un mensaje nuevo a la secuencia. Normalmente su uid es el mayor asignado y va al final.
+        """
+        messageFile = os.path.basename(messagePath)
+
+        uid = self.metadata['uids'].get(messageFile)
+
+        if uid is None:
+
+            uid = self.metadataStore.assignUID(messageFile)
+
+        if self.uidList and uid < self.uidList[-1]:
+
+            # Otro proceso le asigno el uid antes de que este proceso viera el archivo.
+            index = bisect.bisect_left(self.uidList, uid)
+
+            self.maildir.list.insert(index, messagePath)
+
+            self.uidList.insert(index, uid)
+
+        else:
+
+            self.maildir.list.append(messagePath)
+
+            self.uidList.append(uid)
+
+        return uid
+
+    def close(self):
+        """
+        Cierra el log del metadata y deja de vigilar el maildir.
+        """
+        self.maildir.stopWatching()
+        self.metadataStore.close()
+        if self.poller is not None:
+            self.poller.stop()
+            self.poller = None
+        if openMailboxes.get(os.path.abspath(self.maildir.path)) is self:
+            del openMailboxes[os.path.abspath(self.maildir.path)]
+
+    def getHierarchicalDelimiter(self):
+        return "."
+
+    def getFlags(self):
+        return [r'Seen', r'Unseen', r'Deleted', r'Flagged', r'Answered', r'Recent']
+
+    def getUnseenCount(self):
+        seen = self.metadataStore.seenCount
+        if seen > self.getMessageCount():
+            # El contador incluye flags de uids sin mensaje: se borran de la FlagTable y se vuelve a contar.
+            self.metadataStore.forgetOrphanFlags()
+            seen = self.metadataStore.seenCount
+        if seen > self.getMessageCount():
+            # Otro proceso asigno uids a mensajes que este todavia no listo; solo cuentan los de la secuencia.
+            seen = self.metadata['flags'].count('\\Seen', self.uidList)
+        return self.getMessageCount() - seen
 
     def getMessageCount(self):
         return len(self.maildir)
 
     def getRecentCount(self):
-        return 0
+        """
+        Los mensajes recientes son los de uid mayor o igual a recentUID, un sufijo de la lista ordenada de uids.
+        """
+        return len(self.uidList) - bisect.bisect_left(self.uidList, self.recentUID())
+
+    def recentUID(self):
+        """
+        Primer uid reciente para este proceso: el que tenia el buzon cuando se selecciono o, si nadie lo
+        selecciono todavia, el primero que ninguna sesion reclamo.
+        """
+        if self.claimedRecentUID is not None:
+            return self.claimedRecentUID
+        return self.metadata.get('recentuid', 1)
+
+    def claimRecent(self):
+        """
+        Al seleccionar el buzon sus mensajes recientes quedan para este proceso y dejan de serlo para los demas.
+        """
+        if self.claimedRecentUID is None:
+            self.claimedRecentUID = self.metadata.get('recentuid', 1)
+        if self.metadata.get('recentuid', 1) < self.metadata['uidnext']:
+            self.metadataStore.set('recentuid', self.metadata['uidnext'])
 
     def isWriteable(self):
         return False
@@ -233,141 +670,308 @@ class IMAPMailbox(object):
         return self.metadata['uidvalidity']
 
     def getUID(self, messageNum):
-        filename = os.path.basename(self.maildir[messageNum - 1])
-        if not filename in self.metadata['uids']:
-            self._assignUIDs()
-        return self.metadata['uids'][filename]
+        return self.uidList[messageNum - 1]
 
     def getUIDNext(self):
-        return self.folder.metadata['uidnext']
+        return self.metadata['uidnext']
 
-    def _seqMessageSetToSeqDict(self, messageSet):
+    def _seqMessageSetToSeqDict(self, messageSet, paths):
         if not messageSet.last:
-            messageSet.last = self.getMessageCount()
+            messageSet.last = len(paths)
 
         seqMap = {}
-        for messageNum in messageSet:
-            if messageNum >= 0 and messageNum <= self.getMessageCount():
-                seqMap[messageNum] = self.maildir[messageNum - 1]
+        for low, high in messageSet.ranges:
+            for messageNum in range(max(low, 1), min(high, len(paths)) + 1):
+                seqMap[messageNum] = paths[messageNum - 1]
         return seqMap
 
 
-    def _uidMessageSetToSeqDict(self, messageSet):
+    def _uidMessageSetToSeqDict(self, messageSet, uidList, paths):
 
         """
         Obtiene un set de mensajes que contienen user ids y retorna un diccionario en secuencia de numeros para el
-        nombre de los archivos.
+        nombre de los archivos. Cada rango se ubica con busqueda binaria sobre la lista ordenada de uids.
         """
 
         if not messageSet.last:
 
-            messageSet.last = self.metadata['uidnext']
+            messageSet.last = uidList[-1] if uidList else self.metadata['uidnext']
 
-            self._assignUIDs()
+        seqMap = {}
 
-            allUIDs = []
+        for low, high in messageSet.ranges:
 
-            for filename in self.maildir:
-                shortFilename = os.path.basename(filename)
-                allUIDs.append(self.metadata['uids'][shortFilename])
+            start = bisect.bisect_left(uidList, low)
 
+            end = bisect.bisect_right(uidList, high)
 
-            allUIDs.sort()
+            for index in range(start, end):
 
-            seqMap = {}
+                seqMap[index + 1] = paths[index]
 
-            for uid in messageSet:
+        return seqMap
 
-                if uid in allUIDs:
+    def _messageSetToSeqDict(self, messageSet, uid, uidList, paths):
 
-                    sequence = allUIDs.index(uid) + 1
+        """
+        Numeros de secuencia y archivos del set de mensajes sobre la secuencia dada: la del buzon o la de una vista.
+        """
+
+        if uid:
 
-                    seqMap[sequence] = self.maildir[sequence - 1]
-            return seqMap
+            return self._uidMessageSetToSeqDict(messageSet, uidList, paths)
+
+        return self._seqMessageSetToSeqDict(messageSet, paths)
 
 
     def fetch(self, messages, uid):
         """
         Realiza el fetch de la carpeta de mensajes del smpt al cliente del imap utilizado.
+        Los encabezados que no estan en el cache se leen en el pool de disco antes de responder.
         """
-        if uid:
-            messagesToFetch = self._uidMessageSetToSeqDict(messages)
-        else:
-            messagesToFetch = self._seqMessageSetToSeqDict(messages)
+        fetchHeaders, self.fetchHeaders = self.fetchHeaders, True
+        fetchStructure, self.fetchStructure = self.fetchStructure, False
+
+        def synced(ignored):
+            messagesToFetch = self._messageSetToSeqDict(messages, uid, self.uidList, self.maildir.list)
+            return self._fetchMessages(messagesToFetch, self.uidList, fetchHeaders, fetchStructure)
+
+        return self.sync().addCallback(synced)
+
+    def _fetchMessages(self, messagesToFetch, uidList, fetchHeaders, fetchStructure):
+        """
+        Arma los mensajes de {secuencia: archivo}, donde uidList da el uid de cada numero de secuencia.
+        """
+        fetched = []
         for seq, filename in messagesToFetch.items():
-            uid = self.getUID(seq)
+            uid = uidList[seq - 1]
             flags = self.metadata['flags'].get(uid, [])
-            yield seq, MaildirMessage(filename,flags,uid)
+            fetched.append((seq, MaildirMessage(filename,flags,uid)))
+
+        missing = [message for seq, message in fetched if message.path not in messageCache]
+
+        if not fetched or (not fetchStructure and (not fetchHeaders or not missing)):
+
+            return fetched
+
+        def loaded(results):
+
+            for message, result in zip(missing, results):
+
+                if result is not None:
+
+                    message.loadHeaders(*result)
+
+            return fetched
+
+        def structuresLoaded(records):
+
+            for (seq, message), record in zip(fetched, records):
+
+                message.structure = record
+
+            return fetched
+
+        d = defer.succeed(fetched)
+
+        if fetchHeaders and missing:
+
+            d = deferToDisk(readHeaderFiles, [message.path for message in missing]).addCallback(loaded)
+
+        if fetchStructure:
+
+            d.addCallback(lambda ignored: deferToDisk(self.searchIndex.structures,
+                                                      [message.path for seq, message in fetched]))
+
+            d.addCallback(structuresLoaded)
+
+        return d
 
     def addListener(self, listener):
+        """
+        Registra un cliente para recibir avisos de mensajes nuevos. Sin inotify el buzon revisa el mtime
+        de sus directorios cada pollInterval segundos mientras tenga clientes o vistas registrados.
+        """
         self.listeners.append(listener)
+        self._watch()
 
     def removeListener(self, listener):
         self.listeners.remove(listener)
+        self._watch()
+
+    def addView(self, view):
+        self.views.append(view)
+        self._watch()
+
+    def removeView(self, view):
+        self.views.remove(view)
+        self._watch()
+
+    def _watch(self):
+        if (self.listeners or self.views) and not self.maildir.watched and self.poller is None:
+            self.poller = task.LoopingCall(self.sync)
+            self.poller.start(self.pollInterval, now=False)
+        elif not (self.listeners or self.views) and self.poller is not None:
+            self.poller.stop()
+            self.poller = None
 
     def requestStatus(self, path):
-        return imap4.statusRequestHelper(self, path)
+        return self.sync().addCallback(lambda ignored: imap4.statusRequestHelper(self, path))
 
     def store(self, messageSet, flags, mode, uid):
         """
         Guarda los mensajes de la carpeta de mensajes del smpt al cliente del imap utilizado.
         """
-        if uid:
+        def synced(ignored):
 
-            messages = self._uidMessageSetToSeqDict(messageSet)
+            messages = self._messageSetToSeqDict(messageSet, uid, self.uidList, self.maildir.list)
 
-        else:
+            return self._storeFlags(dict((seq, self.getUID(seq)) for seq in messages), flags, mode)
 
-            messages = self._seqMessageSetToSeqDict(messageSet)
+        return self.sync().addCallback(synced)
 
-            setFlags = {}
+    def _storeFlags(self, uids, flags, mode):
 
-            for seq, filename in messages.items():
+        """
+        Cambia los flags de {secuencia: uid} y retorna los flags resultantes por numero de secuencia.
+        """
 
-                uid = self.getUID(seq)
+        # Un solo registro y una operacion por flag sobre los mapas de bits, sin importar cuantos mensajes toque.
+        if uids:
 
-                if mode == 0:
+            self.metadataStore.storeFlags(list(uids.values()), flags, mode)
 
-                    messageFlags = self.metadata['flags'][uid] = flags
+        return dict((seq, self.metadata['flags'].get(uid, [])) for seq, uid in uids.items())
 
-                else:
+    def expunge(self):
 
-                    messageFlags = self.metadata['flags'].setdefault(uid, [])
+        """
+        Elimina todos los mensajes marcados para eliminar y retorna un Deferred con sus numeros de secuencia en
+        orden descendente, que se dispara cuando los archivos terminaron de moverse a .Trash en el pool.
+        """
 
-            for flag in flags:
+        return self.sync().addCallback(lambda ignored: self._expungeDeleted())
 
-                if mode == 1 and not messageFlags.count(flag):
+    def _expungeDeleted(self):
 
-                    messageFlags.append(flag)
+        removed = []
 
-                elif mode == -1 and messageFlags.count(flag):
+        expunged = []
 
-                    messageFlags.remove(flag)
+        for uid in self.metadata['flags'].withFlag('\\Deleted'):
 
-                    setFlags[seq] = messageFlags
+            index = bisect.bisect_left(self.uidList, uid)
 
-                    self.saveMetadata()
-            return setFlags
+            if index == len(self.uidList) or self.uidList[index] != uid:
 
-    def expunge(self):
+                continue
+
+            filename = self.maildir.list[index]
+
+            self.maildir.list[index] = 0
+
+            messageCache.invalidate(filename)
+
+            removed.append(index + 1)
+
+            expunged.append(filename)
+
+        if removed:
+
+            uids = [self.uidList[index - 1] for index in removed]
+
+            self.maildir.list = [messagePath for messagePath in self.maildir.list if messagePath]
+
+            self._sortByUID()
+
+            self._unindex(expunged)
+
+            for view in list(self.views):
+
+                view.messagesRemoved(uids)
+
+        removed.reverse()
+
+        if not expunged:
+
+            return removed
+
+        def moved(ignored):
+
+            # El uid se borra del log despues de mover el archivo; si no, otro proceso que lista cur/ en el medio
+            # le asignaria uno nuevo.
+            for filename in expunged:
+
+                self.metadataStore.expunge(os.path.basename(filename))
+
+            return removed
+
+        return self.maildir.moveToTrash(expunged).addCallback(moved)
+
+    def _index(self, messagePaths):
 
         """
-        Elimina todos los mensajes marcados para eliminar.
+        Agrega al indice de busqueda, en el pool de disco, los mensajes que le falten.
         """
+        d = deferToDisk(self.searchIndex.add, list(messagePaths))
 
-        removed = []
+        d.addErrback(log.err)
+
+        self.indexing.add(d)
+
+        d.addBoth(lambda ignored: self.indexing.discard(d))
+
+    def _unindex(self, messagePaths):
+
+        """
+        Borra del indice de busqueda los mensajes eliminados, en el pool de disco.
+        """
+        names = [os.path.basename(messagePath) for messagePath in messagePaths]
+
+        deferToDisk(self.searchIndex.remove, names).addErrback(log.err)
+
+    def search(self, query, uid):
+
+        """
+        Resuelve SEARCH con el indice del buzon sin abrir los mensajes, salvo los terminos que el indice no
+        cubre. Con UID SEARCH retorna los uids de la foto que se evaluo; con SEARCH los traduce a los numeros de
+        secuencia actuales al volver al reactor, sin los mensajes que se eliminaron mientras tanto.
+        """
+
+        return self.sync().addCallback(
+            lambda ignored: self._search(query, uid, lambda: self.uidList, lambda: self.maildir.list))
+
+    def _search(self, query, uid, uidList, paths):
+
+        """
+        Busca sobre la secuencia que retornan uidList() y paths(): la del buzon o la de una vista. Se piden con
+        funciones porque la secuencia puede cambiar mientras el indice trabaja en el pool.
+        """
+
+        lastUID = uidList()[-1] if uidList() else 0
+
+        try:
 
-        for filename in self.maildir:
+            node = searchindex.compileQuery(query, len(uidList()), lastUID)
 
-            uid = self.metadata['uids'].get(os.path.basename(filename))
+        except searchindex.UnindexedQuery as e:
 
-            if r"Deleted" in self.metadata['flags'].get(uid, []):
+            raise imap4.IllegalQueryError('Unsupported search key: %s' % (e,))
 
-                self.maildir.deleteMessage(filename)
+        snapshotPaths = paths() if searchindex.usesKind(node, ('header', 'text')) else ()
 
-                removed.append(uid)
+        snapshot = searchindex.MailboxSnapshot(uidList(), snapshotPaths, self.metadata['uids'],
+                                               self.metadata['flags'], self.recentUID())
 
-        return removed
+        d = defer.DeferredList(list(self.indexing))
+
+        d.addCallback(lambda ignored: deferToDisk(self.searchIndex.search, node, snapshot))
+
+        if not uid:
+
+            d.addCallback(lambda uids: sequenceNumbers(uids, uidList()))
+
+        return d
 
     def destroy(self):
 
@@ -378,16 +982,467 @@ class IMAPMailbox(object):
         raise imap4.MailboxException("Permission denied.")
 
 
-@implementer(imap4.IMessage)
+def sequenceNumbers(uids, uidList):
+
+    """
+    Numeros de secuencia actuales de los uids que siguen en la lista ordenada uidList.
+    """
+    numbers = []
+
+    for uid in uids:
+
+        index = bisect.bisect_left(uidList, uid)
+
+        if index < len(uidList) and uidList[index] == uid:
+
+            numbers.append(index + 1)
+
+    return numbers
+
+
+@implementer(imap4.IMailbox, imap4.ISearchableMailbox, imap4.ICloseableMailbox)
+class MailboxView(object):
+
+    """
+    Secuencia de mensajes de una sesion sobre el IMAPMailbox que comparten todas las sesiones de la cuenta.
+    Los mensajes que otra sesion o proceso elimino quedan en la secuencia, marcados como pendientes, hasta que
+    el protocolo envia sus EXPUNGE (RFC 3501 7.4.1); recien ahi se renumera. Los mensajes nuevos se agregan al
+    momento, porque EXISTS se puede enviar en cualquier respuesta.
+    """
+
+    fetchHeaders = True
+
+    fetchStructure = False
+
+    def __init__(self, box):
+
+        self.box = box
+
+        self.uidList = list(box.uidList)
+
+        self.paths = list(box.maildir.list)
+
+        self.pending = set()
+
+        self.listeners = []
+
+    def messagesAdded(self, messages):
+
+        """
+        Agrega a la secuencia los (uid, archivo) que el buzon incorporo y avisa EXISTS a los clientes.
+        """
+
+        for uid, messagePath in messages:
+
+            index = bisect.bisect_left(self.uidList, uid)
+
+            if index < len(self.uidList) and self.uidList[index] == uid:
+
+                continue
+
+            self.uidList.insert(index, uid)
+
+            self.paths.insert(index, messagePath)
+
+        for listener in self.listeners:
+
+            listener.newMessages(self.getMessageCount(), self.getRecentCount())
+
+    def messagesRemoved(self, uids):
+
+        """
+        Marca como pendientes los uids eliminados del buzon; siguen en la secuencia hasta takeExpunges.
+        """
+
+        removed = set(sequenceNumbers(uids, self.uidList))
+
+        if not removed:
+
+            return
+
+        self.pending.update(self.uidList[index - 1] for index in removed)
+
+        for listener in self.listeners:
+
+            if hasattr(listener, 'expungesPending'):
+
+                listener.expungesPending()
+
+    def takeExpunges(self):
+
+        """
+        Saca de la secuencia los mensajes pendientes y retorna sus numeros de secuencia en orden descendente,
+        el orden en que se envian los EXPUNGE para que cada numero siga valiendo al aplicar el anterior.
+        """
+
+        if not self.pending:
+
+            return []
+
+        numbers = sorted(sequenceNumbers(sorted(self.pending), self.uidList), reverse=True)
+
+        for index in numbers:
+
+            del self.uidList[index - 1]
+
+            del self.paths[index - 1]
+
+        self.pending = set()
+
+        return numbers
+
+    def sync(self):
+
+        return self.box.sync()
+
+    def addListener(self, listener):
+
+        if not self.listeners:
+
+            self.box.addView(self)
+
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+
+        self.listeners.remove(listener)
+
+        if not self.listeners:
+
+            self.box.removeView(self)
+
+    def close(self):
+
+        """
+        Deja de recibir cambios del buzon al cerrar o cambiar de buzon. El buzon sigue abierto en la cuenta.
+        """
+
+        if self.listeners:
+
+            self.listeners = []
+
+            self.box.removeView(self)
+
+    def getHierarchicalDelimiter(self):
+        return self.box.getHierarchicalDelimiter()
+
+    def getFlags(self):
+        return self.box.getFlags()
+
+    def getUnseenCount(self):
+        return self.box.getUnseenCount()
+
+    def getMessageCount(self):
+        return len(self.uidList)
+
+    def getRecentCount(self):
+        return len(self.uidList) - bisect.bisect_left(self.uidList, self.box.recentUID())
+
+    def isWriteable(self):
+        return self.box.isWriteable()
+
+    def getUIDValidity(self):
+        return self.box.getUIDValidity()
+
+    def getUID(self, messageNum):
+        return self.uidList[messageNum - 1]
+
+    def getUIDNext(self):
+        return self.box.getUIDNext()
+
+    def requestStatus(self, names):
+        return self.box.requestStatus(names)
+
+    def _messageSetToSeqDict(self, messageSet, uid):
+
+        """
+        Como IMAPMailbox, sobre la secuencia de la sesion y sin los mensajes pendientes de EXPUNGE, cuyos
+        archivos ya no existen.
+        """
+
+        messages = self.box._messageSetToSeqDict(messageSet, uid, self.uidList, self.paths)
+
+        return dict((seq, path) for seq, path in messages.items() if self.uidList[seq - 1] not in self.pending)
+
+    def fetch(self, messages, uid):
+
+        fetchHeaders, self.fetchHeaders = self.fetchHeaders, True
+
+        fetchStructure, self.fetchStructure = self.fetchStructure, False
+
+        def synced(ignored):
+
+            messagesToFetch = self._messageSetToSeqDict(messages, uid)
+
+            return self.box._fetchMessages(messagesToFetch, self.uidList, fetchHeaders, fetchStructure)
+
+        return self.box.sync().addCallback(synced)
+
+    def store(self, messageSet, flags, mode, uid):
+
+        def synced(ignored):
+
+            messages = self._messageSetToSeqDict(messageSet, uid)
+
+            return self.box._storeFlags(dict((seq, self.getUID(seq)) for seq in messages), flags, mode)
+
+        return self.box.sync().addCallback(synced)
+
+    def expunge(self):
+
+        """
+        Elimina los mensajes marcados con Deleted y retorna los numeros de secuencia de esta sesion que se
+        eliminaron, incluidos los que otras sesiones eliminaron antes.
+        """
+
+        return self.box.expunge().addCallback(lambda ignored: self.takeExpunges())
+
+    def search(self, query, uid):
+
+        return self.box.sync().addCallback(
+            lambda ignored: self.box._search(query, uid, lambda: self.uidList, lambda: self.paths))
+
+    def destroy(self):
+        return self.box.destroy()
+
+
+def readHeaderBlock(file):
+    """
+    Lee las lineas de encabezado hasta la linea en blanco y retorna el bloque junto al offset del cuerpo.
+    """
+    lines = []
+    for line in file:
+        if line in (b'\n', b'\r\n'):
+            break
+        lines.append(line)
+    return b''.join(lines), file.tell()
+
+def readHeaderFile(messagePath):
+    """
+    Retorna el mtime, el bloque de encabezados y el offset del cuerpo de un mensaje. No usa el cache,
+    por lo que puede correr en el pool de disco.
+    """
+    mtime = os.stat(messagePath).st_mtime_ns
+    with open(messagePath, 'rb') as file:
+        headerData, bodyOffset = readHeaderBlock(file)
+    return mtime, headerData, bodyOffset
+
+def readHeaderFiles(messagePaths):
+    """
+    Lee los encabezados de varios mensajes; los que ya no existen quedan en None.
+    """
+    results = []
+    for messagePath in messagePaths:
+        try:
+            results.append(readHeaderFile(messagePath))
+        except FileNotFoundError:
+            results.append(None)
+    return results
+
+def maildirSize(messagePath):
+    """
+    Obtiene el tamano del mensaje del campo S= del nombre del archivo, o con stat si no lo tiene.
+    """
+    for field in os.path.basename(messagePath).split(':', 1)[0].split(',')[1:]:
+        if field.startswith('S=') and field[2:].isdigit():
+            return int(field[2:])
+    return os.stat(messagePath).st_size
+
+class ParsedMessageCache(object):
+
+    """
+    Cache LRU, compartido por todas las sesiones del proceso, de los encabezados ya procesados de cada mensaje.
+    La llave es la direccion del archivo y su mtime, por lo que un archivo modificado no usa datos viejos.
+    El tamano de cada entrada se estima con el largo del bloque de encabezados mas un costo fijo por entrada.
+    """
+
+    entryOverhead = 1024
+
+    def __init__(self, maxBytes=32 * 2 ** 20, maxEntries=100000):
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.keys = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, mtime):
+        entry = self.entries.get((path, mtime))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end((path, mtime))
+        self.hits += 1
+        return entry[0]
+
+    def put(self, path, mtime, value, cost):
+        self.invalidate(path)
+        key = (path, mtime)
+        self.entries[key] = (value, cost + self.entryOverhead)
+        self.keys[path] = key
+        self.size += cost + self.entryOverhead
+        while self.entries and (self.size > self.maxBytes or len(self.entries) > self.maxEntries):
+            (oldPath, oldTime), (oldValue, oldCost) = self.entries.popitem(last=False)
+            del self.keys[oldPath]
+            self.size -= oldCost
+            self.evictions += 1
+
+    def __contains__(self, path):
+        return path in self.keys
+
+    def invalidate(self, path):
+        """
+        Elimina la entrada de un archivo borrado o renombrado.
+        """
+        key = self.keys.pop(path, None)
+        if key is not None:
+            self.size -= self.entries.pop(key)[1]
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+messageCache = ParsedMessageCache()
+
+class MessageFileSlice(object):
+
+    """
+    Ventana de solo lectura de los bytes [start, end) de un archivo de mensaje. Se lee en bloques del
+    tamano que pida el productor, sin copiar el mensaje a memoria, y el archivo se cierra al llegar al final.
+    """
+
+    def __init__(self, path, start, end):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.position = start
+        self.file = None
+
+    def _seekFile(self):
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        self.file.seek(self.position)
+        return self.file
+
+    def read(self, size=-1):
+        remaining = self.end - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            self.close()
+            return b''
+        data = self._seekFile().read(size)
+        self.position += len(data)
+        if not data:
+            self.close()
+        return data
+
+    def readline(self, size=-1):
+        remaining = self.end - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            self.close()
+            return b''
+        line = self._seekFile().readline(size)
+        self.position += len(line)
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            position = self.start + offset
+        elif whence == 1:
+            position = self.position + offset
+        else:
+            position = self.end + offset
+        self.position = min(max(position, self.start), self.end)
+        return self.tell()
+
+    def tell(self):
+        return self.position - self.start
+
+    def slice(self, begin, length):
+        """
+        Retorna una ventana relativa a esta, usada para los fetch parciales <begin.length>.
+        """
+        start = min(self.start + begin, self.end)
+        return MessageFileSlice(self.path, start, min(start + length, self.end))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class MessagePart(mimestructure.StructurePart):
+
+    """
+    Parte de un mensaje del maildir segun su registro de estructura. Los encabezados y el cuerpo se leen del
+    archivo en los offsets del registro, sin procesar el resto del mensaje.
+    """
+
+    defaultContentType = False
+
+    def __init__(self, node, path):
+        mimestructure.StructurePart.__init__(self, node, None)
+        self.path = path
+
+    def headerData(self):
+        with open(self.path, 'rb') as file:
+            file.seek(self.node['headerStart'])
+            return file.read(self.node['bodyStart'] - self.node['headerStart'])
+
+    def getBodyFile(self):
+        return MessageFileSlice(self.path, self.node['bodyStart'], self.node['end'])
+
+    def _subPart(self, node):
+        return MessagePart(node, self.path)
+
+@implementer(imap4.IMessage, imap4.IMessageFile)
 class MaildirMessage(object):
 
-    def __init__(self, messageData,flags,uid):
+    """
+    Mensaje de un maildir que se lee solo cuando se necesita. Los flags y el uid no tocan el archivo,
+    el tamano sale del nombre o de stat y los encabezados se leen hasta la linea en blanco.
+    """
+
+    def __init__(self, messagePath,flags,uid):
+        self.path = messagePath
         self.flags = flags
         self.uid = uid
-        with open(messageData, 'r') as file:
-            data = file.read()
-        self.data = data
-        self.message = email.message_from_string(data)
+        self._message = None
+        self.bodyOffset = None
+        self.structure = None
+
+    @property
+    def message(self):
+        """
+        Encabezados del mensaje, leidos del archivo la primera vez que se usan.
+        """
+        if self._message is None:
+            mtime = os.stat(self.path).st_mtime_ns
+            cached = messageCache.get(self.path, mtime)
+            if cached is None:
+                self.loadHeaders(*readHeaderFile(self.path))
+            else:
+                self._message, self.bodyOffset = cached
+        return self._message
+
+    def loadHeaders(self, mtime, headerData, bodyOffset):
+        """
+        Procesa un bloque de encabezados ya leido del disco y lo guarda en el cache.
+        """
+        message = email.parser.HeaderParser().parsestr(headerData.decode('utf-8', 'replace'))
+        messageCache.put(self.path, mtime, (message, bodyOffset), len(headerData))
+        self._message, self.bodyOffset = message, bodyOffset
 
     def getHeaders(self, negate, *names):
         if not names:
@@ -407,14 +1462,41 @@ class MaildirMessage(object):
         return headers
 
     def getInternalDate(self):
-        return self.message.get('Date', '')
+        """
+        La fecha interna es la de entrega, tomada del inicio del nombre del maildir o del mtime del archivo.
+        """
+        seconds = os.path.basename(self.path).split('.', 1)[0]
+        if seconds.isdigit():
+            return email.utils.formatdate(int(seconds))
+        return email.utils.formatdate(os.stat(self.path).st_mtime)
 
     def getBodyFile(self):
-        bodyData = self.message.get_payload()
-        return BytesIO(bodyData.encode())
+        """
+        Retorna los bytes del cuerpo como una ventana sobre el archivo.
+        """
+        if self.bodyOffset is None:
+            self.message
+        return MessageFileSlice(self.path, self.bodyOffset, self.getSize())
+
+    def open(self):
+        """
+        Retorna el mensaje completo tal como esta en disco, para BODY[] y RFC822.
+        """
+        return MessageFileSlice(self.path, 0, self.getSize())
 
     def isMultipart(self):
-        return self.message.is_multipart()
+        if self.structure is not None:
+            return self.structure['parts']['type'].startswith('multipart/')
+        return self.message.get_content_maintype() == 'multipart'
+
+    def getSubPart(self, part):
+        """
+        Parte del mensaje, ubicada con el registro de estructura. Si el FETCH no lo cargo se calcula aqui.
+        """
+        if self.structure is None:
+            with open(self.path, 'rb') as file:
+                self.structure = mimestructure.messageStructure(file.read())
+        return MessagePart(self.structure['parts'], self.path).getSubPart(part)
 
     def getFlags(self):
         return self.flags
@@ -423,13 +1505,51 @@ class MaildirMessage(object):
         return self.uid
 
     def getSize(self):
-        return len(self.data)
+        return maildirSize(self.path)
+
+class AccountRegistry(object):
+
+    """
+    Cuentas abiertas compartidas por todas las sesiones de un mismo usuario. Cada login suma una referencia
+    y cada logout la resta; una cuenta sin sesiones se cierra despues de idleTimeout segundos si nadie la pide.
+    """
+
+    def __init__(self, idleTimeout=300, clock=None):
+        self.idleTimeout = idleTimeout
+        self.clock = clock or reactor
+        self.accounts = {}
+
+    def acquire(self, avatarId, userDir):
+        """
+        Retorna la cuenta del usuario, abriendola solo si no esta en el registro.
+        """
+        entry = self.accounts.get(avatarId)
+        if entry is None:
+            entry = self.accounts[avatarId] = [IMAPUserAccount(userDir), 0, None]
+        if entry[2] is not None:
+            entry[2].cancel()
+            entry[2] = None
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, avatarId):
+        entry = self.accounts.get(avatarId)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            entry[2] = self.clock.callLater(self.idleTimeout, self._evict, avatarId)
+
+    def _evict(self, avatarId):
+        account = self.accounts.pop(avatarId)[0]
+        account.close()
 
 @implementer(portal.IRealm)
 class MailUserRealm(object):
 
-    def __init__(self, baseDir):
+    def __init__(self, baseDir, idleTimeout=300):
         self.baseDir = baseDir
+        self.registry = AccountRegistry(idleTimeout)
 
     def requestAvatar(self, avatarId, mind, *interfaces):
         if imap4.IAccount not in interfaces:
@@ -437,9 +1557,9 @@ class MailUserRealm(object):
                 "This realm only supports the imap4.IAccount interface.")
 
         userDir = os.path.join(self.baseDir, avatarId.decode("utf-8"))
-        avatar = IMAPUserAccount(userDir)
+        avatar = self.registry.acquire(avatarId, userDir)
         print(avatar)
-        return imap4.IAccount, avatar, lambda: None
+        return imap4.IAccount, avatar, lambda: self.registry.release(avatarId)
 
 def passwordFileToDict(filename):
     """
@@ -500,11 +1620,167 @@ class CredentialsChecker(object):
 
             raise credError.UnauthorizedLogin("Bad password")
 
+# Atributos de FETCH que se responden sin abrir el archivo del mensaje.
+headerlessFetchTypes = ('flags', 'uid', 'internaldate', 'rfc822size')
+
+def isStructureFetch(attr):
+    """
+    ENVELOPE, BODYSTRUCTURE y BODY sin seccion se responden con el registro de estructura.
+    """
+    if attr.type == 'body':
+        return not (attr.empty or attr.header or attr.text or attr.mime or attr.part)
+    return attr.type in ('envelope', 'bodystructure')
+
+def needsStructure(attr):
+    return isStructureFetch(attr) or (attr.type == 'body' and bool(attr.part))
+
+def needsHeaders(attr):
+    return attr.type not in headerlessFetchTypes and not needsStructure(attr)
+
 class IMAPServerProtocol(imap4.IMAP4Server):
   def lineReceived(self, line):
       print("CLIENT:", line)
       imap4.IMAP4Server.lineReceived(self, line)
 
+  def dispatchCommand(self, tag, cmd, rest, uid=None):
+      """
+      Envia los EXPUNGE pendientes de la sesion antes de cada comando. FETCH, STORE y SEARCH sin UID no los
+      pueden recibir (RFC 3501 7.4.1): el cliente todavia usa los numeros de secuencia anteriores.
+      """
+      if uid is None and cmd.upper() in (b'FETCH', b'STORE', b'SEARCH'):
+          return imap4.IMAP4Server.dispatchCommand(self, tag, cmd, rest, uid)
+      if isinstance(getattr(self, 'mbox', None), MailboxView):
+          self.sendExpunges()
+      return imap4.IMAP4Server.dispatchCommand(self, tag, cmd, rest, uid)
+
+  def sendExpunges(self):
+      for number in self.mbox.takeExpunges():
+          self.sendUntaggedResponse(b'%d EXPUNGE' % (number,))
+
+  def do_NOOP(self, tag):
+      """
+      NOOP es el comando con que el cliente pide novedades: sincroniza el buzon y envia sus EXPUNGE y EXISTS.
+      """
+      if not isinstance(self.mbox, MailboxView):
+          return imap4.IMAP4Server.do_NOOP(self, tag)
+      d = self.mbox.sync()
+      d.addCallback(lambda ignored: self.sendExpunges())
+      d.addCallback(lambda ignored: imap4.IMAP4Server.do_NOOP(self, tag))
+      d.addErrback(log.err)
+
+  select_NOOP = (do_NOOP,)
+
+  def expungesPending(self):
+      """
+      Llamado por la vista cuando otra sesion elimina mensajes. En IDLE los EXPUNGE se envian al momento;
+      si no, esperan al proximo comando que los permita.
+      """
+      if self.parseState == 'idle':
+          self.sendExpunges()
+
+  def do_FETCH(self, tag, messages, query, uid=0):
+      """
+      Avisa al buzon si el FETCH necesita los encabezados, para no leer los archivos cuando solo se piden flags.
+      """
+      if query and isinstance(self.mbox, (IMAPMailbox, MailboxView)):
+          self.mbox.fetchHeaders = any(needsHeaders(attr) for attr in query)
+          self.mbox.fetchStructure = any(needsStructure(attr) for attr in query)
+      imap4.IMAP4Server.do_FETCH(self, tag, messages, query, uid)
+
+  select_FETCH = (do_FETCH, imap4.IMAP4Server.arg_seqset, imap4.IMAP4Server.arg_fetchatt)
+
+  def flushMetadata(self):
+      """
+      Escribe los flags pendientes de la cuenta antes de confirmar el LOGOUT o al perder la conexion.
+      """
+      if isinstance(self.account, IMAPUserAccount):
+          return self.account.flush()
+      return defer.succeed(None)
+
+  def do_LOGOUT(self, tag):
+      d = self.flushMetadata()
+      d.addCallback(lambda ignored: imap4.IMAP4Server.do_LOGOUT(self, tag))
+      d.addErrback(log.err)
+
+  def do_SEARCH(self, tag, charset, query, uid=0):
+      """
+      Con UID SEARCH el buzon ya retorna uids; IMAP4Server los pasaria otra vez por getUID despues del salto al
+      pool, cuando los numeros de secuencia pueden haber cambiado.
+      """
+      if not isinstance(self.mbox, (IMAPMailbox, MailboxView)):
+          return imap4.IMAP4Server.do_SEARCH(self, tag, charset, query, uid)
+      d = defer.maybeDeferred(self.mbox.search, query, uid=uid)
+      d.addCallback(self._cbSearch, tag)
+      d.addErrback(self._ebSearch, tag)
+
+  select_SEARCH = (do_SEARCH, imap4.IMAP4Server.opt_charset, imap4.IMAP4Server.arg_searchkeys)
+
+  def _cbSearch(self, result, tag):
+      self.sendUntaggedResponse(b'SEARCH ' + b' '.join(b'%d' % (number,) for number in result))
+      self.sendPositiveResponse(tag, b'SEARCH completed')
+
+  def _ebSearch(self, failure, tag):
+      self.sendBadResponse(tag, b'SEARCH failed: ' + str(failure.value).encode())
+      log.err(failure)
+
+  unauth_LOGOUT = (do_LOGOUT,)
+  auth_LOGOUT = unauth_LOGOUT
+  select_LOGOUT = unauth_LOGOUT
+  logout_LOGOUT = unauth_LOGOUT
+
+  def connectionLost(self, reason):
+      # IMAP4Server no cierra el buzon seleccionado al perder la conexion; la vista dejaria de recibir cambios.
+      if isinstance(getattr(self, 'mbox', None), MailboxView):
+          self.mbox.close()
+      self.flushMetadata()
+      imap4.IMAP4Server.connectionLost(self, reason)
+
+  def spew_envelope(self, id, msg, _w=None, _f=None):
+      structure = getattr(msg, 'structure', None)
+      if structure is None:
+          return imap4.IMAP4Server.spew_envelope(self, id, msg, _w, _f)
+      if _w is None:
+          _w = self.transport.write
+      _w(b"ENVELOPE " + imap4.collapseNestedLists([structure['envelope']]))
+
+  def spew_bodystructure(self, id, msg, _w=None, _f=None):
+      structure = getattr(msg, 'structure', None)
+      if structure is None:
+          return imap4.IMAP4Server.spew_bodystructure(self, id, msg, _w, _f)
+      if _w is None:
+          _w = self.transport.write
+      _w(b"BODYSTRUCTURE " + imap4.collapseNestedLists([structure['bodystructure']]))
+
+  def spew_body(self, part, id, msg, _w=None, _f=None):
+      """
+      Responde BODY con el registro de estructura y los fetch parciales (BODY[]<0.4096>, BODY[TEXT]<n.m>)
+      leyendo solo el rango pedido del archivo.
+      """
+      if _w is None:
+          _w = self.transport.write
+      structure = getattr(msg, 'structure', None)
+      if structure is not None and isStructureFetch(part):
+          _w(b"BODY " + imap4.collapseNestedLists([structure['body']]))
+          return
+      if part.partialBegin is None or part.header or part.mime:
+          return imap4.IMAP4Server.spew_body(self, part, id, msg, _w, _f)
+      for p in part.part:
+          if msg.isMultipart():
+              msg = msg.getSubPart(p)
+          elif p > 0:
+              raise TypeError("Requested subpart of non-multipart message")
+      messageFile = imap4.IMessageFile(msg, None)
+      if part.empty and not part.part and messageFile is not None:
+          data = messageFile.open()
+      else:
+          data = msg.getBodyFile()
+      if not isinstance(data, MessageFileSlice):
+          return imap4.IMAP4Server.spew_body(self, part, id, msg, _w, _f)
+      name = part.__bytes__().split(b'<', 1)[0]
+      _w(name + b'<%d> ' % (part.partialBegin,))
+      _f()
+      return imap4.FileProducer(data.slice(part.partialBegin, part.partialLength)).beginProducing(self.transport)
+
   def sendLine(self, line):
       imap4.IMAP4Server.sendLine(self, line)
       print("SERVER:", line)
@@ -515,15 +1791,22 @@ class IMAPFactory(protocol.Factory):
 
     def buildProtocol(self, addr):
         proto = IMAPServerProtocol()
-        proto.portal = portal
+        proto.portal = self.portal
         return proto
 
-#python3 IMAPserver.py -s <mail-storage> -p <port>
+#python3 IMAPserver.py -s <mail-storage> -p <port> [-w <workers>] [-d none|flush|always]
 if __name__=='__main__':
     dataDir = sys.argv[2]
 
     port = int(sys.argv[4])
 
+    options = dict(zip(sys.argv[5::2], sys.argv[6::2]))
+
+    # Durabilidad de los flags: ver mailmetadata.DURABILITY_LEVELS.
+    mailmetadata.defaultDurability = options.get('-d', mailmetadata.defaultDurability)
+
+    reactor.addSystemEventTrigger('before', 'shutdown', mailmetadata.flushAll)
+
     portal = portal.Portal(MailUserRealm(dataDir))
 
     passwordFile = os.path.join(dataDir, 'passwords.txt')
@@ -533,5 +1816,8 @@ if __name__=='__main__':
     passwordChecker = CredentialsChecker(passwords)
 
     portal.registerChecker(passwordChecker)
-    reactor.listenTCP(port, IMAPFactory(portal))
+
+    workers = int(options.get('-w', 1))
+
+    prefork.listen(port, lambda: IMAPFactory(portal), workers)
     reactor.run()
\ No newline at end of file
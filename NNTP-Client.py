@@ -4,8 +4,15 @@ from twisted.internet import protocol, defer
 
 import time, email
 import os
+import pickle
+import sqlite3
+from collections import deque
 
-articles = 1
+STATE_SCHEMA = """
+    PRAGMA journal_mode=WAL;
+    CREATE TABLE IF NOT EXISTS groups (name TEXT PRIMARY KEY, highWaterMark INTEGER);
+    CREATE TABLE IF NOT EXISTS messageIds (messageId TEXT PRIMARY KEY) WITHOUT ROWID;
+"""
 
 class NNTPGroupDownloadProtocol(nntp.NNTPClient):
 
@@ -25,37 +32,50 @@ class NNTPGroupDownloadProtocol(nntp.NNTPClient):
 
     last = int(last)
 
-    start = max(first, last-self.factory.articleCount)
+    highWaterMark = self.factory.highWaterMark()
 
-    self.articlesToFetch = range(start+1, last+1)
+    if highWaterMark is None:
+
+        start = max(first, last-self.factory.articleCount)
+
+    else:
+
+        # Sincronizacion incremental: solo los articulos posteriores al ultimo descargado.
+        start = max(first - 1, highWaterMark)
+
+    self.articlesToFetch = deque(range(start+1, last+1))
 
     self.articleCount = len(self.articlesToFetch)
 
+    self.pending = deque()
+
+    self.articleFile = None
+
+    self.messageId = None
+
     print(str(self.articleCount) + " Articles Found.\n")
 
-    value = raw_input("Would you like to download them? y,n \n")
-    if value == "y":
-        self.fetchNextArticle()
-    else:
-        print("Exiting...")
-        reactor.stop()
+    self.fetchNextArticle()
 
 
  def fetchNextArticle(self):
 
-     if self.articlesToFetch:
+     """
+     Mantiene hasta factory.window comandos ARTICLE enviados sin respuesta. El servidor responde en orden,
+     por lo que la respuesta que llega siempre es la del primer articulo pendiente.
+     """
 
-         nextArticleIdx = self.articlesToFetch.pop(0)
+     while self.articlesToFetch and len(self.pending) < self.factory.window:
 
-         print("Fetching article %i of %i..." % (
+         nextArticleIdx = self.articlesToFetch.popleft()
 
-         self.articleCount-len(self.articlesToFetch),
+         self.pending.append(nextArticleIdx)
 
-         self.articleCount),
+         self.fetchArticle(nextArticleIdx)
 
-         self.fetchArticle(nextArticleIdx))
+     if not self.pending:
 
-     else:
+         self.factory.saveState()
 
          self.quit( )
 
@@ -63,11 +83,68 @@ class NNTPGroupDownloadProtocol(nntp.NNTPClient):
 
 
 
- def gotArticle(self, article):
+ def fetchArticle(self, index):
+
+     self.sendLine(b'ARTICLE %d' % (index,))
+
+     self._newState(self._stateArticle, self.getArticleFailed, self._headerArticle)
+
+
+
+ def _headerArticle(self, code):
+
+     """
+     Toma el Message-ID de la linea de estado "220 <numero> <message-id>". Si ya se descargo desde otro grupo
+     o en otra corrida, el articulo se lee pero no se guarda.
+     """
+
+     fields = code[1].split()
+
+     self.messageId = fields[1].decode('ascii', 'replace') if len(fields) > 1 else None
+
+     self.articleFile = self.factory.openArticle(self.pending[0], self.messageId)
+
+
+
+ def _stateArticle(self, line):
+
+     """
+     Escribe cada linea del articulo en su archivo apenas llega, sin juntar el articulo en memoria.
+     """
+
+     if line != b'.':
+
+         if line.startswith(b'.'):
+
+             line = line[1:]
+
+         if self.articleFile is not None:
+
+             self.articleFile.write(line + b'\n')
+
+     else:
+
+         self._endState()
+
+         if self.articleFile is not None:
+
+             self.articleFile.close()
+
+             self.articleFile = None
+
+         articleIdx = self.pending.popleft()
+
+         self.factory.articleDone(articleIdx, self.messageId)
+
+         self.gotArticle(articleIdx)
 
-     print("OK")
 
-     self.factory.handleArticle(article)
+
+ def gotArticle(self, articleIdx):
+
+     print("Fetched article %i of %i" % (self.articleCount - len(self.articlesToFetch) - len(self.pending),
+
+                                          self.articleCount))
 
      self.fetchNextArticle()
 
@@ -77,6 +154,8 @@ class NNTPGroupDownloadProtocol(nntp.NNTPClient):
 
      print(errorMessage)
 
+     self.factory.articleDone(self.pending.popleft(), None)
+
      self.fetchNextArticle( )
 
 
@@ -93,6 +172,11 @@ class NNTPGroupDownloadProtocol(nntp.NNTPClient):
 
  def connectionLost(self, error):
 
+    if self.articleFile is not None:
+        self.articleFile.close()
+
+    self.factory.saveState()
+
     if not self.factory.deferred.called:
         self.factory.deferred.errback(error)
 
@@ -100,31 +184,110 @@ class NNTPGroupDownloadProtocol(nntp.NNTPClient):
 
 class NNTPGroupDownloadFactory(protocol.ClientFactory):
 
+ """
+ Descarga un grupo a output_storage/<grupo>/Article <numero>. La base .nntp-sync.sqlite guarda el ultimo
+ articulo descargado de cada grupo y los Message-ID ya guardados, por lo que cada corrida solo baja lo nuevo.
+ Cada articulo agrega una fila; no se reescribe el estado completo.
+ """
+
  protocol = NNTPGroupDownloadProtocol
 
+ # Cada cuantos articulos se guarda el estado; si se corta la conexion se repiten a lo sumo estos.
+ saveInterval = 100
+
 
 
- def __init__(self, newsgroup, articleCount=10):
+ def __init__(self, newsgroup, articleCount=10, window=1):
 
      self.newsgroup = newsgroup
 
      self.articleCount = articleCount
 
-     if not os.path.exists(output_storage):
-         os.mkdir(output_storage)
+     # Numero de comandos ARTICLE en vuelo.
+     self.window = window
+
+     self.groupDir = os.path.join(output_storage, newsgroup)
+
+     if not os.path.exists(self.groupDir):
+         os.makedirs(self.groupDir)
+
+     self.stateFile = os.path.join(output_storage, '.nntp-sync.sqlite')
+
+     self.state = sqlite3.connect(self.stateFile)
+
+     self.state.executescript(STATE_SCHEMA)
+
+     self.importPickle(os.path.join(output_storage, '.nntp-sync.pickle'))
+
+     row = self.state.execute('SELECT highWaterMark FROM groups WHERE name = ?', (newsgroup,)).fetchone()
+
+     self.lastArticle = row[0] if row is not None else None
+
+     self.unsaved = 0
 
      self.deferred = defer.Deferred()
 
 
 
- def handleArticle(self, articleData):
-     global articles
-     parsedMessage = email.message_from_string(articleData)
-     output = os.path.join(output_storage, "Article "+ str(articles))
-     articles+=1
-     out_file = file(output, 'w+b')
-     out_file.write(parsedMessage.as_string(unixfrom=True))
-     out_file.write('')
+ def highWaterMark(self):
+     """
+     Numero del ultimo articulo descargado del grupo, o None si el grupo nunca se sincronizo.
+     """
+     return self.lastArticle
+
+
+
+ def openArticle(self, articleIdx, messageId):
+     """
+     Abre el archivo donde se escribe el articulo, o retorna None si su Message-ID ya se guardo.
+     """
+     if self.state.execute('SELECT 1 FROM messageIds WHERE messageId = ?', (messageId,)).fetchone() is not None:
+         return None
+     return open(os.path.join(self.groupDir, "Article %d" % articleIdx), 'wb')
+
+
+
+ def articleDone(self, articleIdx, messageId):
+     """
+     Avanza la marca del grupo. Las respuestas llegan en orden, asi que todos los anteriores ya terminaron.
+     """
+     self.lastArticle = articleIdx
+     if messageId is not None:
+         self.state.execute('INSERT OR IGNORE INTO messageIds (messageId) VALUES (?)', (messageId,))
+     self.unsaved += 1
+     if self.unsaved >= self.saveInterval:
+         self.saveState()
+
+
+
+ def saveState(self):
+     """
+     Confirma en una transaccion los Message-ID agregados desde el ultimo guardado junto con la marca del grupo.
+     """
+     if not self.unsaved:
+         return
+     self.state.execute('INSERT OR REPLACE INTO groups (name, highWaterMark) VALUES (?, ?)',
+                        (self.newsgroup, self.lastArticle))
+     self.state.commit()
+     self.unsaved = 0
+
+
+
+ def importPickle(self, pickleFile):
+     """
+     Pasa a la base el estado de las versiones que usaban .nntp-sync.pickle y renombra el archivo para no
+     importarlo de nuevo.
+     """
+     if not os.path.exists(pickleFile):
+         return
+     with open(pickleFile, 'rb') as stateFile:
+         state = pickle.load(stateFile)
+     self.state.executemany('INSERT OR REPLACE INTO groups (name, highWaterMark) VALUES (?, ?)',
+                            state['groups'].items())
+     self.state.executemany('INSERT OR IGNORE INTO messageIds (messageId) VALUES (?)',
+                            ((messageId,) for messageId in state['messageIds']))
+     self.state.commit()
+     os.rename(pickleFile, pickleFile + '.imported')
 
 
 
@@ -138,21 +301,38 @@ if __name__ == "__main__":
 
  def handleError(error):
 
-     print >> sys.stderr, error.getErrorMessage( )
+     print(error.getErrorMessage( ), file=sys.stderr)
 
      reactor.stop( )
 
 
 
- if len(sys.argv) != 4:
+ args = [arg for arg in sys.argv if arg != '-y']
+
+ if len(args) not in (4, 6, 8):
 
-     print >> sys.stderr, "Usage: %s nntpserver newsgroup outputfile"
+     print("Usage: %s nntpserver newsgroup outputfile [-n <articles>] [-w <window>] [-y]" % (sys.argv[0],), file=sys.stderr)
 
      sys.exit(1)
 
- server, newsgroup, output_storage = sys.argv[1:4]
+ server, newsgroup, output_storage = args[1:4]
+
+ options = dict(zip(args[4::2], args[5::2]))
+
+ window = int(options.get('-w', 1))
+
+ # Se pregunta antes de arrancar el reactor, nunca desde un callback; con -y o con -w se descarga sin preguntar.
+ if window <= 1 and '-y' not in sys.argv:
+
+     value = input("Would you like to download the new articles of %s? y,n \n" % (newsgroup,))
+
+     if value != "y":
+
+         print("Exiting...")
+
+         sys.exit(0)
 
- factory = NNTPGroupDownloadFactory(newsgroup)
+ factory = NNTPGroupDownloadFactory(newsgroup, int(options.get('-n', 10)), window)
 
  factory.deferred.addCallback(lambda _: reactor.stop( )).addErrback(handleError)
 
@@ -1,14 +1,23 @@
+import os
+
 from twisted.internet import reactor
 
 from twisted.news import database, news, nntp
 
+import newsstore
+
 GROUPS = ['local.Inbox']
 
 SMTP_SERVER = 'localhost'
 
 STORAGE_DIR = 'mail_storage'
 
-newsStorage = database.NewsShelf(SMTP_SERVER, STORAGE_DIR)
+newsStorage = newsstore.NewsStore(STORAGE_DIR)
+
+# Los articulos guardados por versiones anteriores con NewsShelf se copian la primera vez.
+if os.path.exists(os.path.join(STORAGE_DIR, 'newsshelf')):
+
+    newsStorage.importShelf(database.NewsShelf(SMTP_SERVER, STORAGE_DIR))
 
 for group in GROUPS:
 
@@ -18,4 +27,4 @@ factory = news.NNTPFactory(newsStorage)
 
 reactor.listenTCP(1199, factory)
 
-reactor.run()
\ No newline at end of file
+reactor.run()
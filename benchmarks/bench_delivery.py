@@ -0,0 +1,78 @@
+"""
+Compara la entrega por destinatario contra el spool unico con hard links.
+
+python3 benchmarks/bench_delivery.py [<message-kb>]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.mail import smtp
+
+import diskio
+import smtpserver
+
+# Sin reactor las operaciones de disco tienen que correr en el mismo hilo.
+diskio.diskPool.synchronous = True
+
+
+class Recipient(object):
+    def __init__(self, address):
+        self.dest = smtp.Address(address)
+
+
+def deliver(userDir, recipients, lines, singleSpool):
+    """
+    Simula una transaccion DATA del protocolo SMTP para todos los destinatarios.
+    """
+    delivery = smtpserver.LocalDelivery(userDir, ['localhost'], singleSpool)
+    delivery.validateFrom((b'bench', b'127.0.0.1'), smtp.Address(b'bench@localhost'))
+    factories = [delivery.validateTo(user) for user in recipients]
+    messages = [factory() for factory in factories]
+    for line in lines:
+        for message in messages:
+            message.lineReceived(line)
+    for message in messages:
+        message.eomReceived()
+
+
+def bytesOnDisk(userDir):
+    """
+    Suma el tamano de cada inodo una sola vez para no contar los hard links.
+    """
+    inodes = {}
+    for root, dirs, files in os.walk(userDir):
+        for name in files:
+            info = os.stat(os.path.join(root, name))
+            inodes[info.st_ino] = info.st_size
+    return sum(inodes.values())
+
+
+def main():
+    messageKB = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    lines = [b'Subject: benchmark', b''] + [b'x' * 1023] * messageKB
+    print('%-12s %-14s %10s %12s' % ('recipients', 'mode', 'seconds', 'MB written'))
+    for count in (1, 8, 100):
+        recipients = [Recipient(b'user%d@localhost' % i) for i in range(count)]
+        for singleSpool in (False, True):
+            userDir = tempfile.mkdtemp()
+            try:
+                # La primera entrega crea los buzones, solo se mide la segunda.
+                deliver(userDir, recipients, lines[:2], singleSpool)
+                before = bytesOnDisk(userDir)
+                start = time.perf_counter()
+                deliver(userDir, recipients, lines, singleSpool)
+                elapsed = time.perf_counter() - start
+                written = bytesOnDisk(userDir) - before
+            finally:
+                shutil.rmtree(userDir)
+            mode = 'single-spool' if singleSpool else 'per-recipient'
+            print('%-12d %-14s %10.3f %12.1f' % (count, mode, elapsed, written / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
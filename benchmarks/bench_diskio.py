@@ -0,0 +1,116 @@
+"""
+Mide cuanto se atrasa el reactor mientras se entregan mensajes grandes con el disco ocupado por otro
+proceso, escribiendo en el hilo del reactor contra el pool de disco.
+
+python3 benchmarks/bench_diskio.py [<messages>] [<message-kb>]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import defer, reactor, task
+from twisted.mail import smtp
+
+import diskio
+import smtpserver
+
+PROBE_INTERVAL = 0.005
+
+# Un paso de una entrega por vuelta del reactor, para que el atraso medido sea el del disco.
+cooperator = task.Cooperator(terminationPredicateFactory=lambda: lambda: True,
+                             scheduler=lambda step: reactor.callLater(0, step))
+
+
+class Recipient(object):
+    def __init__(self, address):
+        self.dest = smtp.Address(address)
+
+
+def saturateDisk(path, stop):
+    """
+    Escribe y sincroniza bloques de 4 MB sin parar para mantener ocupado el disco.
+    """
+    block = b'x' * 4 * 2 ** 20
+    with open(os.path.join(path, 'saturate'), 'wb') as file:
+        while not stop.is_set():
+            file.seek(0)
+            file.write(block)
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def deliver(userDir, index, lines):
+    """
+    Entrega un mensaje recibiendo 64 lineas por vuelta del reactor, como llegarian de la red.
+    """
+    delivery = smtpserver.LocalDelivery(userDir, ['localhost'])
+    delivery.validateFrom((b'bench', b'127.0.0.1'), smtp.Address(b'bench@localhost'))
+    message = delivery.validateTo(Recipient(b'user%d@localhost' % (index % 10)))()
+    for i, line in enumerate(lines):
+        message.lineReceived(line)
+        if i % 64 == 0:
+            yield None
+    yield message.eomReceived()
+
+
+def measure(messages, lines):
+    """
+    Retorna los atrasos del reactor, en milisegundos, medidos mientras se hacen las entregas.
+    """
+    lateness = []
+    expected = [time.perf_counter() + PROBE_INTERVAL]
+
+    def probe():
+        now = time.perf_counter()
+        lateness.append(max(0, now - expected[0]) * 1000)
+        expected[0] = now + PROBE_INTERVAL
+
+    userDir = tempfile.mkdtemp()
+    prober = task.LoopingCall(probe)
+    prober.start(PROBE_INTERVAL, now=False)
+    work = [cooperator.cooperate(deliver(userDir, i, lines)).whenDone() for i in range(messages)]
+    done = defer.DeferredList(work)
+    done.addCallback(lambda ignored: prober.stop())
+    done.addCallback(lambda ignored: shutil.rmtree(userDir))
+    done.addCallback(lambda ignored: sorted(lateness))
+    return done
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+@defer.inlineCallbacks
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    messageKB = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    lines = [b'Subject: benchmark', b''] + [b'x' * 1023] * messageKB
+    scratch = tempfile.mkdtemp()
+    stop = threading.Event()
+    saturator = threading.Thread(target=saturateDisk, args=(scratch, stop))
+    saturator.start()
+    try:
+        print('%-12s %10s %10s %10s %10s' % ('mode', 'seconds', 'p50 ms', 'p99 ms', 'max ms'))
+        for synchronous in (True, False):
+            diskio.diskPool.synchronous = synchronous
+            start = time.perf_counter()
+            lateness = yield measure(messages, lines)
+            elapsed = time.perf_counter() - start
+            mode = 'reactor' if synchronous else 'disk pool'
+            print('%-12s %10.2f %10.2f %10.2f %10.2f' % (mode, elapsed, percentile(lateness, 0.5),
+                                                         percentile(lateness, 0.99), lateness[-1]))
+    finally:
+        stop.set()
+        saturator.join()
+        shutil.rmtree(scratch)
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,100 @@
+"""
+Mide las operaciones de flags sobre un buzon grande: el diccionario anterior con una lista por mensaje contra la
+FlagTable con un mapa de bits por flag. STORE 1:* +FLAGS, la seleccion de candidatos de EXPUNGE, la cuenta de
+no leidos y la memoria de cada representacion.
+
+python3 benchmarks/bench_flags.py [mensajes]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mailmetadata
+
+
+def oldStore(flagsByUID, uids, flags, mode):
+    """
+    El recorrido anterior de IMAPMailbox.store: una lista nueva por mensaje, con count y remove por flag.
+    """
+    for uid in uids:
+        if mode == 0:
+            messageFlags = list(flags)
+        else:
+            messageFlags = list(flagsByUID.get(uid, []))
+            for flag in flags:
+                if mode == 1 and not messageFlags.count(flag):
+                    messageFlags.append(flag)
+                elif mode == -1 and messageFlags.count(flag):
+                    messageFlags.remove(flag)
+        flagsByUID[uid] = messageFlags
+
+
+def oldDeleted(flagsByUID, uids):
+    return [uid for uid in uids if '\\Deleted' in flagsByUID.get(uid, [])]
+
+
+def oldSeenCount(flagsByUID):
+    return sum(1 for messageFlags in flagsByUID.values() if '\\Seen' in messageFlags)
+
+
+def sampleFlags(count):
+    flags = {}
+    for uid in range(1, count + 1):
+        messageFlags = []
+        if uid % 3 == 0:
+            messageFlags.append('\\Seen')
+        if uid % 50 == 0:
+            messageFlags.append('\\Deleted')
+        if uid % 7 == 0:
+            messageFlags.append('\\Flagged')
+        flags[uid] = messageFlags
+    return flags
+
+
+def measure(name, old, new, runs=5):
+    results = []
+    for function in (old, new):
+        function()
+        start = time.perf_counter()
+        for i in range(runs):
+            function()
+        results.append((time.perf_counter() - start) / runs * 1000)
+    print('%-32s %10.2f ms %10.2f ms' % (name, results[0], results[1]))
+
+
+def memory(build):
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del value
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    uids = list(range(1, count + 1))
+    flagsByUID = sampleFlags(count)
+    table = mailmetadata.FlagTable(flagsByUID)
+    assert oldDeleted(flagsByUID, uids) == table.withFlag('\\Deleted')
+    assert oldSeenCount(flagsByUID) == table.count('\\Seen')
+
+    print('%d mensajes %30s %13s' % (count, 'listas', 'FlagTable'))
+    measure('STORE 1:* +FLAGS (\\Seen)', lambda: oldStore(flagsByUID, uids, ['\\Seen'], 1),
+            lambda: table.update(uids, ['\\Seen'], 1))
+    measure('STORE 1:* -FLAGS (\\Flagged)', lambda: oldStore(flagsByUID, uids, ['\\Flagged'], -1),
+            lambda: table.update(uids, ['\\Flagged'], -1))
+    measure('candidatos de EXPUNGE', lambda: oldDeleted(flagsByUID, uids), lambda: table.withFlag('\\Deleted'))
+    measure('no leidos', lambda: oldSeenCount(flagsByUID), lambda: table.count('\\Seen'))
+
+    old = memory(lambda: sampleFlags(count))
+    flags = sampleFlags(count)
+    new = memory(lambda: mailmetadata.FlagTable(flags))
+    print('%-32s %10.0f KB %10.0f KB' % ('memoria', old / 1024, new / 1024))
+
+
+if __name__ == '__main__':
+    main()
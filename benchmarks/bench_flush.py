@@ -0,0 +1,54 @@
+"""
+Mide un STORE que marca como leidos muchos mensajes con cada durabilidad de MetadataStore: tiempo, writes y
+fsyncs al log.
+
+python3 benchmarks/bench_flush.py [mensajes]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import task
+
+import diskio
+import mailmetadata
+
+diskio.diskPool.synchronous = True
+
+
+def storeSeen(durability, count):
+    directory = tempfile.mkdtemp()
+    try:
+        store = mailmetadata.MetadataStore(directory, durability, task.Clock())
+        uids = [store.assignUID('%d.M%dP1.host' % (1600000000 + i, i)) for i in range(count)]
+        before = store.stats()
+        start = time.perf_counter()
+        for uid in uids:
+            store.setFlags(uid, ['\\Seen'])
+        store.flush()
+        elapsed = time.perf_counter() - start
+        after = store.stats()
+        store.close()
+
+        reopened = mailmetadata.MetadataStore(directory, durability, task.Clock())
+        assert reopened.seenCount == count
+        reopened.close()
+        print('%-8s %9.1f ms %8d writes %8d fsyncs' % (durability, elapsed * 1000, after['writes'] - before['writes'],
+                                                     after['fsyncs'] - before['fsyncs']))
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print('STORE +FLAGS (\\Seen) sobre %d mensajes' % count)
+    for durability in mailmetadata.DURABILITY_LEVELS:
+        storeSeen(durability, count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Compara NewsShelf con NewsStore (sqlite) en un grupo de 100k articulos: LIST, GROUP, XOVER de los ultimos
+100 articulos, busquedas por Message-ID y LISTGROUP.
+
+NewsShelf reescribe el pickle del grupo completo en cada postRequest, por lo que su grupo se arma de una
+sola vez; en NewsStore los articulos se publican con postRequest.
+
+python benchmarks/bench_newsstore.py [<articles>]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import defer, reactor
+from twisted.news import database
+
+import newsstore
+
+GROUP = 'local.bench'
+
+
+def articleText(i):
+    return ('Newsgroups: %s\r\nSubject: article %d\r\nFrom: bench@localhost\r\nMessage-ID: <%d@bench>\r\n\r\n'
+            'body of article %d\r\n' % (GROUP, i, i, i))
+
+
+def fillShelf(shelf, count):
+    group = database.Group(GROUP, ['y'])
+    for i in range(1, count + 1):
+        cleave = articleText(i).find('\r\n\r\n')
+        group.articles[i] = database.Article(articleText(i)[:cleave], articleText(i)[cleave + 4:])
+        shelf.dbm['Message-IDs']['<%d@bench>' % i] = [(GROUP, str(i))]
+    group.maxArticle = count
+    shelf.dbm['groups'][GROUP] = group
+
+
+@defer.inlineCallbacks
+def fillStore(store, count):
+    yield store.addGroup(GROUP, ['y'])
+    for i in range(1, count + 1):
+        yield store.postRequest(articleText(i))
+
+
+@defer.inlineCallbacks
+def timed(function, *args):
+    start = time.time()
+    yield function(*args)
+    defer.returnValue(time.time() - start)
+
+
+@defer.inlineCallbacks
+def lookups(storage, ids):
+    for messageId in ids:
+        yield storage.articleRequest(None, None, messageId)
+
+
+@defer.inlineCallbacks
+def measure(name, storage, count):
+    ids = ['<%d@bench>' % random.randint(1, count) for i in range(1000)]
+    results = [
+        ('LIST', (yield timed(storage.listRequest))),
+        ('GROUP', (yield timed(storage.groupRequest, GROUP))),
+        ('XOVER last 100', (yield timed(storage.xoverRequest, GROUP, count - 99, count))),
+        ('1000 Message-IDs', (yield timed(lookups, storage, ids))),
+        ('LISTGROUP', (yield timed(storage.listGroupRequest, GROUP))),
+    ]
+    for operation, seconds in results:
+        print('%-10s %-18s %10.4f' % (name, operation, seconds))
+
+
+@defer.inlineCallbacks
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    shelfDir = tempfile.mkdtemp()
+    storeDir = tempfile.mkdtemp()
+    try:
+        shelf = database.NewsShelf('localhost', shelfDir)
+        start = time.time()
+        fillShelf(shelf, count)
+        print('%-10s %-18s %10.4f' % ('NewsShelf', 'fill', time.time() - start))
+        yield measure('NewsShelf', shelf, count)
+
+        store = newsstore.NewsStore(storeDir)
+        start = time.time()
+        yield fillStore(store, count)
+        print('%-10s %-18s %10.4f' % ('NewsStore', 'fill (post)', time.time() - start))
+        yield measure('NewsStore', store, count)
+        store.dbpool.close()
+    finally:
+        shutil.rmtree(shelfDir)
+        shutil.rmtree(storeDir)
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
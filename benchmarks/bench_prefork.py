@@ -0,0 +1,82 @@
+"""
+Prueba de carga del servidor SMTP con 1, 2 y 4 procesos compartiendo el puerto.
+
+python3 benchmarks/bench_prefork.py [<clients> <messages-per-client> <message-kb>]
+"""
+import multiprocessing
+import os
+import shutil
+import smtplib
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def freePort():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def waitForPort(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+
+def client(args):
+    """
+    Envia los mensajes de un cliente reutilizando una conexion para todas las transacciones.
+    """
+    port, messages, body = args
+    connection = smtplib.SMTP('127.0.0.1', port)
+    for i in range(messages):
+        connection.sendmail('bench@localhost', ['user%d@localhost' % (i % 50)], body)
+    connection.quit()
+
+
+def run(workers, clients, messages, body):
+    storage = tempfile.mkdtemp()
+    port = freePort()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'smtpserver.py'), '-d', 'localhost', '-s', storage,
+         '-p', str(port), '-w', str(workers)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        waitForPort(port)
+        # Los workers adoptan el socket despues de arrancar, se espera a que todos esten listos.
+        time.sleep(1)
+        with multiprocessing.Pool(clients) as pool:
+            start = time.perf_counter()
+            pool.map(client, [(port, messages, body)] * clients)
+            elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(storage)
+    return clients * messages / elapsed
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    messageKB = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+    body = 'Subject: load test\r\n\r\n' + ('x' * 1022 + '\r\n') * messageKB
+    print('%-8s %14s' % ('workers', 'messages/s'))
+    for workers in (1, 2, 4):
+        print('%-8d %14.1f' % (workers, run(workers, clients, messages, body)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Mide el costo de RCPT TO por destinatario: la validacion anterior (lista de dominios, prints y revision del buzon
+en el disco) contra RecipientIndex.
+
+python3 benchmarks/bench_rcpt.py [destinatarios]
+"""
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.mail import smtp
+
+import smtpserver
+
+DOMAINS = ['localhost'] + ['domain%d.com' % i for i in range(50)]
+
+
+class Recipient(object):
+    def __init__(self, address):
+        self.dest = smtp.Address(address)
+
+
+def oldValidateTo(userDir, user):
+    """
+    Lo que hacia validateTo y MaildirMessageWriter antes del indice.
+    """
+    if user.dest.domain.decode("utf-8") in DOMAINS:
+        print("Domain: %s accepted" % user.dest.domain.decode("utf-8"))
+        print()
+        print("Server ready.")
+        print("Waiting for connections...")
+        print()
+        return smtpserver.initializeInbox(userDir, user)
+    raise smtp.SMTPBadRcpt(user)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    userDir = tempfile.mkdtemp()
+    try:
+        recipients = [Recipient(b'user%d@localhost' % i) for i in range(count)]
+        for user in recipients:
+            smtpserver.initializeInbox(userDir, user)
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            for user in recipients:
+                oldValidateTo(userDir, user)
+            old = time.perf_counter() - start
+
+        index = smtpserver.RecipientIndex(userDir, DOMAINS)
+        start = time.perf_counter()
+        for user in recipients:
+            index.accepts(user) and index.inbox(user)()
+        new = time.perf_counter() - start
+
+        print('%d recipients' % count)
+        print('%-16s %8.3f s %10.0f rcpt/s' % ('anterior', old, count / old))
+        print('%-16s %8.3f s %10.0f rcpt/s' % ('RecipientIndex', new, count / new))
+    finally:
+        shutil.rmtree(userDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Mide la lectura de la lista de destinatarios: el algoritmo anterior de smtpclient (addresses = addresses + new)
+contra RecipientReader, en direcciones por segundo y memoria maxima.
+
+python3 benchmarks/bench_recipients.py [filas] [direcciones por fila]
+"""
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bulksender
+
+
+def createCSV(path, rows, perRow):
+    """
+    Crea un csv con perRow direcciones por fila; una de cada diez se repite.
+    """
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        for row in range(rows):
+            first = row * perRow
+            numbers = [i if i % 10 else i // 2 for i in range(first, first + perRow)]
+            writer.writerow(['User%d@Domain%d.com' % (n, n % 500) for n in numbers])
+
+
+def oldReader(path):
+    """
+    Algoritmo anterior de smtpclient.send_data.
+    """
+    addresses = []
+    with open(path, 'r') as csvfile:
+        spamreader = csv.reader(csvfile, delimiter='\n', quotechar='|')
+        for row in spamreader:
+            new = row[0].split(sep=',')
+            addresses = addresses + new
+    return addresses
+
+
+def measure(name, function, traceMemory=False):
+    if traceMemory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    count = function()
+    elapsed = time.perf_counter() - start
+    peak = ''
+    if traceMemory:
+        peak = '  peak %.1f MB' % (tracemalloc.get_traced_memory()[1] / 1e6)
+        tracemalloc.stop()
+    print('%-32s %9d addresses  %7.2f s  %10.0f addresses/s%s' % (name, count, elapsed, count / elapsed, peak))
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    perRow = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'recipients.csv')
+        createCSV(path, rows, perRow)
+        print('%d rows x %d addresses, %.1f MB' % (rows, perRow, os.path.getsize(path) / 1e6))
+
+        # El algoritmo anterior es cuadratico; solo se mide con una parte del archivo.
+        oldRows = min(rows, 10000)
+        oldPath = os.path.join(directory, 'old.csv')
+        createCSV(oldPath, oldRows, perRow)
+        measure('anterior (%d filas)' % oldRows, lambda: len(oldReader(oldPath)))
+        measure('RecipientReader (%d filas)' % oldRows, lambda: sum(1 for a in bulksender.RecipientReader(oldPath)))
+
+        measure('RecipientReader', lambda: sum(1 for a in bulksender.RecipientReader(path)))
+        measure('RecipientReader en memoria', lambda: sum(1 for a in bulksender.RecipientReader(path)), True)
+        measure('RecipientReader maxInMemory=10k',
+                lambda: sum(1 for a in bulksender.RecipientReader(path, maxInMemory=10000)), True)
+        measure('RecipientReader + domainBatches',
+                lambda: sum(len(b) for d, b in bulksender.domainBatches(bulksender.RecipientReader(path), 50)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Mide SEARCH sobre el indice de un buzon grande: arma un indice con mensajes sinteticos y cronometra consultas
+compiladas como las recibe IMAPMailbox.search. Tambien mide cuantos mensajes por segundo indexa una entrega.
+
+python3 benchmarks/bench_search.py [mensajes]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mailmetadata
+import searchindex
+
+QUERIES = [
+    [b'FROM', b'user42@', b'SINCE', b'1-Feb-2021'],
+    [b'SUBJECT', b'report 7', b'UNSEEN'],
+    [b'OR', b'FROM', b'user1@', b'TO', b'user2@', b'LARGER', b'4000'],
+    [b'BODY', b'invoice', b'NOT', b'DELETED'],
+    [b'TEXT', b'user42', b'SENTBEFORE', b'1-Mar-2021'],
+]
+
+START = 1609459200  # 1-Jan-2021
+
+
+def buildIndex(path, count):
+    """
+    Llena el indice directamente con filas sinteticas; cada mensaje tiene uid igual a su posicion mas uno.
+    """
+    index = searchindex.SearchIndex(path)
+    db = index._connect()
+    db.execute('BEGIN')
+    rows = []
+    tokens = []
+    for i in range(count):
+        date = START + i * 60
+        rows.append((i + 1, '%d.M%dP1.host' % (date, i), 'user%d@domain%d.com' % (i % 1000, i % 50),
+                     'user%d@localhost' % (i % 7), '', '', 'report %d' % (i % 100), searchindex.dayOf(date),
+                     date, 2000 + i % 5000, None))
+        words = ['hello', 'word%d' % (i % 5000)] + (['invoice'] if i % 20 == 0 else [])
+        tokens.extend((word, i + 1) for word in words)
+        tokens.append((searchindex.HEADER_TOKEN + 'user%d' % (i % 1000), i + 1))
+    db.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    db.executemany('INSERT OR IGNORE INTO tokens VALUES (?, ?)', tokens)
+    db.execute('COMMIT')
+    names = [row[1] for row in rows]
+    flags = mailmetadata.FlagTable(dict((i + 1, ['\\Seen']) for i in range(0, count, 3)))
+    snapshot = searchindex.MailboxSnapshot(list(range(1, count + 1)), names,
+                                           dict((name, i + 1) for i, name in enumerate(names)), flags)
+    return index, snapshot
+
+
+def measureDelivery(path, count):
+    messages = []
+    for i in range(count):
+        messagePath = os.path.join(path, '%d.M%dP2.host' % (START + i, i))
+        with open(messagePath, 'wb') as messageFile:
+            messageFile.write(b'From: user%d@example.com\r\nTo: me@localhost\r\nSubject: =?utf-8?q?caf=C3=A9?= %d\r\n'
+                              b'Date: Fri, 5 Feb 2021 10:00:00 -0600\r\n\r\n' % (i, i) + b'some body text\r\n' * 40)
+        messages.append(messagePath)
+    index = searchindex.SearchIndex(path)
+    start = time.perf_counter()
+    for messagePath in messages:
+        index.add([messagePath])
+    elapsed = time.perf_counter() - start
+    print('%-60s %8.0f mensajes/s' % ('indexar al entregar, de a uno', count / elapsed))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        index, snapshot = buildIndex(directory, count)
+        print('%d mensajes, indice armado en %.1f s' % (count, time.perf_counter() - start))
+        for query in QUERIES:
+            node = searchindex.compileQuery(query, count, count)
+            index.search(node, snapshot)
+            runs = 10
+            start = time.perf_counter()
+            for i in range(runs):
+                result = index.search(node, snapshot)
+            elapsed = (time.perf_counter() - start) / runs
+            text = ' '.join(term.decode() for term in query)
+            print('%-48s %8d resultados %8.2f ms' % (text, len(result), elapsed * 1000))
+        index.close()
+
+        deliveryDir = os.path.join(directory, 'delivery')
+        os.mkdir(deliveryDir)
+        measureDelivery(deliveryDir, 2000)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
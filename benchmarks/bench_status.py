@@ -0,0 +1,66 @@
+"""
+Mide el costo de UNSEEN en STATUS: el recorrido anterior de getUnseenCount (uid y flags de cada archivo) contra
+el contador que mantiene MetadataStore.
+
+python3 benchmarks/bench_status.py [mensajes]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import diskio
+import mailmetadata
+
+diskio.diskPool.synchronous = True
+
+
+def oldUnseenCount(metadata, messagePaths):
+    """
+    getUnseenCount anterior, con sum en lugar del len(filter(...)) que fallaba en Python 3.
+    """
+    def messageIsUnseen(filename):
+        filename = os.path.basename(filename)
+        uid = metadata['uids'].get(filename)
+        flags = metadata['flags'].get(uid, [])
+        if not r'Seen' in flags:
+            return True
+
+    return sum(1 for messagePath in messagePaths if messageIsUnseen(messagePath))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    directory = tempfile.mkdtemp()
+    try:
+        store = mailmetadata.MetadataStore(directory)
+        messagePaths = [os.path.join(directory, 'cur', '%d.M%dP1.host:2,' % (1600000000 + i, i)) for i in range(count)]
+        for messagePath in messagePaths:
+            uid = store.assignUID(os.path.basename(messagePath))
+            if uid % 3 == 0:
+                store.setFlags(uid, ['\\Seen'])
+
+        runs = 20
+        start = time.perf_counter()
+        for i in range(runs):
+            oldUnseenCount(store.data, messagePaths)
+        old = (time.perf_counter() - start) / runs
+
+        start = time.perf_counter()
+        for i in range(runs):
+            max(0, len(messagePaths) - store.seenCount)
+        new = (time.perf_counter() - start) / runs
+
+        print('%d mensajes, %d sin leer' % (count, count - store.seenCount))
+        print('%-16s %10.3f ms por STATUS' % ('anterior', old * 1000))
+        print('%-16s %10.3f ms por STATUS' % ('seenCount', new * 1000))
+        store.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Mide el costo de responder BODYSTRUCTURE de un mensaje multipart grande: procesar el mensaje completo en cada
+FETCH contra leer el registro que se guarda al entregarlo.
+
+python3 benchmarks/bench_structure.py [MB de adjunto]
+"""
+import email
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import searchindex
+
+
+def createMessage(path, megabytes):
+    message = MIMEMultipart()
+    message['From'] = 'ana@example.com'
+    message['To'] = 'bob@example.com'
+    message['Subject'] = 'reporte'
+    alternative = MIMEMultipart('alternative')
+    alternative.attach(MIMEText('hola\n' * 200))
+    alternative.attach(MIMEText('<p>hola</p>\n' * 200, 'html'))
+    message.attach(alternative)
+    message.attach(MIMEApplication(os.urandom(megabytes * 2 ** 20), 'pdf'))
+    with open(path, 'wb') as messageFile:
+        messageFile.write(message.as_bytes())
+
+
+def measure(name, function, runs=10):
+    function()
+    start = time.perf_counter()
+    for i in range(runs):
+        function()
+    print('%-40s %10.3f ms' % (name, (time.perf_counter() - start) / runs * 1000))
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, '1612540800.M1P1.host')
+        createMessage(path, megabytes)
+        index = searchindex.SearchIndex(directory)
+        index.add([path])
+        print('mensaje de %.1f MB' % (os.path.getsize(path) / 2 ** 20))
+
+        def parseEveryTime():
+            with open(path, 'rb') as messageFile:
+                message = email.message_from_binary_file(messageFile)
+            return [part.get_content_type() for part in message.walk()]
+
+        measure('procesar el mensaje completo', parseEveryTime)
+        measure('registro guardado (sqlite + pickle)', lambda: index.structures([path]))
+        record = index.structures([path])[0]
+        print('registro: %d bytes' % len(pickle.dumps(record, pickle.HIGHEST_PROTOCOL)))
+        index.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Mide la traduccion de UID FETCH 1:* a numeros de secuencia en buzones de 1k, 10k y 100k mensajes.
+
+python3 benchmarks/bench_uidmap.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.mail import imap4, maildir
+
+import diskio
+import IMAPserver
+
+# Sin reactor las operaciones de disco tienen que correr en el mismo hilo.
+diskio.diskPool.synchronous = True
+
+
+def createMailbox(path, count):
+    """
+    Crea un maildir con mensajes vacios, suficientes para medir el mapa de uids.
+    """
+    maildir.initializeMaildir(path)
+    for i in range(count):
+        open(os.path.join(path, 'new', '%010d.bench' % i), 'w').close()
+
+
+def linearUIDMap(mailbox, messageSet):
+    """
+    Algoritmo anterior: ordena todos los uids y usa list.index por cada uid pedido.
+    """
+    allUIDs = sorted(mailbox.metadata['uids'][os.path.basename(f)] for f in mailbox.maildir)
+    seqMap = {}
+    for uid in messageSet:
+        if uid in allUIDs:
+            sequence = allUIDs.index(uid) + 1
+            seqMap[sequence] = mailbox.maildir[sequence - 1]
+    return seqMap
+
+
+def timeIt(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    print('%-10s %14s %14s %14s' % ('messages', 'bisect 1:*', 'bisect 1 uid', 'linear 1:*'))
+    for count in (1000, 10000, 100000):
+        path = tempfile.mkdtemp()
+        try:
+            createMailbox(os.path.join(path, 'Inbox'), count)
+            mailbox = IMAPserver.IMAPMailbox(os.path.join(path, 'Inbox'))
+            full = timeIt(mailbox._uidMessageSetToSeqDict, imap4.parseIdList(b'1:*'))
+            single = timeIt(mailbox._uidMessageSetToSeqDict, imap4.parseIdList(b'%d' % (count // 2)))
+            if count <= 10000:
+                messageSet = imap4.parseIdList(b'1:*')
+                messageSet.last = mailbox.uidList[-1]
+                linear = '%14.4f' % timeIt(linearUIDMap, mailbox, messageSet)
+            else:
+                linear = '%14s' % 'skipped'
+            print('%-10d %14.4f %14.6f %s' % (count, full, single, linear))
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
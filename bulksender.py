@@ -0,0 +1,446 @@
+import collections
+import csv
+import io
+import sqlite3
+import sys
+import tempfile
+
+from email.mime.text import MIMEText
+
+from twisted.internet import defer, protocol, reactor
+from twisted.mail import smtp
+from twisted.python import log
+
+
+class OutgoingMessage(object):
+
+    """
+    Un mensaje pendiente: los destinatarios de un mismo dominio que van en una sola transaccion SMTP.
+    """
+
+    def __init__(self, recipients, data, attempts=0):
+        self.recipients = recipients
+        self.data = data
+        self.attempts = attempts
+
+
+def domainBatches(addresses, batchSize, maxOpenBatches=10000):
+    """
+    Agrupa las direcciones por dominio en lotes de hasta batchSize destinatarios, a medida que se leen.
+    Solo se guarda un lote abierto por dominio y como maximo maxOpenBatches; si hay mas dominios se envia
+    el lote abierto mas antiguo, por lo que la memoria no depende del largo de la lista.
+    """
+    pending = collections.OrderedDict()
+    for address in addresses:
+        domain = address.rsplit('@', 1)[-1].lower()
+        batch = pending.setdefault(domain, [])
+        batch.append(address)
+        if len(batch) >= batchSize:
+            del pending[domain]
+            yield domain, batch
+        elif len(pending) > maxOpenBatches:
+            yield pending.popitem(last=False)
+    for domain, batch in pending.items():
+        yield domain, batch
+
+
+def normalizeAddress(field):
+    """
+    Retorna la direccion del campo sin espacios, sin nombre ni <> y con el dominio en minusculas,
+    o None si el campo no es una direccion.
+    """
+    address = field.strip()
+    if '<' in address:
+        # La direccion es lo que esta entre los ultimos <>; parseaddr corta en la coma de un nombre
+        # como "Perez, Ana" <ana@example.com>, que el csv deja sin comillas.
+        address = address[address.rfind('<') + 1:].split('>', 1)[0].strip()
+    local, at, domain = address.rpartition('@')
+    if not local or not domain or ' ' in address or '@' in local:
+        return None
+    return local + '@' + domain.lower()
+
+
+class SeenAddresses(object):
+
+    """
+    Conjunto de direcciones ya leidas. Guarda hasta maxInMemory direcciones en un set; a partir de ahi
+    las pasa a una base sqlite temporal, por lo que la memoria usada no crece con el archivo.
+    """
+
+    def __init__(self, maxInMemory=1000000):
+        self.maxInMemory = maxInMemory
+        self.addresses = set()
+        self.db = None
+
+    def add(self, address):
+        """
+        Agrega la direccion y retorna True si no estaba.
+        """
+        if self.db is None:
+            if address in self.addresses:
+                return False
+            self.addresses.add(address)
+            if len(self.addresses) >= self.maxInMemory:
+                self._spill()
+            return True
+        cursor = self.db.execute('INSERT OR IGNORE INTO seen VALUES (?)', (address,))
+        return cursor.rowcount == 1
+
+    def _spill(self):
+        self.dbFile = tempfile.NamedTemporaryFile(prefix='recipients-', suffix='.sqlite')
+        self.db = sqlite3.connect(self.dbFile.name)
+        self.db.execute('PRAGMA journal_mode=OFF')
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.execute('CREATE TABLE seen (address TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.db.executemany('INSERT INTO seen VALUES (?)', ((address,) for address in self.addresses))
+        self.addresses = set()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.dbFile.close()
+            self.db = None
+
+
+class RecipientReader(object):
+
+    """
+    Lee las direcciones de un archivo csv a medida que se iteran, separadas por comas, una por linea o
+    ambas. Cada direccion se normaliza y se entrega una sola vez; los campos que no son direcciones
+    (por ejemplo un encabezado) se cuentan en invalid y las repetidas en duplicates.
+    """
+
+    def __init__(self, path, maxInMemory=1000000):
+        self.path = path
+        self.maxInMemory = maxInMemory
+        self.read = 0
+        self.invalid = 0
+        self.duplicates = 0
+
+    def __iter__(self):
+        seen = SeenAddresses(self.maxInMemory)
+        try:
+            with open(self.path, 'r', newline='') as csvfile:
+                for row in csv.reader(csvfile):
+                    for field in row:
+                        if not field or field.isspace():
+                            continue
+                        self.read += 1
+                        address = normalizeAddress(field)
+                        if address is None:
+                            self.invalid += 1
+                        elif seen.add(address):
+                            yield address
+                        else:
+                            self.duplicates += 1
+        finally:
+            seen.close()
+
+
+def readRecipients(path):
+    """
+    Retorna las direcciones del archivo csv, sin repetir.
+    """
+    return RecipientReader(path)
+
+
+class BulkSMTPClient(smtp.SMTPClient):
+
+    """
+    Sesion SMTP que envia varios mensajes en la misma conexion, una transaccion despues de la otra,
+    pidiendo cada uno al BulkSender hasta que no quedan mensajes para su destino.
+    """
+
+    debug = False
+
+    def __init__(self, identity, bulk, destination):
+        smtp.SMTPClient.__init__(self, identity)
+        self.bulk = bulk
+        self.destination = destination
+        self.message = None
+        self.messagesSent = 0
+        self.finished = False
+        self.failed = False
+
+    def getMailFrom(self):
+        self.message = self.bulk.nextMessage(self)
+        if self.message is None:
+            self.finished = True
+            return None
+        return self.bulk.sender
+
+    def getMailTo(self):
+        return self.message.recipients
+
+    def getMailData(self):
+        return io.BytesIO(self.message.data)
+
+    def sentMail(self, code, resp, numOk, addresses, log):
+        message, self.message = self.message, None
+        self.messagesSent += 1
+        if numOk and code in smtp.SUCCESS:
+            self.bulk.hostAccepted(self.destination)
+        self.bulk.messageSent(self.destination, message, code, resp, addresses)
+
+    def sendError(self, exc):
+        self.failed = True
+        message, self.message = self.message, None
+        if message is not None:
+            if getattr(exc, 'addresses', None):
+                self.bulk.messageSent(self.destination, message, exc.code, exc.resp, exc.addresses)
+            else:
+                self.bulk.messageFailed(self.destination, message, exc)
+        smtp.SMTPClient.sendError(self, exc)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        smtp.SMTPClient.connectionLost(self, reason)
+        message, self.message = self.message, None
+        if message is not None:
+            self.bulk.messageFailed(self.destination, message, reason.value)
+        # Un saludo rechazado, un error o una conexion cortada antes de terminar cuentan como falla del destino.
+        self.bulk.sessionEnded(self.destination, self.failed or not self.finished, reason.getErrorMessage())
+
+
+class BulkSessionFactory(protocol.ClientFactory):
+
+    def __init__(self, bulk, destination):
+        self.bulk = bulk
+        self.destination = destination
+
+    def buildProtocol(self, addr):
+        return BulkSMTPClient(self.bulk.identity, self.bulk, self.destination)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.bulk.connectionFailed(self.destination, reason)
+
+
+class BulkSender(object):
+
+    """
+    Envia un mensaje a una lista grande de direcciones.
+
+    Los destinatarios se agrupan por dominio en lotes de batchSize (un RCPT por direccion en la misma transaccion)
+    y cada lote va al (host, puerto) que retorna route(dominio). Cada destino tiene hasta sessionsPerHost
+    conexiones abiertas, con un total de maxSessions, y cada conexion envia hasta messagesPerSession mensajes
+    antes de cerrarse. Los lotes se leen de la lista a medida que se necesitan, por lo que la lista puede ser
+    un generador. Los errores temporales (4xx o conexion perdida) se reintentan hasta maxAttempts veces, con
+    espera exponencial desde retryDelay hasta maxRetryDelay; los permanentes (5xx) van directo a failed. Un
+    destino que falla no se vuelve a conectar hasta que pasa su propia espera, y si falla maxAttempts veces
+    seguidas, sin aceptar ningun mensaje en el medio, da por fallidos los mensajes que lo esperan.
+    """
+
+    def __init__(self, sender, route, identity='localhost', maxSessions=8, sessionsPerHost=2,
+                 messagesPerSession=1000, batchSize=50, maxAttempts=3, retryDelay=5, maxRetryDelay=300,
+                 reactor=reactor):
+        self.sender = sender
+        self.route = route
+        self.identity = identity
+        self.maxSessions = maxSessions
+        self.sessionsPerHost = sessionsPerHost
+        self.messagesPerSession = messagesPerSession
+        self.batchSize = batchSize
+        self.maxAttempts = maxAttempts
+        self.retryDelay = retryDelay
+        self.maxRetryDelay = maxRetryDelay
+        self.reactor = reactor
+
+        self.queues = collections.OrderedDict()
+        self.queued = 0
+        self.maxQueued = maxSessions * 16
+        self.sessions = collections.Counter()
+        self.activeSessions = 0
+        self.connectFailures = collections.Counter()
+        self.hostBackoff = {}
+        self.delayed = 0
+
+        self.sent = 0
+        self.messages = 0
+        self.failed = []
+
+    def send(self, addresses, makeMessage):
+        """
+        Envia a todas las direcciones. makeMessage(recipients) retorna los bytes del mensaje de cada lote.
+        Retorna un Deferred que se dispara con este BulkSender cuando no quedan mensajes pendientes.
+        """
+        self.batches = domainBatches(addresses, self.batchSize)
+        self.makeMessage = makeMessage
+        self.exhausted = False
+        self.done = defer.Deferred()
+        self._schedule()
+        return self.done
+
+    def _fill(self):
+        """
+        Lee lotes de la lista hasta tener maxQueued mensajes esperando.
+        """
+        while not self.exhausted and self.queued < self.maxQueued:
+            try:
+                domain, recipients = next(self.batches)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self._enqueue(self.route(domain), OutgoingMessage(recipients, self.makeMessage(recipients)))
+
+    def _enqueue(self, destination, message):
+        self.queues.setdefault(destination, collections.deque()).append(message)
+        self.queued += 1
+
+    def _schedule(self):
+        """
+        Abre sesiones para los destinos con mensajes esperando, sin pasar los limites de conexiones.
+        """
+        self._fill()
+        now = self.reactor.seconds()
+        for destination, queue in list(self.queues.items()):
+            if self.hostBackoff.get(destination, 0) > now:
+                continue
+            while (len(queue) > self.sessions[destination] and self.sessions[destination] < self.sessionsPerHost
+                   and self.activeSessions < self.maxSessions):
+                self._connect(destination)
+        if (self.exhausted and not self.queued and not self.delayed and not self.activeSessions
+                and not self.done.called):
+            self.done.callback(self)
+
+    def _connect(self, destination):
+        host, port = destination
+        self.sessions[destination] += 1
+        self.activeSessions += 1
+        self.reactor.connectTCP(host, port, BulkSessionFactory(self, destination))
+
+    def nextMessage(self, session):
+        """
+        Siguiente mensaje para la sesion, o None si ya envio messagesPerSession o no queda nada para su destino.
+        """
+        if session.messagesSent >= self.messagesPerSession:
+            return None
+        self._fill()
+        queue = self.queues.get(session.destination)
+        if not queue:
+            return None
+        self.queued -= 1
+        message = queue.popleft()
+        if not queue:
+            del self.queues[session.destination]
+        return message
+
+    def messageSent(self, destination, message, code, resp, addresses):
+        """
+        Cuenta los destinatarios aceptados y separa los rechazados, cada uno segun el codigo de su RCPT. Los
+        rechazos temporales se reintentan. Sin addresses el servidor rechazo MAIL FROM y el codigo vale para todos.
+        """
+        if not addresses:
+            self._rejected(destination, message, code, resp)
+            return
+        self.messages += 1
+        retry = []
+        for address, addressCode, addressResp in addresses:
+            if addressCode in smtp.SUCCESS and code in smtp.SUCCESS:
+                self.sent += 1
+            elif 400 <= addressCode < 500 or (addressCode in smtp.SUCCESS and 400 <= code < 500):
+                retry.append(address)
+            else:
+                self.failed.append((address, addressCode if addressCode not in smtp.SUCCESS else code,
+                                    addressResp if addressCode not in smtp.SUCCESS else resp))
+        if retry:
+            self._retry(destination, OutgoingMessage(retry, message.data, message.attempts), code, resp)
+
+    def messageFailed(self, destination, message, reason):
+        self._rejected(destination, message, getattr(reason, 'code', -1), str(reason))
+
+    def _rejected(self, destination, message, code, resp):
+        """
+        Ningun destinatario del mensaje lo recibio: con 5xx fallan todos y con 4xx, o sin codigo, se reintenta.
+        """
+        if 500 <= code < 600:
+            for address in message.recipients:
+                self.failed.append((address, code, resp))
+        else:
+            self._retry(destination, message, code, resp)
+
+    def _delay(self, failures):
+        return min(self.retryDelay * 2 ** (failures - 1), self.maxRetryDelay)
+
+    def _retry(self, destination, message, code, resp):
+        """
+        Vuelve a encolar el mensaje despues de la espera que corresponde a su numero de intentos.
+        """
+        message.attempts += 1
+        if message.attempts >= self.maxAttempts:
+            for address in message.recipients:
+                self.failed.append((address, code, resp))
+        else:
+            self.delayed += 1
+            self.reactor.callLater(self._delay(message.attempts), self._requeue, destination, message)
+
+    def _requeue(self, destination, message):
+        self.delayed -= 1
+        self._enqueue(destination, message)
+        self._schedule()
+
+    def sessionEnded(self, destination, failed, reason):
+        self.sessions[destination] -= 1
+        self.activeSessions -= 1
+        if failed:
+            self._hostFailed(destination, reason)
+        self._schedule()
+
+    def connectionFailed(self, destination, reason):
+        self.sessionEnded(destination, True, reason.getErrorMessage())
+
+    def _hostFailed(self, destination, reason):
+        """
+        Deja el destino en espera antes de volver a conectar. Si falla maxAttempts veces seguidas, sus mensajes
+        se dan por fallidos. La cuenta solo se reinicia cuando el destino acepta un mensaje.
+        """
+        self.connectFailures[destination] += 1
+        if self.connectFailures[destination] >= self.maxAttempts:
+            for message in self.queues.pop(destination, ()):
+                self.queued -= 1
+                for address in message.recipients:
+                    self.failed.append((address, -1, reason))
+            return
+        delay = self._delay(self.connectFailures[destination])
+        self.hostBackoff[destination] = self.reactor.seconds() + delay
+        self.reactor.callLater(delay, self._schedule)
+
+    def hostAccepted(self, destination):
+        self.connectFailures.pop(destination, None)
+        self.hostBackoff.pop(destination, None)
+
+
+def textMessage(sender, subject, text):
+    """
+    Retorna la funcion que arma el mensaje de texto de cada lote.
+    """
+    def makeMessage(recipients):
+        msg = MIMEText(text)
+        msg["Subject"] = subject
+        msg["From"] = sender
+        msg["To"] = ", ".join(recipients)
+        return msg.as_bytes()
+    return makeMessage
+
+
+#python3 bulksender.py -f <from> -c <recipients.csv> -s <subject> -m <message> [-h <host>] [-p <port>] [-n <sessions>]
+if __name__ == '__main__':
+    options = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+    sender = options['-f']
+    host = options.get('-h', 'localhost')
+    port = int(options.get('-p', 2525))
+
+    bulk = BulkSender(sender, lambda domain: (host, port), maxSessions=int(options.get('-n', 8)))
+
+    recipients = readRecipients(options['-c'])
+
+    def finished(bulk):
+        print("Read %d addresses: %d duplicated, %d invalid" % (recipients.read, recipients.duplicates,
+                                                               recipients.invalid))
+        print("Sent to %d recipients in %d messages, %d failed" % (bulk.sent, bulk.messages, len(bulk.failed)))
+        for address, code, resp in bulk.failed:
+            print("FAILED:", address, code, resp)
+
+    d = bulk.send(recipients, textMessage(sender, options.get('-s', ''), options.get('-m', '')))
+    d.addCallback(finished)
+    d.addErrback(log.err)
+    d.addBoth(lambda ignored: reactor.stop())
+    reactor.run()
@@ -0,0 +1,48 @@
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+
+
+class DiskPool(object):
+
+    """
+    Pool de hilos acotado para las operaciones bloqueantes del sistema de archivos.
+
+    maxThreads limita los hilos que tocan el disco a la vez y maxPending limita las operaciones en espera;
+    cuando la cola esta llena las nuevas operaciones esperan en un DeferredSemaphore sin bloquear el reactor.
+    Con synchronous=True las operaciones corren en el mismo hilo, util para scripts sin reactor.
+    """
+
+    def __init__(self, maxThreads=8, maxPending=256, synchronous=False):
+        self.maxThreads = maxThreads
+        self.synchronous = synchronous
+        self.semaphore = defer.DeferredSemaphore(maxPending)
+        self.pool = None
+        self.calls = 0
+
+    def _start(self):
+        self.pool = threadpool.ThreadPool(1, self.maxThreads, 'diskio')
+        self.pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Ejecuta la funcion en el pool y retorna un Deferred con su resultado.
+        """
+        self.calls += 1
+        if self.synchronous:
+            return defer.maybeDeferred(function, *args, **kwargs)
+        if self.pool is None:
+            self._start()
+        return self.semaphore.run(threads.deferToThreadPool, reactor, self.pool, function, *args, **kwargs)
+
+    def waiting(self):
+        """
+        Cantidad de operaciones esperando un lugar en la cola.
+        """
+        return len(self.semaphore.waiting)
+
+
+diskPool = DiskPool()
+
+def deferToDisk(function, *args, **kwargs):
+    return diskPool.run(function, *args, **kwargs)
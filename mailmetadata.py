@@ -0,0 +1,652 @@
+import os
+import pickle
+import weakref
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from diskio import deferToDisk
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+COMPACT_MIN_RECORDS = 1024
+
+# Durabilidad de los cambios de flags, expunge y valores simples:
+#   'none'   se escriben al log en grupo, en el pool de disco, y el sistema operativo decide cuando llegan al disco.
+#   'flush'  se escriben en grupo en el pool de disco y cada grupo termina con un fsync del log.
+#   'always' cada cambio se escribe y sincroniza antes de retornar; es el unico modo que bloquea al reactor.
+# Los uids se escriben siempre al asignarse, porque otros procesos los comparten, y solo se sincronizan con
+# 'always'.
+DURABILITY_LEVELS = ('none', 'flush', 'always')
+defaultDurability = 'flush'
+
+# Un grupo de cambios se escribe flushDelay segundos despues del primero, al juntar maxPending cambios,
+# al cerrar el buzon o al terminar la sesion.
+flushDelay = 1.0
+maxPending = 512
+
+openStores = weakref.WeakSet()
+
+def flushAll():
+    """
+    Escribe los cambios pendientes de todos los buzones abiertos; se llama antes de apagar el reactor, que
+    espera al Deferred retornado.
+    """
+    return defer.DeferredList([store.flush() for store in list(openStores)])
+
+
+def popCount(bits):
+    return bin(bits).count('1')
+
+
+def uidMask(uids):
+    """
+    Mapa de bits con un bit prendido por cada uid.
+    """
+    uids = list(uids)
+    if not uids:
+        return bytearray()
+    mask = bytearray(max(uids) // 8 + 1)
+    for uid in uids:
+        mask[uid >> 3] |= 1 << (uid & 7)
+    return mask
+
+
+def maskUIDs(bits):
+    """
+    Uids de los bits prendidos, en orden.
+    """
+    uids = []
+    for index, byte in enumerate(bits):
+        if byte:
+            for bit in range(8):
+                if byte >> bit & 1:
+                    uids.append(index * 8 + bit)
+    return uids
+
+
+def testBit(bits, uid):
+    index = uid >> 3
+    return index < len(bits) and bool(bits[index] >> (uid & 7) & 1)
+
+
+def setBit(bits, uid, value):
+    index = uid >> 3
+    if value:
+        if index >= len(bits):
+            bits.extend(bytes(index - len(bits) + 1))
+        bits[index] |= 1 << (uid & 7)
+    elif index < len(bits):
+        bits[index] &= ~(1 << (uid & 7)) & 0xff
+
+
+def combine(bits, mask, operation):
+    """
+    Aplica una operacion de bits entre dos mapas de una sola vez, pasandolos por enteros de Python.
+    """
+    length = max(len(bits), len(mask))
+    result = operation(int.from_bytes(bits, 'little'), int.from_bytes(mask, 'little'))
+    return bytearray(result.to_bytes(length, 'little'))
+
+
+# Con menos uids que esto un STORE cambia bit por bit; con mas combina los mapas completos.
+BULK_THRESHOLD = 64
+
+
+class FlagTable(object):
+
+    """
+    Flags de un buzon como un mapa de bits por flag, con un bit por uid, en lugar de una lista por mensaje.
+    present marca los uids que tienen una entrada, aunque este vacia.
+
+    Se usa como el diccionario uid -> lista de flags que reemplaza (get, [], pop, in, len, items) y se guarda en
+    la foto como ese mismo diccionario, por lo que el formato en disco no cambia. Los flags de sistema se
+    comparan sin importar mayusculas.
+    """
+
+    def __init__(self, flags=None):
+        self.bits = {}
+        self.names = {}
+        byName = {}
+        for uid, messageFlags in (flags or {}).items():
+            for flag in messageFlags:
+                byName.setdefault(self._name(flag), []).append(uid)
+        self.present = uidMask((flags or {}).keys())
+        for name, uids in byName.items():
+            self.bits[name] = uidMask(uids)
+
+    def _name(self, flag):
+        name = self.names.get(flag.lower())
+        if name is None:
+            name = self.names[flag.lower()] = '\\' + flag[1:].capitalize() if flag.startswith('\\') else flag
+            self.bits[name] = bytearray()
+        return name
+
+    def __reduce__(self):
+        return (dict, (dict(self.items()),))
+
+    def __contains__(self, uid):
+        return testBit(self.present, uid)
+
+    def __len__(self):
+        return popCount(int.from_bytes(self.present, 'little'))
+
+    def get(self, uid, default=None):
+        if not testBit(self.present, uid):
+            return default
+        return [name for name, bits in self.bits.items() if testBit(bits, uid)]
+
+    def __getitem__(self, uid):
+        flags = self.get(uid)
+        if flags is None:
+            raise KeyError(uid)
+        return flags
+
+    def __setitem__(self, uid, flags):
+        self.update([uid], flags, 0)
+
+    def pop(self, uid, default=None):
+        flags = self.get(uid, default)
+        for bits in self.bits.values():
+            setBit(bits, uid, False)
+        setBit(self.present, uid, False)
+        return flags
+
+    def items(self):
+        return [(uid, self.get(uid)) for uid in maskUIDs(self.present)]
+
+    def update(self, uids, flags, mode):
+        """
+        Cambia los flags de varios mensajes: mode 0 los reemplaza, 1 los agrega y -1 los quita. Con muchos
+        uids cada flag cambia con una sola operacion sobre su mapa completo.
+        """
+        names = set(self._name(flag) for flag in flags)
+        if len(uids) < BULK_THRESHOLD:
+            for uid in uids:
+                for name, bits in self.bits.items():
+                    if name in names:
+                        setBit(bits, uid, mode != -1)
+                    elif mode == 0:
+                        setBit(bits, uid, False)
+                setBit(self.present, uid, True)
+            return
+        mask = uidMask(uids)
+        for name in self.bits:
+            if (name in names and mode == -1) or (name not in names and mode == 0):
+                self.bits[name] = combine(self.bits[name], mask, lambda bits, mask: bits & ~mask)
+            elif name in names:
+                self.bits[name] = combine(self.bits[name], mask, lambda bits, mask: bits | mask)
+        self.present = combine(self.present, mask, lambda bits, mask: bits | mask)
+
+    def has(self, uid, flag):
+        name = self.names.get(flag.lower())
+        return name is not None and testBit(self.bits[name], uid)
+
+    def withFlag(self, flag):
+        """
+        Uids que tienen el flag, en orden.
+        """
+        name = self.names.get(flag.lower())
+        if name is None:
+            return []
+        return maskUIDs(self.bits[name])
+
+    def count(self, flag, uids=None):
+        """
+        Cantidad de mensajes con el flag; con uids, solo entre esos mensajes.
+        """
+        name = self.names.get(flag.lower())
+        if name is None:
+            return 0
+        bits = int.from_bytes(self.bits[name], 'little')
+        if uids is not None:
+            bits &= int.from_bytes(uidMask(uids), 'little')
+        return popCount(bits)
+
+
+def readRecords(file):
+    """
+    Lee los registros pickle que siguen en el archivo hasta el final o hasta un registro incompleto.
+    """
+    records = []
+    while True:
+        try:
+            records.append(pickle.load(file))
+        except (EOFError, pickle.UnpicklingError, ValueError, IndexError):
+            return records
+
+
+class MetadataStore(object):
+    """
+    Metadata IMAP de un buzon (uids, flags, uidnext, uidvalidity) guardado como una foto en pickle
+    mas un log de solo-agregar con los cambios posteriores.
+
+    Cada cambio es un registro pickle agregado al log, por lo que asignar un uid o cambiar flags
+    cuesta una escritura O(1). Cuando el log crece al doble del buzon se compacta en una nueva foto.
+    Los archivos .imap-metadata.pickle existentes se usan como foto sin ninguna conversion.
+
+    Los flags se guardan en memoria en una FlagTable; seenCount cuenta los bits de \\Seen, por lo que STATUS
+    no recorre los mensajes.
+
+    Varios procesos pueden compartir el mismo buzon: cada escritura toma un flock sobre el log y antes
+    de escribir aplica los registros que otros procesos agregaron desde la ultima lectura.
+
+    La foto nueva se escribe y sincroniza en el pool de disco; solo el rename final y el truncado del log
+    corren en el reactor. Los registros que llegan al log mientras se escribe la foto se copian al final
+    de la foto antes del rename y se aplican al cargarla.
+
+    Los cambios de flags se aplican en memoria al instante y se acumulan en pending; flush los escribe en el
+    pool de disco con un solo write bajo el lock y, segun la durabilidad, un solo fsync despues de soltarlo,
+    por lo que el reactor no espera al disco. El grupo que se esta escribiendo queda en writing hasta que
+    llega al log. Al leer los registros de otros procesos writing y pending se vuelven a aplicar encima, en
+    el mismo orden en que quedaran en el log. flushes, writes y fsyncs cuentan las escrituras al disco.
+    """
+
+    def __init__(self, path, durability=None, clock=None):
+        if durability is None:
+            durability = defaultDurability
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError('Unknown durability: %r' % (durability,))
+        self.durability = durability
+        self.clock = clock or reactor
+        self.snapshotFile = os.path.join(path, '.imap-metadata.pickle')
+        self.logFile = os.path.join(path, '.imap-metadata.log')
+        self.logFd = os.open(self.logFile, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+        self.compacting = None
+        self.pending = []
+        self.writing = None
+        self.flushWaiters = []
+        self.flushCall = None
+        self.flushes = 0
+        self.writes = 0
+        self.fsyncs = 0
+        openStores.add(self)
+        self._lock(True)
+        try:
+            self._load(truncateTornRecord=True)
+        finally:
+            self._unlock()
+
+    def _lock(self, exclusive):
+        if fcntl is not None:
+            fcntl.flock(self.logFd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def _unlock(self):
+        if fcntl is not None:
+            fcntl.flock(self.logFd, fcntl.LOCK_UN)
+
+    def _snapshotId(self):
+        try:
+            info = os.stat(self.snapshotFile)
+        except FileNotFoundError:
+            return None
+        return (info.st_ino, info.st_mtime_ns)
+
+    def _load(self, truncateTornRecord=False):
+        """
+        Lee la foto y aplica el log completo. Se llama con el lock tomado.
+        """
+        data = {}
+        records = []
+        self.snapshotId = self._snapshotId()
+        if self.snapshotId is not None:
+            with open(self.snapshotFile, 'rb') as snapshot:
+                data = pickle.load(snapshot)
+                records = readRecords(snapshot)
+
+        data['flags'] = FlagTable(data.get('flags'))
+        data.setdefault('uids', {})
+        data.setdefault('uidnext', 1)
+
+        if hasattr(self, 'data'):
+            self.data.clear()
+            self.data.update(data)
+        else:
+            self.data = data
+        for record in records:
+            self._apply(record)
+        self.logRecords = 0
+        self.logOffset = 0
+        self._replayLog(truncateTornRecord)
+
+    def _replayLog(self, truncateTornRecord=False):
+        """
+        Aplica los registros del log desde la ultima posicion leida. Un registro incompleto al final,
+        producto de una caida a mitad de escritura, se descarta truncando el log.
+        """
+        with os.fdopen(os.dup(self.logFd), 'rb') as log:
+            log.seek(self.logOffset)
+            while True:
+                try:
+                    record = pickle.load(log)
+                except (EOFError, pickle.UnpicklingError, ValueError, IndexError):
+                    break
+                self._apply(record)
+                self.logRecords += 1
+                self.logOffset = log.tell()
+        if truncateTornRecord and os.fstat(self.logFd).st_size > self.logOffset:
+            os.ftruncate(self.logFd, self.logOffset)
+
+    def _catchUp(self):
+        """
+        Aplica los cambios hechos por otros procesos. Si otro proceso compacto el log se vuelve a leer
+        la foto completa. Se llama con el lock tomado.
+        """
+        if self._snapshotId() != self.snapshotId or os.fstat(self.logFd).st_size < self.logOffset:
+            self._load()
+        elif os.fstat(self.logFd).st_size > self.logOffset:
+            self._replayLog()
+        else:
+            return
+        for record in (self.writing or []) + self.pending:
+            self._apply(record)
+
+    def refresh(self):
+        """
+        Incorpora los cambios de otros procesos; sin cambios solo cuesta dos stat.
+        """
+        if self._snapshotId() == self.snapshotId and os.fstat(self.logFd).st_size == self.logOffset:
+            return
+        self._lock(False)
+        try:
+            self._catchUp()
+        finally:
+            self._unlock()
+        self._compactIfLarge()
+
+    def _apply(self, record):
+        """
+        Aplica un registro a los datos en memoria. Los registros guardan valores absolutos para
+        que aplicarlos dos veces no cambie el resultado.
+        """
+        kind = record[0]
+        if kind == 'uid':
+            filename, uid = record[1:]
+            self.data['uids'][filename] = uid
+            self.data['uidnext'] = max(self.data['uidnext'], uid + 1)
+        elif kind == 'flags':
+            uid, flags = record[1:]
+            self.data['flags'][uid] = flags
+        elif kind == 'store':
+            uids, flags, mode = record[1:]
+            self.data['flags'].update(uids, flags, mode)
+        elif kind == 'expunge':
+            filename = record[1]
+            uid = self.data['uids'].pop(filename, None)
+            if uid is not None:
+                self.data['flags'].pop(uid)
+        elif kind == 'forget':
+            assigned = set(self.data['uids'].values())
+            for uid in record[1]:
+                if uid not in assigned:
+                    self.data['flags'].pop(uid)
+        elif kind == 'set':
+            key, value = record[1:]
+            self.data[key] = value
+
+    @property
+    def seenCount(self):
+        return self.data['flags'].count('\\Seen')
+
+    def _write(self, records):
+        """
+        Aplica los registros y los agrega al log con una sola escritura, sin esperar al grupo pendiente;
+        solo con durabilidad 'always' le sigue un fsync. Se llama con el lock tomado.
+        """
+        for record in records:
+            self._apply(record)
+        data = b''.join(pickle.dumps(record, pickle.HIGHEST_PROTOCOL) for record in records)
+        self.logOffset += os.write(self.logFd, data)
+        self.writes += 1
+        self.logRecords += len(records)
+        if self.durability == 'always':
+            os.fsync(self.logFd)
+            self.fsyncs += 1
+        self._compactIfLarge()
+
+    def _compactIfLarge(self):
+        """
+        Compacta cuando el log pasa de COMPACT_MIN_RECORDS registros y del doble de mensajes del buzon.
+        """
+        if self.logFd is not None and self.logRecords > max(COMPACT_MIN_RECORDS, 2 * len(self.data['uids'])):
+            self._startCompaction()
+
+    def _append(self, record):
+        """
+        Aplica un cambio en memoria y lo deja pendiente; con durabilidad 'always' lo escribe de inmediato.
+        """
+        if self.durability == 'always':
+            self._lock(True)
+            try:
+                self._catchUp()
+                self._write([record])
+            finally:
+                self._unlock()
+            return
+        self._apply(record)
+        self.pending.append(record)
+        if len(self.pending) >= maxPending:
+            self.flush()
+        elif self.flushCall is None or not self.flushCall.active():
+            self.flushCall = self.clock.callLater(flushDelay, self.flush)
+
+    def flush(self):
+        """
+        Escribe los cambios pendientes en el pool de disco. Retorna un Deferred que se dispara cuando llegaron
+        al log; si ya hay un grupo escribiendose, los nuevos van en el siguiente.
+        """
+        if self.flushCall is not None and self.flushCall.active():
+            self.flushCall.cancel()
+        self.flushCall = None
+        if self.writing is not None:
+            waiter = defer.Deferred()
+            self.flushWaiters.append(waiter)
+            return waiter
+        if not self.pending:
+            return defer.succeed(None)
+        self.writing, self.pending = self.pending, []
+        data = b''.join(pickle.dumps(record, pickle.HIGHEST_PROTOCOL) for record in self.writing)
+        d = deferToDisk(self._writeGroup, data, self.durability == 'flush')
+        d.addCallbacks(self._groupWritten, self._groupFailed)
+        d.addBoth(self._groupEnded)
+        return d
+
+    def _writeGroup(self, data, sync):
+        """
+        Corre en el pool de disco con su propio descriptor, para que el flock excluya tambien al reactor. El
+        lock se suelta antes del fsync: los demas solo esperan el write. Retorna si sincronizo, la foto vigente
+        y el rango del log donde quedo el grupo.
+        """
+        fd = os.open(self.logFile, os.O_WRONLY | os.O_APPEND)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                snapshotId = self._snapshotId()
+                start = os.fstat(fd).st_size
+                end = start + os.write(fd, data)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            if sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        return sync, snapshotId, start, end
+
+    def _groupWritten(self, result):
+        """
+        Si el grupo quedo justo donde termino la ultima lectura, sus registros ya aplicados cuentan como leidos;
+        si antes hay registros de otros procesos, el proximo _catchUp lee ambos del log. El grupo cuenta para
+        compactar igual que los registros escritos por _write.
+        """
+        synced, snapshotId, start, end = result
+        if snapshotId == self.snapshotId and start == self.logOffset:
+            self.logOffset = end
+            self.logRecords += len(self.writing)
+        self.writing = None
+        self.flushes += 1
+        self.writes += 1
+        if synced:
+            self.fsyncs += 1
+        self._compactIfLarge()
+
+    def _groupFailed(self, reason):
+        log.err(reason, 'Writing %s' % (self.logFile,))
+        self.pending[:0] = self.writing
+        self.writing = None
+
+    def _groupEnded(self, result):
+        waiters, self.flushWaiters = self.flushWaiters, []
+        if waiters:
+            d = self.flush()
+            for waiter in waiters:
+                d.addBoth(lambda ignored, waiter=waiter: waiter.callback(None))
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        """
+        Cambia un valor simple del metadata, como 'subscribed' o 'uidvalidity'.
+        """
+        self._append(('set', key, value))
+
+    def setDefault(self, key, value):
+        """
+        Guarda el valor solo si ningun proceso lo guardo antes, y retorna el valor vigente.
+        """
+        self._lock(True)
+        try:
+            self._catchUp()
+            if key not in self.data:
+                self._write([('set', key, value)])
+            return self.data[key]
+        finally:
+            self._unlock()
+
+    def assignUID(self, filename):
+        """
+        Asigna el siguiente uid disponible al archivo y lo retorna. Si otro proceso ya le asigno uno,
+        retorna ese.
+        """
+        self._lock(True)
+        try:
+            self._catchUp()
+            uid = self.data['uids'].get(filename)
+            if uid is None:
+                uid = self.data['uidnext']
+                self._write([('uid', filename, uid)])
+            return uid
+        finally:
+            self._unlock()
+
+    def setFlags(self, uid, flags):
+        self._append(('flags', uid, list(flags)))
+
+    def storeFlags(self, uids, flags, mode):
+        """
+        Cambia los flags de varios mensajes con un solo registro: mode 0 los reemplaza, 1 los agrega y -1 los quita.
+        """
+        self._append(('store', list(uids), list(flags), mode))
+
+    def expunge(self, filename):
+        """
+        Elimina el uid y los flags de un mensaje borrado.
+        """
+        self._append(('expunge', filename))
+
+    def forgetOrphanFlags(self):
+        """
+        Borra los flags de uids que no tienen mensaje, por ejemplo los que otro proceso cambio mientras el
+        mensaje se expurgaba, y retorna cuantos borro. Despues seenCount vuelve a coincidir con los mensajes.
+        """
+        assigned = set(self.data['uids'].values())
+        orphans = [uid for uid, flags in self.data['flags'].items() if uid not in assigned]
+        if orphans:
+            self._append(('forget', orphans))
+        return len(orphans)
+
+    def _startCompaction(self):
+        """
+        Copia los datos y escribe la foto en el pool de disco. Retorna un Deferred que se dispara al terminar.
+        """
+        if self.compacting is not None:
+            return self.compacting
+        data = pickle.dumps(self.data, pickle.HIGHEST_PROTOCOL)
+        # Con el pool sincronico la compactacion termina antes de retornar y _compactionEnded ya limpio
+        # self.compacting, por lo que se retorna la referencia local.
+        d = self.compacting = deferToDisk(self._writeSnapshot, data)
+        d.addCallback(self._commitSnapshot, self.snapshotId, self.logOffset)
+        d.addErrback(log.err)
+        d.addBoth(self._compactionEnded)
+        return d
+
+    def _writeSnapshot(self, data):
+        tmpFile = '%s.%d.tmp' % (self.snapshotFile, os.getpid())
+        with open(tmpFile, 'wb') as snapshot:
+            snapshot.write(data)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        self.fsyncs += 1
+        return tmpFile
+
+    def _commitSnapshot(self, tmpFile, snapshotId, logOffset):
+        """
+        Reemplaza la foto y vacia el log. Los registros agregados despues de copiar los datos se pasan al
+        final de la foto. Si otro proceso compacto mientras tanto la foto se descarta.
+        """
+        if self.logFd is None:
+            os.remove(tmpFile)
+            return
+        self._lock(True)
+        try:
+            if self._snapshotId() != snapshotId:
+                os.remove(tmpFile)
+                return
+            self._catchUp()
+            tail = os.pread(self.logFd, self.logOffset - logOffset, logOffset)
+            if tail:
+                with open(tmpFile, 'ab') as snapshot:
+                    snapshot.write(tail)
+            os.replace(tmpFile, self.snapshotFile)
+            os.ftruncate(self.logFd, 0)
+            self.snapshotId = self._snapshotId()
+            self.logOffset = 0
+            self.logRecords = 0
+        finally:
+            self._unlock()
+
+    def _compactionEnded(self, result):
+        self.compacting = None
+        return result
+
+    def compact(self):
+        """
+        Escribe una foto nueva. Los cambios pendientes ya estan aplicados en los datos copiados, y volver a
+        aplicarlos cuando lleguen al log no cambia nada.
+        """
+        self._lock(True)
+        try:
+            self._catchUp()
+        finally:
+            self._unlock()
+        return self._startCompaction()
+
+    def stats(self):
+        return {'pending': len(self.pending), 'flushes': self.flushes, 'writes': self.writes, 'fsyncs': self.fsyncs}
+
+    def close(self):
+        """
+        Escribe los cambios pendientes y cierra el log; retorna el Deferred de la ultima escritura.
+        """
+        if self.logFd is None:
+            return defer.succeed(None)
+        d = self.flush()
+        openStores.discard(self)
+        logFd, self.logFd = self.logFd, None
+        d.addBoth(lambda ignored: os.close(logFd))
+        return d
@@ -0,0 +1,187 @@
+import email.parser
+import re
+
+from zope.interface import implementer
+
+from twisted.mail import imap4
+
+# Fin del bloque de encabezados: la primera linea vacia.
+HEADER_END = re.compile(br'\r?\n\r?\n')
+
+
+def headerBlockEnd(data, start, end):
+    """
+    Offset donde empieza el cuerpo de la parte que empieza en start.
+    """
+    if data[start:start + 2] == b'\r\n':
+        return start + 2
+    if data[start:start + 1] == b'\n':
+        return start + 1
+    match = HEADER_END.search(data, start, end)
+    if match is None:
+        return end
+    return match.end()
+
+
+def parseHeaderBlock(headerData):
+    return email.parser.HeaderParser().parsestr(headerData.decode('utf-8', 'replace'))
+
+
+def parsePart(data, start, end, defaultType='text/plain'):
+    """
+    Nodo de la estructura MIME de la parte data[start:end]: tipo, offsets de encabezados, cuerpo y fin, y
+    las partes internas de un multipart o el mensaje de un message/rfc822.
+    """
+    bodyStart = headerBlockEnd(data, start, end)
+    headers = parseHeaderBlock(data[start:bodyStart])
+    if headers.get('content-type'):
+        contentType = headers.get_content_type()
+    else:
+        contentType = defaultType
+    node = {'type': contentType, 'headerStart': start, 'bodyStart': bodyStart, 'end': end, 'parts': []}
+
+    if contentType.startswith('multipart/'):
+        boundary = headers.get_boundary()
+        if boundary:
+            childType = 'message/rfc822' if contentType == 'multipart/digest' else 'text/plain'
+            node['parts'] = [parsePart(data, partStart, partEnd, childType)
+                             for partStart, partEnd in splitMultipart(data, bodyStart, end, boundary)]
+    elif contentType == 'message/rfc822':
+        node['parts'] = [parsePart(data, bodyStart, end)]
+    return node
+
+
+def splitMultipart(data, start, end, boundary):
+    """
+    Rangos de las partes de un cuerpo multipart. El salto de linea antes de cada delimitador pertenece al
+    delimitador, no a la parte.
+    """
+    delimiter = re.compile(br'(?m)^--' + re.escape(boundary.encode('utf-8', 'replace')) + br'(--)?[ \t]*\r?$')
+    ranges = []
+    partStart = None
+    position = start
+    while True:
+        match = delimiter.search(data, position, end)
+        if match is None:
+            break
+        if partStart is not None:
+            partEnd = match.start()
+            if partEnd - partStart >= 2 and data[partEnd - 2:partEnd] == b'\r\n':
+                partEnd -= 2
+            elif partEnd > partStart and data[partEnd - 1:partEnd] == b'\n':
+                partEnd -= 1
+            ranges.append((partStart, max(partStart, partEnd)))
+        if match.group(1):
+            return ranges
+        lineEnd = data.find(b'\n', match.end(), end)
+        if lineEnd < 0:
+            return ranges
+        partStart = position = lineEnd + 1
+    if partStart is not None and partStart < end:
+        # Falta el delimitador final: la ultima parte llega hasta el final del cuerpo.
+        ranges.append((partStart, end))
+    return ranges
+
+
+class BufferSlice(object):
+
+    """
+    Archivo de solo lectura sobre data[start:end] que no copia la parte: con data mapeado con mmap, contar las
+    lineas de un cuerpo grande solo trae a memoria las paginas que va recorriendo.
+    """
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.position = start
+        self.end = end
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.end - self.position:
+            size = self.end - self.position
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def readline(self, size=-1):
+        lineEnd = self.data.find(b'\n', self.position, self.end)
+        lineEnd = self.end if lineEnd < 0 else lineEnd + 1
+        if size is not None and 0 <= size < lineEnd - self.position:
+            lineEnd = self.position + size
+        return self.read(lineEnd - self.position)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+
+@implementer(imap4.IMessagePart)
+class StructurePart(object):
+
+    """
+    Parte de un mensaje descrita por un nodo de parsePart. Esta clase lee de los bytes del mensaje en memoria;
+    IMAPserver.MessagePart lee los mismos rangos del archivo.
+    """
+
+    # Sin Content-Type una parte informa el tipo por omision del RFC 2046 (text/plain, o message/rfc822 dentro
+    # de un multipart/digest), para que BODYSTRUCTURE no quede con NIL.
+    defaultContentType = True
+
+    def __init__(self, node, data):
+        self.node = node
+        self.data = data
+        self._headers = None
+
+    def headerData(self):
+        return self.data[self.node['headerStart']:self.node['bodyStart']]
+
+    def getBodyFile(self):
+        return BufferSlice(self.data, self.node['bodyStart'], self.node['end'])
+
+    def _subPart(self, node):
+        return StructurePart(node, self.data)
+
+    def getHeaders(self, negate, *names):
+        if self._headers is None:
+            self._headers = parseHeaderBlock(self.headerData())
+        names = [name.decode('utf-8') if isinstance(name, bytes) else name for name in names]
+        headers = {}
+        if negate:
+            excluded = set(name.lower() for name in names)
+            for name in self._headers.keys():
+                if name.lower() not in excluded:
+                    headers[name.lower()] = self._headers.get(name, '')
+        else:
+            for name in names:
+                if name in self._headers:
+                    headers[name.lower()] = self._headers.get(name, '')
+                elif name.lower() == 'content-type' and self.defaultContentType:
+                    headers['content-type'] = self.node['type']
+        return headers
+
+    def getSize(self):
+        return self.node['end'] - self.node['bodyStart']
+
+    def isMultipart(self):
+        return self.node['type'].startswith('multipart/')
+
+    def getSubPart(self, part):
+        return self._subPart(self.node['parts'][part])
+
+
+def messageStructure(data):
+    """
+    Registro compacto de un mensaje: el arbol de partes con sus offsets, y ENVELOPE, BODY y BODYSTRUCTURE ya
+    calculados. Se arma una sola vez, al entregar el mensaje. data puede ser un mmap del archivo: solo se
+    copian los bloques de encabezados y las lineas de las partes de texto.
+    """
+    node = parsePart(data, 0, len(data))
+    message = StructurePart(node, data)
+    return {'parts': node,
+            'envelope': imap4.getEnvelope(message),
+            'body': imap4.getBodyStructure(message),
+            'bodystructure': imap4.getBodyStructure(message, True)}
@@ -0,0 +1,416 @@
+import email.parser
+import os
+import shutil
+import socket
+import sqlite3
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from zope.interface import implementer
+
+from twisted.enterprise import adbapi
+from twisted.internet import defer
+from twisted.python import log
+
+from diskio import deferToDisk
+
+try:
+    from twisted.news import database
+except ImportError:
+    # twisted.news no existe en las versiones nuevas de Twisted; el gateway del servidor SMTP solo escribe
+    # en la base y no lo necesita.
+    database = None
+
+# Numero de articulo mas alto aceptado cuando un rango no tiene limite superior.
+MAX_ARTICLE = 2 ** 63 - 1
+
+# Mismos campos y orden que twisted.news.database.OVERVIEW_FMT.
+OVERVIEW_FMT = ['Subject', 'From', 'Date', 'Message-ID', 'References', 'Bytes', 'Lines', 'Xref']
+
+SCHEMA = """
+    PRAGMA journal_mode=WAL;
+
+    CREATE TABLE IF NOT EXISTS groups (
+        name        TEXT PRIMARY KEY,
+        flags       TEXT NOT NULL,
+        low         INTEGER NOT NULL DEFAULT 1,
+        high        INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        name        TEXT PRIMARY KEY
+    );
+
+    CREATE TABLE IF NOT EXISTS articles (
+        id          INTEGER PRIMARY KEY,
+        messageId   TEXT NOT NULL UNIQUE,
+        headers     TEXT NOT NULL,
+        body        TEXT NOT NULL,
+        overview    TEXT NOT NULL,
+        path        TEXT,
+        bodyOffset  INTEGER
+    );
+
+    CREATE TABLE IF NOT EXISTS postings (
+        groupName   TEXT NOT NULL,
+        number      INTEGER NOT NULL,
+        articleId   INTEGER NOT NULL,
+        PRIMARY KEY (groupName, number)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS postingsByArticle ON postings (articleId);
+"""
+
+
+def openDatabase(dbFile):
+    """
+    Abre la base creando las tablas que falten. Las bases anteriores al gateway reciben las columnas
+    path y bodyOffset.
+    """
+    connection = sqlite3.connect(dbFile, timeout=30)
+    connection.text_factory = str
+    connection.executescript(SCHEMA)
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(articles)')]
+    if 'path' not in columns:
+        connection.execute('ALTER TABLE articles ADD COLUMN path TEXT')
+        connection.execute('ALTER TABLE articles ADD COLUMN bodyOffset INTEGER')
+        connection.commit()
+    return connection
+
+
+def overviewLine(values):
+    """
+    Campos de OVERVIEW_FMT separados por tabs, sin tabs ni saltos de linea dentro de cada campo.
+    """
+    fields = []
+    for value in values:
+        fields.append(value.replace('\r\n', ' ').replace('\n', ' ').replace('\t', ' '))
+    return '\t'.join(fields)
+
+
+def insertArticle(transaction, messageId, headers, body, overview, path=None, bodyOffset=None):
+    """
+    Guarda el articulo y retorna su id. Un articulo con un Message-ID ya guardado retorna el id existente.
+    Los articulos del gateway tienen el cuerpo vacio y apuntan al archivo con path y bodyOffset.
+    """
+    row = transaction.execute('SELECT id FROM articles WHERE messageId = ?', (messageId,)).fetchone()
+    if row is not None:
+        return row[0]
+    cursor = transaction.execute(
+        'INSERT INTO articles (messageId, headers, body, overview, path, bodyOffset) VALUES (?, ?, ?, ?, ?, ?)',
+        (messageId, headers, body, overview, path, bodyOffset))
+    return cursor.lastrowid
+
+
+def addPostings(transaction, articleId, xref):
+    """
+    Agrega el articulo a cada (grupo, numero) y sube la marca de cada grupo.
+    """
+    for group, number in xref:
+        transaction.execute('INSERT INTO postings (groupName, number, articleId) VALUES (?, ?, ?)',
+                            (group, number, articleId))
+        transaction.execute('UPDATE groups SET high = ? WHERE name = ?', (number, group))
+
+
+def nextNumbers(transaction, groups):
+    """
+    Retorna (grupo, numero) con el siguiente numero de cada grupo existente.
+    """
+    xref = []
+    for group in groups:
+        row = transaction.execute('SELECT high FROM groups WHERE name = ?', (group,)).fetchone()
+        if row is not None:
+            xref.append((group, row[0] + 1))
+    return xref
+
+
+def xrefHeader(xref):
+    return '%s %s' % (socket.gethostname().split()[0], ' '.join(['%s:%d' % (group, number) for group, number in xref]))
+
+
+def readSpooledBody(path, bodyOffset):
+    """
+    Lee el cuerpo de un articulo del gateway desde su archivo, con fin de linea CRLF y las lineas que empiezan
+    con punto duplicadas, como se envian por NNTP.
+    """
+    with open(path, 'rb') as spooled:
+        spooled.seek(bodyOffset)
+        data = spooled.read()
+    if not isinstance(data, str):
+        data = data.decode('utf-8', 'replace')
+    lines = data.replace('\r\n', '\n').split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    return ''.join([('.' + line if line.startswith('.') else line) + '\r\n' for line in lines])
+
+
+class NewsStore(object):
+
+    """
+    Almacenamiento de noticias en un solo archivo sqlite, en reemplazo de NewsShelf.
+
+    Los articulos se guardan una vez aunque esten en varios grupos; la tabla postings relaciona cada
+    (grupo, numero) con su articulo y es la llave primaria de los rangos de XOVER, XHDR y LISTGROUP. La linea
+    de overview se calcula al publicar, y los Message-ID tienen su propio indice, por lo que ninguna consulta
+    recorre el grupo completo. Las consultas corren en un ConnectionPool de adbapi con una sola conexion,
+    ya que sqlite admite un solo escritor.
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            os.mkdir(path)
+
+        self.dbFile = os.path.join(path, 'news.sqlite')
+
+        openDatabase(self.dbFile).close()
+
+        self.dbpool = adbapi.ConnectionPool('sqlite3', self.dbFile, check_same_thread=False,
+                                            cp_min=1, cp_max=1, cp_openfun=self._openConnection)
+
+    def _openConnection(self, connection):
+        connection.text_factory = str
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+    def addGroup(self, name, flags):
+        return self.dbpool.runOperation('INSERT OR IGNORE INTO groups (name, flags) VALUES (?, ?)',
+                                        (name, ''.join(flags)))
+
+    def addSubscription(self, name):
+        return self.dbpool.runOperation('INSERT OR IGNORE INTO subscriptions (name) VALUES (?)', (name,))
+
+    def importShelf(self, shelf):
+        """
+        Copia los grupos y articulos de un NewsShelf existente, manteniendo los numeros de cada grupo.
+        Solo se usa la primera vez, cuando la base todavia no tiene articulos.
+        """
+        connection = openDatabase(self.dbFile)
+        try:
+            if connection.execute('SELECT 1 FROM articles LIMIT 1').fetchone() is not None:
+                return
+            for group in shelf.dbm['groups'].values():
+                connection.execute('INSERT OR IGNORE INTO groups (name, flags) VALUES (?, ?)',
+                                   (group.name, ''.join(group.flags)))
+                for number, article in group.articles.items():
+                    articleId = insertArticle(connection, article.getHeader('Message-ID'), article.textHeaders(),
+                                              article.body, overviewLine(article.overview()))
+                    connection.execute('INSERT OR IGNORE INTO postings (groupName, number, articleId) '
+                                       'VALUES (?, ?, ?)', (group.name, number, articleId))
+                connection.execute('UPDATE groups SET high = ? WHERE name = ?', (group.maxArticle, group.name))
+            for name in shelf.dbm['subscriptions']:
+                connection.execute('INSERT OR IGNORE INTO subscriptions (name) VALUES (?)', (name,))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def listRequest(self):
+        return self.dbpool.runQuery('SELECT name, high, low, flags FROM groups ORDER BY name')
+
+    def subscriptionRequest(self):
+        d = self.dbpool.runQuery('SELECT name FROM subscriptions ORDER BY name')
+        return d.addCallback(lambda rows: [name for name, in rows])
+
+    def postRequest(self, message):
+        cleave = message.find('\r\n\r\n')
+        headers, article = message[:cleave], message[cleave + 4:]
+        return self.dbpool.runInteraction(self._post, database.Article(headers, article))
+
+    def _post(self, transaction, article):
+        groups = article.getHeader('Newsgroups').split()
+        xref = nextNumbers(transaction, groups)
+
+        if not xref:
+            raise database.NewsServerError("No groups carried: " + ' '.join(groups))
+
+        transaction.execute('SELECT 1 FROM articles WHERE messageId = ?', (article.getHeader('Message-ID'),))
+        if transaction.fetchone() is not None:
+            raise database.NewsServerError("Duplicate article: " + article.getHeader('Message-ID'))
+
+        article.putHeader('Xref', xrefHeader(xref))
+        articleId = insertArticle(transaction, article.getHeader('Message-ID'), article.textHeaders(),
+                                  article.body, overviewLine(article.overview()))
+        addPostings(transaction, articleId, xref)
+
+    def overviewRequest(self):
+        return defer.succeed(OVERVIEW_FMT)
+
+    def xoverRequest(self, group, low, high):
+        d = self.dbpool.runQuery(
+            'SELECT postings.number, articles.overview FROM postings JOIN articles ON articles.id = postings.articleId '
+            'WHERE postings.groupName = ? AND postings.number BETWEEN ? AND ? ORDER BY postings.number',
+            (group, low or 0, MAX_ARTICLE if high is None else high))
+        return d.addCallback(lambda rows: [[str(number)] + overview.split('\t') for number, overview in rows])
+
+    def xhdrRequest(self, group, low, high, header):
+        """
+        Los encabezados del overview salen de la linea precalculada; los demas se leen de los encabezados guardados.
+        """
+        fields = [name.lower() for name in OVERVIEW_FMT]
+        column = 'overview' if header.lower() in fields else 'headers'
+        d = self.dbpool.runQuery(
+            'SELECT postings.number, articles.%s FROM postings JOIN articles ON articles.id = postings.articleId '
+            'WHERE postings.groupName = ? AND postings.number BETWEEN ? AND ? ORDER BY postings.number' % (column,),
+            (group, low or 0, MAX_ARTICLE if high is None else high))
+
+        def headerValues(rows):
+            if column == 'overview':
+                index = fields.index(header.lower())
+                return [(number, value.split('\t')[index]) for number, value in rows]
+            return [(number, database.Article(headers.rstrip('\r\n'), '').getHeader(header)) for number, headers in rows]
+
+        return d.addCallback(headerValues)
+
+    def listGroupRequest(self, group):
+        return self.dbpool.runInteraction(self._listGroup, group)
+
+    def _listGroup(self, transaction, group):
+        transaction.execute('SELECT 1 FROM groups WHERE name = ?', (group,))
+        if transaction.fetchone() is None:
+            raise database.NewsServerError("No such group: " + group)
+        transaction.execute('SELECT number FROM postings WHERE groupName = ? ORDER BY number', (group,))
+        return (group, [number for number, in transaction.fetchall()])
+
+    def groupRequest(self, group):
+        d = self.dbpool.runQuery('SELECT low, high, flags FROM groups WHERE name = ?', (group,))
+
+        def gotGroup(rows):
+            if not rows:
+                raise database.NewsServerError("No such group: " + group)
+            low, high, flags = rows[0]
+            return (group, high - low + 1, high, low, flags)
+
+        return d.addCallback(gotGroup)
+
+    def articleExistsRequest(self, id):
+        d = self.dbpool.runQuery('SELECT 1 FROM articles WHERE messageId = ?', (id,))
+        return d.addCallback(lambda rows: bool(rows))
+
+    def _findArticle(self, transaction, group, index, id, withBody):
+        """
+        Busca un articulo por Message-ID o por grupo y numero, usando los indices de cada tabla. El cuerpo de los
+        articulos del gateway se lee de su archivo en el hilo de la consulta.
+        """
+        columns = 'postings.number, articles.messageId, articles.headers, articles.body, articles.path, articles.bodyOffset'
+        if id is not None:
+            transaction.execute('SELECT %s FROM articles JOIN postings ON postings.articleId = articles.id '
+                                'WHERE articles.messageId = ? LIMIT 1' % (columns,), (id,))
+        else:
+            transaction.execute('SELECT %s FROM postings JOIN articles ON articles.id = postings.articleId '
+                                'WHERE postings.groupName = ? AND postings.number = ?' % (columns,), (group, index))
+        row = transaction.fetchone()
+        if row is None:
+            raise database.NewsServerError("No such article: %s" % (id or index,))
+        number, messageId, headers, body, path, bodyOffset = row
+        if withBody and path is not None:
+            body = readSpooledBody(path, bodyOffset)
+        return number, messageId, headers, body
+
+    def articleRequest(self, group, index, id = None):
+        d = self.dbpool.runInteraction(self._findArticle, group, index, id, True)
+        return d.addCallback(lambda row: (row[0], row[1], StringIO(row[2] + '\r\n' + row[3])))
+
+    def headRequest(self, group, index, id = None):
+        d = self.dbpool.runInteraction(self._findArticle, group, index, id, False)
+        return d.addCallback(lambda row: row[:3])
+
+    def bodyRequest(self, group, index, id = None):
+        d = self.dbpool.runInteraction(self._findArticle, group, index, id, True)
+        return d.addCallback(lambda row: (row[0], row[1], StringIO(row[3])))
+
+
+if database is not None:
+    NewsStore = implementer(database.INewsStorage)(NewsStore)
+
+
+class NewsGateway(object):
+
+    """
+    Publica como articulos los mensajes que el servidor SMTP entrega a las direcciones configuradas.
+
+    El mensaje no se copia: el archivo del maildir se enlaza con un hard link en <storage>/news, que sigue
+    valido aunque IMAP mueva o borre el mensaje, y la base guarda solo los encabezados NNTP, la linea de
+    overview y el offset donde empieza el cuerpo. Se registra con
+    smtpserver.deliveryObservers.append(gateway.deliveryReceived).
+    """
+
+    def __init__(self, storageDir, groups):
+        self.groups = groups
+        self.spoolDir = os.path.join(storageDir, 'news')
+        self.dbFile = os.path.join(storageDir, 'news.sqlite')
+        if not os.path.exists(self.spoolDir):
+            os.makedirs(self.spoolDir)
+        openDatabase(self.dbFile).close()
+
+    def deliveryReceived(self, inboxDir, messagePath):
+        """
+        El buzon de entrada esta en <storage>/<direccion>/Inbox, de ahi sale la direccion del destinatario.
+        """
+        address = os.path.basename(os.path.dirname(os.path.abspath(inboxDir)))
+        group = self.groups.get(address)
+        if group is not None:
+            deferToDisk(self.post, group, messagePath).addErrback(log.err)
+
+    def post(self, group, messagePath):
+        """
+        Enlaza el mensaje y lo agrega al grupo. Corre en el pool de disco.
+        """
+        with open(messagePath, 'rb') as message:
+            headerLines = []
+            for line in message:
+                if line in (b'\n', b'\r\n'):
+                    break
+                headerLines.append(line)
+            bodyOffset = message.tell()
+            lines = sum(1 for line in message)
+            size = message.tell()
+
+        headerText = b''.join(headerLines).decode('utf-8', 'replace')
+        headers = email.parser.HeaderParser().parsestr(headerText)
+        messageId = headers.get('Message-ID') or '<%s@%s>' % (os.path.basename(messagePath).split(',')[0],
+                                                                  socket.gethostname())
+
+        spoolPath = None
+        connection = openDatabase(self.dbFile)
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('INSERT OR IGNORE INTO groups (name, flags) VALUES (?, ?)', (group, 'y'))
+            xref = nextNumbers(connection, [group])
+            row = connection.execute('SELECT id FROM articles WHERE messageId = ?', (messageId,)).fetchone()
+            if row is not None:
+                # El mismo mensaje llego a otra direccion del gateway: solo se agrega al grupo, y si ya estaba
+                # se retorna el numero que tiene en la base.
+                if not connection.execute('SELECT 1 FROM postings WHERE groupName = ? AND articleId = ?',
+                                          (group, row[0])).fetchone():
+                    addPostings(connection, row[0], xref)
+                number, = connection.execute('SELECT number FROM postings WHERE groupName = ? AND articleId = ?',
+                                             (group, row[0])).fetchone()
+                connection.commit()
+                return number
+
+            spoolPath = os.path.join(self.spoolDir, os.path.basename(messagePath))
+            try:
+                os.link(messagePath, spoolPath)
+            except OSError:
+                shutil.copyfile(messagePath, spoolPath)
+
+            extra = [('Newsgroups', group), ('Xref', xrefHeader(xref))]
+            if 'Message-ID' not in headers:
+                extra.append(('Message-ID', messageId))
+            nntpHeaders = headerText.replace('\r\n', '\n').replace('\n', '\r\n')
+            nntpHeaders += ''.join(['%s: %s\r\n' % field for field in extra])
+            overview = overviewLine([headers.get('Subject', ''), headers.get('From', ''), headers.get('Date', ''),
+                                     messageId, headers.get('References', ''), str(size - bodyOffset),
+                                     str(lines), xrefHeader(xref)])
+            articleId = insertArticle(connection, messageId, nntpHeaders, '', overview, spoolPath, bodyOffset)
+            addPostings(connection, articleId, xref)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            if spoolPath is not None and os.path.exists(spoolPath):
+                os.remove(spoolPath)
+            raise
+        finally:
+            connection.close()
+        return xref[0][1]
@@ -0,0 +1,130 @@
+import os
+import signal
+import socket
+import sys
+
+from twisted.internet import protocol, reactor
+from twisted.python import log
+
+# Variable de ambiente con la que el supervisor le pasa el socket compartido a cada proceso hijo.
+WORKER_FD_VARIABLE = 'MAILSERVER_LISTEN_FD'
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.started = reactor.seconds()
+
+    def processEnded(self, reason):
+        """
+        Vuelve a levantar el proceso si termino mientras el supervisor sigue corriendo.
+        """
+        self.supervisor.workerEnded(self, reason)
+
+
+class Supervisor(object):
+
+    """
+    Crea el socket de escucha una sola vez y levanta workers procesos que lo heredan. Cada proceso corre su
+    propio reactor y acepta conexiones del mismo socket, por lo que el trabajo se reparte entre los nucleos.
+    Con reload un SIGHUP al supervisor se reenvia a los workers, que son los que recargan su configuracion;
+    sin reload el supervisor lo ignora, porque un worker sin manejador de SIGHUP terminaria con la senal.
+    """
+
+    # Un worker que termina antes de minUptime segundos cuenta como caida rapida. Cada caida rapida seguida
+    # duplica la espera antes de relevantarlo, desde restartDelay hasta maxRestartDelay, y despues de
+    # maxRapidFailures el supervisor deja de relevantarlos.
+    minUptime = 10
+    restartDelay = 1
+    maxRestartDelay = 60
+    maxRapidFailures = 5
+
+    def __init__(self, port, workers, interface='', reload=False):
+        self.workers = workers
+        self.reload = reload
+        self.running = True
+        self.processes = {}
+        self.rapidFailures = 0
+        self.restarts = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((interface, port))
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
+        self.fd = self.socket.fileno()
+        os.set_inheritable(self.fd, True)
+
+    def start(self):
+        for i in range(self.workers):
+            self.spawn()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        if self.reload:
+            signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(self.signalWorkers, 'HUP'))
+        else:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    def spawn(self):
+        worker = WorkerProtocol(self)
+        env = dict(os.environ)
+        env[WORKER_FD_VARIABLE] = str(self.fd)
+        process = reactor.spawnProcess(
+            worker, sys.executable, [sys.executable] + sys.argv, env=env,
+            childFDs={0: 0, 1: 1, 2: 2, self.fd: self.fd})
+        self.processes[worker] = process
+
+    def workerEnded(self, worker, reason):
+        del self.processes[worker]
+        if not self.running:
+            return
+        if reactor.seconds() - worker.started >= self.minUptime:
+            self.rapidFailures = 0
+            self.spawn()
+            return
+        self.rapidFailures += 1
+        if self.rapidFailures > self.maxRapidFailures:
+            log.msg("Worker failed %d times in a row, not restarting: %s" % (self.rapidFailures, reason.value))
+            if not self.processes and not self.restarts:
+                reactor.stop()
+            return
+        delay = min(self.restartDelay * 2 ** (self.rapidFailures - 1), self.maxRestartDelay)
+        log.msg("Worker failed, restarting in %g seconds: %s" % (delay, reason.value))
+        self.restarts.append(reactor.callLater(delay, self._restart))
+
+    def _restart(self):
+        self.restarts = [call for call in self.restarts if call.active()]
+        self.spawn()
+
+    def signalWorkers(self, signalName):
+        for process in list(self.processes.values()):
+            try:
+                process.signalProcess(signalName)
+            except Exception:
+                pass
+
+    def stop(self):
+        self.running = False
+        for call in self.restarts:
+            if call.active():
+                call.cancel()
+        self.restarts = []
+        self.signalWorkers('TERM')
+
+
+def listen(port, makeFactory, workers=1, reload=False):
+    """
+    Escucha en el puerto con la fabrica que retorna makeFactory.
+
+    Con un solo worker escucha en este proceso. Con varios, este proceso queda como supervisor y los workers,
+    que corren el mismo script, reciben el socket en la variable de ambiente y lo adoptan. reload indica que
+    los workers recargan su configuracion con SIGHUP y que el supervisor debe reenviarselo.
+    """
+    inherited = os.environ.get(WORKER_FD_VARIABLE)
+    if inherited is not None:
+        return reactor.adoptStreamPort(int(inherited), socket.AF_INET, makeFactory())
+    if workers > 1:
+        supervisor = Supervisor(port, workers, reload=reload)
+        supervisor.start()
+        return supervisor
+    return reactor.listenTCP(port, makeFactory())
+
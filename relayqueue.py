@@ -0,0 +1,635 @@
+import collections
+import fcntl
+import os
+import pickle
+import shutil
+import time
+
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.abstract import isIPAddress
+from twisted.internet.error import DNSLookupError
+from twisted.mail import maildir, relaymanager, smtp
+from twisted.names import cache, client, dns, error
+from twisted.python import failure, log
+
+from diskio import deferToDisk
+
+# Lineas de encabezado del mensaje original que se copian en un aviso de no entrega.
+maxBounceHeaderLines = 200
+
+
+def decodeReply(reply):
+    """
+    Las respuestas SMTP llegan como bytes; los registros y los avisos de no entrega usan texto.
+    """
+    if isinstance(reply, bytes):
+        return reply.decode('utf-8', 'replace')
+    return reply
+
+
+class CachingResolver(object):
+
+    """
+    Resolver que guarda las respuestas MX y A durante el TTL de sus registros. Las consultas iguales que
+    estan en curso comparten la misma respuesta, y los dominios inexistentes o sin registros se recuerdan
+    negativeTTL segundos. Los timeouts y errores del servidor no se guardan.
+    """
+
+    def __init__(self, resolver, clock=reactor, negativeTTL=300):
+        self.resolver = resolver
+        self.clock = clock
+        self.negativeTTL = negativeTTL
+        self.cache = cache.CacheResolver(reactor=clock)
+        self.negative = {}
+        self.inFlight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _query(self, name, type, lookup, timeout):
+        query = dns.Query(name, type, dns.IN)
+        if query in self.cache.cache:
+            self.hits += 1
+            return self.cache.query(query)
+        if query in self.negative:
+            expires, result = self.negative[query]
+            if expires > self.clock.seconds():
+                self.hits += 1
+                if isinstance(result, failure.Failure):
+                    return defer.fail(result)
+                return defer.succeed(result)
+            del self.negative[query]
+        result = defer.Deferred()
+        if query in self.inFlight:
+            self.inFlight[query].append(result)
+        else:
+            self.misses += 1
+            self.inFlight[query] = [result]
+            lookup(name, timeout).addBoth(self._answered, query)
+        return result
+
+    def _answered(self, result, query):
+        if isinstance(result, failure.Failure):
+            if result.check(error.DNSNameError):
+                self.negative[query] = (self.clock.seconds() + self.negativeTTL, result)
+        elif result[0]:
+            self.cache.cacheResult(query, result)
+        else:
+            self.negative[query] = (self.clock.seconds() + self.negativeTTL, result)
+        for waiter in self.inFlight.pop(query):
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+    def lookupMailExchange(self, name, timeout=None):
+        return self._query(name, dns.MX, self.resolver.lookupMailExchange, timeout)
+
+    def lookupAddress(self, name, timeout=None):
+        return self._query(name, dns.A, self.resolver.lookupAddress, timeout)
+
+    def getHostByName(self, name, timeout=None):
+        """
+        Retorna la primera direccion IPv4 del nombre, usando el cache de registros A.
+        """
+        if isIPAddress(name):
+            return defer.succeed(name)
+        return self.lookupAddress(name, timeout).addCallback(self._firstAddress, name)
+
+    def _firstAddress(self, result, name):
+        for record in result[0]:
+            if record.type == dns.A:
+                return record.payload.dottedQuad()
+        raise error.DNSNameError(name)
+
+
+class QueueDirectory(relaymanager.Queue):
+
+    noisy = False
+
+
+class RelayClient(smtp.SMTPClient):
+
+    """
+    Conexion a un servidor remoto que envia los mensajes de la cola para ese destino uno tras otro,
+    hasta maxMessagesPerConnection.
+    """
+
+    debug = False
+
+    def __init__(self, identity, relay, destination):
+        smtp.SMTPClient.__init__(self, identity)
+        self.relay = relay
+        self.destination = destination
+        self.name = None
+        self.data = None
+        self.messagesSent = 0
+        self.finished = False
+        self.failed = False
+
+    def getMailFrom(self):
+        self.name = self.relay.nextMessage(self)
+        if self.name is None:
+            self.finished = True
+            return None
+        return self.relay.envelopes[self.name][0]
+
+    def getMailTo(self):
+        return self.relay.envelopes[self.name][1]
+
+    def getMailData(self):
+        self.data = open(self.relay.queue.getPath(self.name) + '-D', 'rb')
+        return self.data
+
+    def _release(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        name, self.name = self.name, None
+        return name
+
+    def sentMail(self, code, resp, numOk, addresses, log):
+        name = self._release()
+        self.messagesSent += 1
+        if numOk and code in smtp.SUCCESS:
+            self.relay.hostAccepted(self.destination)
+        self.relay.messageSent(name, code, resp, addresses)
+
+    def sendError(self, exc):
+        self.failed = True
+        name = self._release()
+        if name is not None:
+            if getattr(exc, 'addresses', None):
+                self.relay.messageSent(name, exc.code, exc.resp, exc.addresses)
+            else:
+                self.relay.messageFailed(name, str(exc), getattr(exc, 'code', -1))
+        smtp.SMTPClient.sendError(self, exc)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        smtp.SMTPClient.connectionLost(self, reason)
+        name = self._release()
+        if name is not None:
+            self.relay.messageFailed(name, reason.getErrorMessage())
+        # Un saludo rechazado, un error o una conexion cortada antes de terminar la cola cuentan como falla del
+        # destino.
+        self.relay.sessionEnded(self.destination, self.failed or not self.finished, reason.getErrorMessage())
+
+
+class RelayClientFactory(protocol.ClientFactory):
+
+    def __init__(self, relay, destination):
+        self.relay = relay
+        self.destination = destination
+
+    def buildProtocol(self, addr):
+        return RelayClient(self.relay.identity, self.relay, self.destination)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.relay.connectionFailed(self.destination, reason)
+
+
+class RelayQueue(object):
+
+    """
+    Cola de salida en disco para el correo de dominios remotos.
+
+    Cada mensaje se guarda con el formato de relaymanager.Queue: <nombre>-D tiene los datos y <nombre>-H el
+    sobre [origen, destinatarios, intentos, proximo intento, creado], todos los destinatarios de un mismo
+    dominio. El servidor de cada dominio se busca con relaymanager.MXCalculator sobre un CachingResolver,
+    y los mensajes que van al mismo (ip, puerto) comparten hasta connectionsPerHost conexiones, con un total
+    de maxConnections. Los errores temporales se reintentan con espera exponencial desde retryDelay hasta
+    maxRetryDelay. Los destinatarios con un error permanente, o los de mensajes con mas de maxAge segundos,
+    se informan al remitente con un aviso de no entrega (DSN) que entra a la misma cola con remitente vacio;
+    si el mensaje ya era un aviso, se guarda en failed/ en lugar de responderlo.
+    Un destino que falla (conexion rechazada, saludo con error o sesion cortada) se marca como malo en el
+    MXCalculator y no se vuelve a conectar hasta que pase su propia espera exponencial; sus mensajes se
+    reintentan y al resolverlos de nuevo van al siguiente MX.
+
+    Como varios procesos pueden compartir el directorio, un mensaje solo se envia teniendo un flock sobre
+    su archivo -D. resolver, reactor y port se pueden reemplazar para probar sin red.
+    """
+
+    def __init__(self, directory, resolver=None, reactor=reactor, port=25, identity='localhost',
+                 maxConnections=8, connectionsPerHost=2, maxMessagesPerConnection=100,
+                 retryDelay=60, maxRetryDelay=4 * 60 * 60, maxAge=5 * 24 * 60 * 60, scanInterval=300):
+        os.makedirs(os.path.join(directory, 'tmp'), 0o700, exist_ok=True)
+        os.makedirs(os.path.join(directory, 'failed'), 0o700, exist_ok=True)
+        self.directory = directory
+        self.deadLetterDir = os.path.join(directory, 'failed')
+        self.queue = QueueDirectory(directory)
+        if resolver is None:
+            resolver = client.createResolver()
+        self.resolver = CachingResolver(resolver, reactor)
+        self.mxcalc = relaymanager.MXCalculator(self.resolver, reactor)
+        self.reactor = reactor
+        self.port = port
+        self.identity = identity
+        self.maxConnections = maxConnections
+        self.connectionsPerHost = connectionsPerHost
+        self.maxMessagesPerConnection = maxMessagesPerConnection
+        self.retryDelay = retryDelay
+        self.maxRetryDelay = maxRetryDelay
+        self.maxAge = maxAge
+        self.scanInterval = scanInterval
+
+        self.envelopes = {}
+        self.locks = {}
+        self.ready = collections.OrderedDict()
+        self.connections = collections.Counter()
+        self.activeConnections = 0
+        self.wakeup = None
+        self.checking = False
+        self.checkAgain = False
+        self.lastScan = reactor.seconds()
+        self.exchanges = {}
+        self.hostFailures = collections.Counter()
+        self.hostBackoff = {}
+
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+        self.bounced = 0
+
+    def store(self, tmpName, origin, recipients, now):
+        """
+        Agrega a la cola un archivo ya escrito en tmp/. Corre en el pool de disco y retorna el nombre del mensaje.
+        El sobre se escribe antes que los datos, porque la cola solo toma los mensajes que tienen -D.
+        """
+        name = os.path.basename(tmpName)
+        path = self.queue.getPath(name)
+        with open(path + '-H', 'wb') as envelopeFile:
+            pickle.dump([origin, list(recipients), 0, now, now], envelopeFile)
+        os.rename(tmpName, path + '-D')
+        return name
+
+    def queued(self, name):
+        """
+        Marca el mensaje como pendiente e intenta enviarlo enseguida.
+        """
+        self.queue.addMessage(name)
+        self.checkState()
+        return name
+
+    def checkState(self):
+        """
+        Toma los mensajes pendientes cuyo proximo intento ya paso, busca el servidor de su dominio y agenda
+        la siguiente revision para el primer reintento futuro. Los archivos de la cola se leen en el pool de
+        disco; si se pide otra revision mientras tanto, se hace al terminar esta.
+        """
+        if self.wakeup is not None and self.wakeup.active():
+            self.wakeup.cancel()
+        self.wakeup = None
+        if self.checking:
+            self.checkAgain = True
+            return
+        now = self.reactor.seconds()
+        rescan = now - self.lastScan >= self.scanInterval
+        if rescan:
+            self.lastScan = now
+        nextCheck = now + self.scanInterval
+        candidates = []
+        for name in list(self.queue.getWaiting()):
+            envelope = self.envelopes.get(name)
+            if envelope is not None and envelope[3] > now:
+                nextCheck = min(nextCheck, envelope[3])
+                continue
+            candidates.append(name)
+        self.checking = True
+        d = deferToDisk(self._claim, candidates, rescan, frozenset(self.locks), now)
+        d.addCallback(self._claimed, nextCheck)
+        d.addErrback(log.err)
+        d.addBoth(self._checked)
+
+    def _claim(self, candidates, rescan, busy, now):
+        """
+        Corre en el pool de disco. Con rescan recoge tambien los mensajes que dejaron otros procesos que ya no
+        estan. Toma el flock de cada candidato y lee su sobre; retorna (listados, tomados, faltantes), donde
+        tomados son (nombre, fd, sobre) y fd es None si el proximo intento todavia no llego.
+        """
+        listed = []
+        if rescan:
+            listed = [name[:-2] for name in os.listdir(self.directory) if name.endswith('-D')]
+            known = set(candidates)
+            candidates = candidates + [name for name in listed if name not in known and name not in busy]
+        claimed = []
+        missing = []
+        for name in candidates:
+            try:
+                fd = os.open(self.queue.getPath(name) + '-D', os.O_RDONLY)
+            except FileNotFoundError:
+                missing.append(name)
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            try:
+                envelope = self.queue.getEnvelope(name)
+            except (IOError, EOFError):
+                # Otro proceso lo termino de enviar mientras tanto.
+                os.close(fd)
+                missing.append(name)
+                continue
+            if envelope[3] > now:
+                os.close(fd)
+                fd = None
+            claimed.append((name, fd, envelope))
+        return listed, claimed, missing
+
+    def _claimed(self, result, nextCheck):
+        listed, claimed, missing = result
+        for name in listed:
+            self.queue.addMessage(name)
+        for name in missing:
+            self._forget(name)
+        domains = {}
+        for name, fd, envelope in claimed:
+            self.envelopes[name] = envelope
+            if fd is None:
+                nextCheck = min(nextCheck, envelope[3])
+                continue
+            self.locks[name] = fd
+            self.queue.addMessage(name)
+            self.queue.setRelaying(name)
+            domains.setdefault(envelope[1][0].rsplit('@', 1)[-1].lower(), []).append(name)
+        for domain, names in domains.items():
+            self._resolve(domain, names)
+        self._schedule(nextCheck)
+
+    def _checked(self, result):
+        self.checking = False
+        if self.checkAgain:
+            self.checkAgain = False
+            self.checkState()
+
+    def _schedule(self, when):
+        if self.wakeup is not None and self.wakeup.active():
+            if self.wakeup.getTime() <= when:
+                return
+            self.wakeup.cancel()
+        self.wakeup = self.reactor.callLater(max(0, when - self.reactor.seconds()), self.checkState)
+
+    def _unlock(self, name):
+        os.close(self.locks.pop(name))
+
+    def _forget(self, name):
+        self.queue.waiting.pop(name, None)
+        self.queue.relayed.pop(name, None)
+        self.envelopes.pop(name, None)
+        if name in self.locks:
+            self._unlock(name)
+
+    def _resolve(self, domain, names):
+        d = self.mxcalc.getMX(domain)
+        d.addCallback(self._exchangeFound)
+        d.addCallbacks(self._resolved, self._notResolved, (names,), None, (domain, names))
+        d.addErrback(log.err)
+
+    def _exchangeFound(self, mx):
+        exchange = str(mx.name)
+        return self.resolver.getHostByName(exchange).addCallback(lambda address: (address, exchange))
+
+    def _resolved(self, result, names):
+        address, exchange = result
+        self.exchanges[(address, self.port)] = exchange
+        self.ready.setdefault((address, self.port), collections.deque()).extend(names)
+        self._startSessions()
+
+    def _notResolved(self, reason, domain, names):
+        permanent = reason.check(DNSLookupError, error.DNSNameError, relaymanager.CanonicalNameLoop,
+                                 relaymanager.CanonicalNameChainTooLong)
+        for name in names:
+            if permanent:
+                self._fail(name, self.envelopes[name][1], 'No mail server for %s' % (domain,), '5.1.2')
+            else:
+                self._retry(name, self.envelopes[name][1], reason.getErrorMessage())
+
+    def _startSessions(self):
+        now = self.reactor.seconds()
+        for destination, names in list(self.ready.items()):
+            if self.hostBackoff.get(destination, 0) > now:
+                if not self.connections[destination]:
+                    del self.ready[destination]
+                    for name in names:
+                        self._retry(name, self.envelopes[name][1], 'Waiting for %s:%d after a failed session'
+                                    % destination)
+                continue
+            while (len(names) > self.connections[destination]
+                   and self.connections[destination] < self.connectionsPerHost
+                   and self.activeConnections < self.maxConnections):
+                self.connections[destination] += 1
+                self.activeConnections += 1
+                host, port = destination
+                self.reactor.connectTCP(host, port, RelayClientFactory(self, destination))
+
+    def nextMessage(self, relayClient):
+        """
+        Siguiente mensaje para la conexion, o None si ya envio maxMessagesPerConnection o no queda nada
+        para su destino.
+        """
+        if relayClient.messagesSent >= self.maxMessagesPerConnection:
+            return None
+        names = self.ready.get(relayClient.destination)
+        if not names:
+            return None
+        name = names.popleft()
+        if not names:
+            del self.ready[relayClient.destination]
+        return name
+
+    def messageSent(self, name, code, resp, addresses):
+        """
+        Separa los destinatarios aceptados, los rechazados y los que hay que reintentar, cada uno segun el
+        codigo de su RCPT. Sin addresses el servidor rechazo MAIL FROM y el codigo vale para todos.
+        """
+        if not addresses:
+            self.messageFailed(name, resp, code)
+            return
+        transient = []
+        rejected = []
+        for address, addressCode, addressResp in addresses:
+            if addressCode in smtp.SUCCESS and code in smtp.SUCCESS:
+                self.delivered += 1
+            elif 400 <= addressCode < 500 or (addressCode in smtp.SUCCESS and 400 <= code < 500):
+                transient.append(address)
+            else:
+                if addressCode in smtp.SUCCESS:
+                    addressCode, addressResp = code, resp
+                self.failed += 1
+                reason = '%s %s' % (addressCode, decodeReply(addressResp))
+                log.msg("Relay to %s failed: %s" % (address, reason))
+                rejected.append((address, '5.0.0', reason))
+        if transient:
+            self._retry(name, transient, resp, rejected)
+        else:
+            self._finish(name, rejected)
+
+    def messageFailed(self, name, reason, code=-1):
+        """
+        Ningun destinatario recibio el mensaje. Con un 5xx el rechazo es permanente y el mensaje se registra
+        como fallido; un 4xx, o un error sin codigo como una conexion cortada, se reintenta.
+        """
+        if 500 <= code < 600:
+            self._fail(name, self.envelopes[name][1], '%s %s' % (code, decodeReply(reason)))
+        else:
+            self._retry(name, self.envelopes[name][1], reason)
+
+    def sessionEnded(self, destination, failed, reason):
+        self.connections[destination] -= 1
+        self.activeConnections -= 1
+        if failed:
+            self._hostFailed(destination, reason)
+        self._startSessions()
+
+    def connectionFailed(self, destination, reason):
+        self.sessionEnded(destination, True, reason.getErrorMessage())
+
+    def _hostFailed(self, destination, reason):
+        """
+        Marca el MX del destino como malo y lo deja en espera; los mensajes que lo esperaban se reintentan
+        cuando se cierra su ultima conexion.
+        """
+        self.hostFailures[destination] += 1
+        delay = min(self.retryDelay * 2 ** (self.hostFailures[destination] - 1), self.maxRetryDelay)
+        self.hostBackoff[destination] = self.reactor.seconds() + delay
+        exchange = self.exchanges.get(destination)
+        if exchange is not None:
+            self.mxcalc.markBad(exchange)
+        log.msg("Relay host %s:%d failed, waiting %d seconds: %s" % (destination + (delay, reason)))
+
+    def hostAccepted(self, destination):
+        """
+        El destino acepto un mensaje: se olvidan sus fallas anteriores.
+        """
+        self.hostFailures.pop(destination, None)
+        self.hostBackoff.pop(destination, None)
+        exchange = self.exchanges.get(destination)
+        if exchange is not None:
+            self.mxcalc.markGood(exchange)
+
+    def _retry(self, name, recipients, reason, rejected=()):
+        """
+        Deja el mensaje esperando su proximo intento solo con recipients. Los destinatarios de rejected, que
+        fallaron en este intento, se informan al remitente en la misma operacion del pool.
+        """
+        envelope = self.envelopes[name]
+        now = self.reactor.seconds()
+        if now - envelope[4] >= self.maxAge:
+            failures = list(rejected) + [(address, '4.4.7', 'Gave up after %d attempts: %s'
+                                          % (envelope[2] + 1, decodeReply(reason))) for address in recipients]
+            for address, status, diagnostic in failures[len(rejected):]:
+                self.failed += 1
+                log.msg("Relay to %s failed: %s" % (address, diagnostic))
+            self._finish(name, failures)
+            return
+        envelope[1] = list(recipients)
+        envelope[2] += 1
+        envelope[3] = now + min(self.retryDelay * 2 ** (envelope[2] - 1), self.maxRetryDelay)
+        self.retried += 1
+        d = deferToDisk(self._rewrite, name, list(envelope), list(rejected), now)
+        d.addCallback(self._requeue, name)
+        d.addErrback(log.err)
+
+    def _rewrite(self, name, envelope, rejected, now):
+        bounce = self._bounce(name, envelope[0], rejected, envelope[4], now)
+        self._writeEnvelope(name, envelope)
+        return bounce
+
+    def _writeEnvelope(self, name, envelope):
+        path = self.queue.getPath(name)
+        with open(path + '-T', 'wb') as envelopeFile:
+            pickle.dump(envelope, envelopeFile)
+        os.rename(path + '-T', path + '-H')
+
+    def _requeue(self, bounce, name):
+        self._unlock(name)
+        self.queue.setWaiting(name)
+        self._schedule(self.envelopes[name][3])
+        self._bounced(bounce)
+
+    def _fail(self, name, recipients, reason, status='5.0.0'):
+        for address in recipients:
+            self.failed += 1
+            log.msg("Relay to %s failed: %s" % (address, reason))
+        self._finish(name, [(address, status, reason) for address in recipients])
+
+    def _finish(self, name, failures=()):
+        """
+        Borra el mensaje de la cola, avisando antes al remitente de los destinatarios de failures. El flock
+        se suelta despues de borrar los archivos para que ningun otro proceso lo tome.
+        """
+        del self.queue.relayed[name]
+        envelope = self.envelopes.pop(name)
+        d = deferToDisk(self._remove, name, self.locks.pop(name), envelope[0], list(failures), envelope[4],
+                        self.reactor.seconds())
+        d.addCallback(self._bounced)
+        d.addErrback(log.err)
+
+    def _remove(self, name, fd, origin, failures, created, now):
+        path = self.queue.getPath(name)
+        try:
+            bounce = self._bounce(name, origin, failures, created, now)
+            os.remove(path + '-H')
+            os.remove(path + '-D')
+        finally:
+            os.close(fd)
+        return bounce
+
+    def _bounce(self, name, origin, failures, created, now):
+        """
+        Corre en el pool de disco. Agrega a la cola un aviso de no entrega (RFC 3464) para origin con los
+        (direccion, estado, diagnostico) de failures y los encabezados del mensaje, y retorna su nombre. Un
+        mensaje sin remitente ya es un aviso y no se responde: se copia a failed/ con su sobre.
+        """
+        if not failures:
+            return None
+        path = self.queue.getPath(name)
+        if not origin:
+            shutil.copyfile(path + '-D', os.path.join(self.deadLetterDir, name + '-D'))
+            with open(os.path.join(self.deadLetterDir, name + '-H'), 'wb') as envelopeFile:
+                pickle.dump([origin, failures, created, now], envelopeFile)
+            return None
+        headers = []
+        with open(path + '-D', 'rb') as message:
+            for line in message:
+                if not line.strip() or len(headers) >= maxBounceHeaderLines:
+                    break
+                headers.append(line.rstrip(b'\r\n'))
+        boundary = '=_%s' % (maildir._generateMaildirName(),)
+        lines = ['From: Mail Delivery System <MAILER-DAEMON@%s>' % (self.identity,),
+                 'To: <%s>' % (origin,),
+                 'Subject: Undelivered Mail Returned to Sender',
+                 'Date: %s' % (smtp.rfc822date(time.localtime(now)).decode('ascii'),),
+                 'Message-ID: %s' % (smtp.messageid(uniq='bounce').decode('ascii'),),
+                 'Auto-Submitted: auto-replied',
+                 'MIME-Version: 1.0',
+                 'Content-Type: multipart/report; report-type=delivery-status; boundary="%s"' % (boundary,),
+                 '',
+                 '--' + boundary,
+                 'Content-Type: text/plain; charset=utf-8',
+                 '',
+                 'Your message could not be delivered to the following recipients:',
+                 '']
+        lines.extend('  <%s>: %s' % (address, diagnostic) for address, status, diagnostic in failures)
+        lines.extend(['', '--' + boundary,
+                      'Content-Type: message/delivery-status',
+                      '',
+                      'Reporting-MTA: dns; %s' % (self.identity,),
+                      'Arrival-Date: %s' % (smtp.rfc822date(time.localtime(created)).decode('ascii'),)])
+        for address, status, diagnostic in failures:
+            lines.extend(['', 'Final-Recipient: rfc822; %s' % (address,), 'Action: failed',
+                          'Status: %s' % (status,), 'Diagnostic-Code: smtp; %s' % (diagnostic,)])
+        lines.extend(['', '--' + boundary, 'Content-Type: text/rfc822-headers', ''])
+        # Como en los mensajes que escribe el servidor SMTP, las lineas terminan en \n; al enviar se pasan a CRLF.
+        data = '\n'.join(lines).encode('utf-8') + b'\n'
+        data += b''.join(header + b'\n' for header in headers)
+        data += ('\n--%s--\n' % (boundary,)).encode('ascii')
+        tmpName = os.path.join(self.directory, 'tmp', maildir._generateMaildirName())
+        with open(tmpName, 'xb') as bounceFile:
+            bounceFile.write(data)
+        return self.store(tmpName, '', [origin], now)
+
+    def _bounced(self, bounce):
+        if bounce is not None:
+            self.bounced += 1
+            self.queued(bounce)
@@ -0,0 +1,696 @@
+import binascii
+import bisect
+import calendar
+import collections
+import contextlib
+import email.errors
+import email.header
+import email.parser
+import email.policy
+import email.utils
+import mmap
+import os
+import pickle
+import quopri
+import re
+import sqlite3
+import threading
+
+from twisted.mail import imap4
+from twisted.python import log
+
+from diskio import deferToDisk
+import mimestructure
+
+# Indice de busqueda de un buzon, dentro del directorio del maildir.
+INDEX_FILE = '.imap-search.sqlite'
+
+# Con indexBodies los buzones nuevos guardan tambien las palabras del texto; BODY y TEXT se resuelven con el
+# indice invertido. Un buzon creado sin cuerpos las sigue buscando en los archivos.
+indexBodies = True
+
+# Bytes de texto por mensaje que se pasan al indice invertido.
+maxBodyBytes = 256 * 1024
+
+# Indices abiertos a la vez por el registro; los que se dejan de usar se cierran y se reabren al volver.
+maxOpenIndexes = 128
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (
+        key         TEXT PRIMARY KEY,
+        value       TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS messages (
+        id              INTEGER PRIMARY KEY,
+        name            TEXT NOT NULL UNIQUE,
+        fromAddr        TEXT NOT NULL,
+        toAddr          TEXT NOT NULL,
+        cc              TEXT NOT NULL,
+        bcc             TEXT NOT NULL,
+        subject         TEXT NOT NULL,
+        sentDate        INTEGER,
+        internalDate    INTEGER NOT NULL,
+        size            INTEGER NOT NULL,
+        structure       BLOB
+    );
+
+    CREATE INDEX IF NOT EXISTS messagesByInternalDate ON messages (internalDate);
+    CREATE INDEX IF NOT EXISTS messagesBySentDate ON messages (sentDate);
+    CREATE INDEX IF NOT EXISTS messagesBySize ON messages (size);
+
+    CREATE TABLE IF NOT EXISTS tokens (
+        token       TEXT NOT NULL,
+        messageId   INTEGER NOT NULL,
+        PRIMARY KEY (token, messageId)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS tokensByMessage ON tokens (messageId);
+"""
+
+# Encabezados con columna propia; HEADER sobre cualquier otro se busca en los archivos.
+HEADER_COLUMNS = {'from': 'fromAddr', 'to': 'toAddr', 'cc': 'cc', 'bcc': 'bcc', 'subject': 'subject'}
+
+# Las palabras de los encabezados se guardan con este prefijo para que BODY no las encuentre y TEXT si.
+HEADER_TOKEN = 'h:'
+
+TOKEN_RE = re.compile(r'\w{2,64}', re.UNICODE)
+
+TAG_RE = re.compile(r'<[^>]*>')
+
+BASE64_JUNK = re.compile(br'[^A-Za-z0-9+/]')
+
+FLAG_KEYS = {'ANSWERED': '\\answered', 'DELETED': '\\deleted', 'DRAFT': '\\draft', 'FLAGGED': '\\flagged',
+             'SEEN': '\\seen', 'RECENT': '\\recent'}
+
+DATE_KEYS = {'BEFORE': ('internalDate', '<'), 'ON': ('internalDate', '='), 'SINCE': ('internalDate', '>='),
+             'SENTBEFORE': ('sentDate', '<'), 'SENTON': ('sentDate', '='), 'SENTSINCE': ('sentDate', '>=')}
+
+
+class UnindexedQuery(Exception):
+    """
+    La consulta usa un termino que el indice no conoce.
+    """
+
+
+def decodeHeader(value):
+    """
+    Valor de un encabezado con las palabras RFC 2047 decodificadas, en minusculas y en una sola linea.
+    """
+    try:
+        value = str(email.header.make_header(email.header.decode_header(value)))
+    except (email.errors.HeaderParseError, LookupError, UnicodeError):
+        pass
+    return ' '.join(value.split()).lower()
+
+
+def dayOf(seconds):
+    """
+    Inicio del dia UTC que contiene el instante.
+    """
+    return seconds - seconds % 86400
+
+
+def sentDate(value):
+    """
+    Dia del encabezado Date sin hora ni zona horaria, como lo compara SENTON, o None si no se entiende.
+    """
+    parsed = email.utils.parsedate_tz(value) if value else None
+    if parsed is None:
+        return None
+    try:
+        return dayOf(calendar.timegm(parsed[:6] + (0, 0, 0)))
+    except (OverflowError, ValueError):
+        return None
+
+
+def internalDate(messagePath, stat):
+    """
+    Igual que MaildirMessage.getInternalDate: el inicio del nombre del maildir o el mtime del archivo.
+    """
+    seconds = os.path.basename(messagePath).split('.', 1)[0]
+    if seconds.isdigit():
+        return int(seconds)
+    return int(stat.st_mtime)
+
+
+def textTokens(text):
+    return set(TOKEN_RE.findall(text.lower()))
+
+
+def textParts(node):
+    """
+    Nodos de mimestructure de las partes text/* del mensaje, en orden; las demas partes no se leen.
+    """
+    if node['parts']:
+        for part in node['parts']:
+            for textPart in textParts(part):
+                yield textPart
+    elif node['type'].startswith('text/'):
+        yield node
+
+
+def partText(data, node, limit):
+    """
+    Texto de una parte text/* decodificado, leyendo de data solo los bytes codificados que alcanzan para
+    limit bytes decodificados.
+    """
+    headers = mimestructure.parseHeaderBlock(data[node['headerStart']:node['bodyStart']])
+    encoding = headers.get('content-transfer-encoding', '').strip().lower()
+    start = node['bodyStart']
+    if encoding == 'base64':
+        raw = BASE64_JUNK.sub(b'', data[start:min(node['end'], start + limit * 3 // 2 + 4)])
+        try:
+            payload = binascii.a2b_base64(raw[:len(raw) - len(raw) % 4])
+        except binascii.Error:
+            payload = b''
+    elif encoding == 'quoted-printable':
+        payload = quopri.decodestring(data[start:min(node['end'], start + limit * 3)])
+    else:
+        payload = data[start:min(node['end'], start + limit)]
+    payload = payload[:limit]
+    try:
+        text = payload.decode(headers.get_content_charset() or 'utf-8', 'replace')
+    except LookupError:
+        text = payload.decode('utf-8', 'replace')
+    if node['type'] == 'text/html':
+        text = TAG_RE.sub(' ', text)
+    return text, len(payload)
+
+
+def bodyText(data, node):
+    """
+    Texto de las partes text/* del mensaje, decodificado y acotado a maxBodyBytes.
+    """
+    pieces = []
+    remaining = maxBodyBytes
+    for part in textParts(node):
+        text, used = partText(data, part, remaining)
+        pieces.append(text)
+        remaining -= used
+        if remaining <= 0:
+            break
+    return ' '.join(pieces)
+
+
+@contextlib.contextmanager
+def mappedMessage(messagePath):
+    """
+    Contenido del archivo mapeado con mmap, de solo lectura. El sistema pagina el mensaje a medida que se
+    recorre en lugar de copiarlo entero a memoria; un archivo vacio da b''.
+    """
+    with open(messagePath, 'rb') as messageFile:
+        if not os.fstat(messageFile.fileno()).st_size:
+            yield b''
+            return
+        data = mmap.mmap(messageFile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield data
+        finally:
+            data.close()
+
+
+def readStructure(messagePath):
+    """
+    Registro de mimestructure de un mensaje, en el formato que guarda la columna structure.
+    """
+    with mappedMessage(messagePath) as data:
+        return pickle.dumps(mimestructure.messageStructure(data), pickle.HIGHEST_PROTOCOL)
+
+
+def parseMessage(messagePath, withBody):
+    """
+    Recorre un mensaje una sola vez y retorna (columnas, palabras). Las columnas incluyen el registro de
+    mimestructure. Corre en el pool de disco.
+    """
+    stat = os.stat(messagePath)
+    with mappedMessage(messagePath) as data:
+        record = mimestructure.messageStructure(data)
+        parser = email.parser.BytesHeaderParser(policy=email.policy.compat32)
+        message = parser.parsebytes(data[:record['parts']['bodyStart']])
+        structure = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+
+        headers = {}
+        for name in HEADER_COLUMNS:
+            headers[name] = decodeHeader(', '.join(str(value) for value in message.get_all(name, [])))
+        columns = (headers['from'], headers['to'], headers['cc'], headers['bcc'], headers['subject'],
+                   sentDate(message.get('Date')), internalDate(messagePath, stat), stat.st_size, structure)
+
+        tokens = set()
+        if withBody:
+            for value in headers.values():
+                tokens.update(HEADER_TOKEN + token for token in textTokens(value))
+            tokens.update(textTokens(bodyText(data, record['parts'])))
+    return columns, tokens
+
+
+def searchTerms(value):
+    """
+    Palabras de un termino de BODY o TEXT. Sin palabras el indice no sirve y se busca en los archivos.
+    """
+    return sorted(textTokens(value))
+
+
+def messageMatches(messagePath, node):
+    """
+    Evalua en el archivo un termino que el indice no resuelve: HEADER de un encabezado sin columna, o BODY y
+    TEXT como subcadena. Un mensaje que ya no existe no coincide.
+    """
+    kind = node[0]
+    try:
+        with open(messagePath, 'rb') as messageFile:
+            if kind == 'header':
+                message = email.parser.BytesParser(policy=email.policy.compat32).parse(messageFile, headersonly=True)
+                values = message.get_all(node[1], [])
+                return any(node[2] in decodeHeader(str(value)) for value in values)
+            data = messageFile.read()
+    except FileNotFoundError:
+        return False
+    value = node[2].encode('utf-8')
+    if node[1] == 'body':
+        separator = re.search(b'\r?\n\r?\n', data)
+        data = data[separator.end():] if separator else b''
+    return value in data.lower()
+
+
+class MailboxSnapshot(object):
+
+    """
+    Lo que la busqueda necesita del buzon, tomado en el reactor. Las listas se copian porque una entrega o un
+    EXPUNGE pueden cambiarlas mientras la consulta corre en el pool; del diccionario de uids y de la FlagTable
+    solo se leen claves y mapas sueltos, lo que es seguro sin copiarlos.
+    """
+
+    def __init__(self, uidList, paths, uids, flags, recentUID=None):
+        self.uidList = list(uidList)
+        self.paths = list(paths)
+        self.uids = uids
+        self.flags = flags
+        self.recentUID = recentUID
+
+    def position(self, name):
+        """
+        Posicion en la secuencia del mensaje con ese nombre de archivo, o None.
+        """
+        uid = self.uids.get(name)
+        if uid is None:
+            return None
+        index = bisect.bisect_left(self.uidList, uid)
+        if index < len(self.uidList) and self.uidList[index] == uid:
+            return index
+        return None
+
+    def withFlag(self, flag, candidates):
+        """
+        Posiciones de candidates cuyo mensaje tiene el flag, a partir del mapa de bits del flag.
+        """
+        if flag == '\\recent' and self.recentUID is not None:
+            return set(index for index in candidates if self.uidList[index] >= self.recentUID)
+        uids = set(self.flags.withFlag(flag))
+        return set(index for index in candidates if self.uidList[index] in uids)
+
+
+def compileQuery(query, lastSequence, lastUID):
+    """
+    Convierte la consulta de parseNestedParens (bytes y listas para los parentesis) en un arbol de tuplas.
+    Los terminos desconocidos levantan UnindexedQuery y los mal formados IllegalQueryError.
+    """
+    terms = collections.deque(query)
+    nodes = []
+    while terms:
+        nodes.append(_compileTerm(terms, lastSequence, lastUID))
+    if not nodes:
+        raise imap4.IllegalQueryError('Empty search query')
+    if len(nodes) == 1:
+        return nodes[0]
+    return ('and', nodes)
+
+
+def _string(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _argument(terms):
+    if not terms or isinstance(terms[0], list):
+        raise imap4.IllegalQueryError('Missing search argument')
+    return _string(terms.popleft())
+
+
+def _compileTerm(terms, lastSequence, lastUID):
+    term = terms.popleft()
+    if isinstance(term, list):
+        return compileQuery(term, lastSequence, lastUID)
+
+    key = _string(term).upper()
+    if key == 'ALL':
+        return ('all',)
+    if key in FLAG_KEYS:
+        return ('flag', FLAG_KEYS[key], True)
+    if key.startswith('UN') and key[2:] in FLAG_KEYS and key != 'UNRECENT':
+        return ('flag', FLAG_KEYS[key[2:]], False)
+    if key == 'NEW':
+        return ('and', [('flag', '\\recent', True), ('flag', '\\seen', False)])
+    if key == 'OLD':
+        return ('flag', '\\recent', False)
+    if key in ('KEYWORD', 'UNKEYWORD'):
+        return ('flag', _argument(terms).lower(), key == 'KEYWORD')
+    if key in ('FROM', 'TO', 'CC', 'BCC', 'SUBJECT'):
+        return ('column', HEADER_COLUMNS[key.lower()], _argument(terms).lower())
+    if key == 'HEADER':
+        name = _argument(terms).lower()
+        value = _argument(terms).lower()
+        if name in HEADER_COLUMNS:
+            return ('column', HEADER_COLUMNS[name], value)
+        return ('header', name, value)
+    if key in ('BODY', 'TEXT'):
+        return ('text', key.lower(), _argument(terms).lower())
+    if key in DATE_KEYS:
+        try:
+            day = calendar.timegm(imap4.parseTime(_argument(terms)))
+        except ValueError:
+            raise imap4.IllegalQueryError('Bad date in search query')
+        column, operator = DATE_KEYS[key]
+        if operator == '=':
+            return ('and', [('range', column, '>=', day), ('range', column, '<', day + 86400)])
+        return ('range', column, operator, day)
+    if key in ('LARGER', 'SMALLER'):
+        size = _argument(terms)
+        if not size.isdigit():
+            raise imap4.IllegalQueryError('Bad size in search query')
+        return ('range', 'size', '>' if key == 'LARGER' else '<', int(size))
+    if key == 'NOT':
+        if not terms:
+            raise imap4.IllegalQueryError('Missing search argument')
+        return ('not', _compileTerm(terms, lastSequence, lastUID))
+    if key == 'OR':
+        if not terms:
+            raise imap4.IllegalQueryError('Missing search argument')
+        first = _compileTerm(terms, lastSequence, lastUID)
+        if not terms:
+            raise imap4.IllegalQueryError('Missing search argument')
+        return ('or', first, _compileTerm(terms, lastSequence, lastUID))
+    if key == 'UID':
+        return ('uid', _messageSet(_argument(terms), lastUID))
+    if key[:1].isdigit() or key[:1] == '*':
+        return ('seq', _messageSet(key, lastSequence))
+    raise UnindexedQuery(key)
+
+
+def _messageSet(value, last):
+    try:
+        return imap4.parseIdList(value.encode('ascii'), last or 1)
+    except (imap4.IllegalIdentifierError, UnicodeError, ValueError):
+        raise imap4.IllegalQueryError('Bad message set in search query')
+
+
+def usesKind(node, kinds):
+    """
+    Indica si el arbol tiene algun nodo de esos tipos.
+    """
+    if node[0] in kinds:
+        return True
+    if node[0] == 'and':
+        return any(usesKind(child, kinds) for child in node[1])
+    if node[0] == 'or':
+        return usesKind(node[1], kinds) or usesKind(node[2], kinds)
+    if node[0] == 'not':
+        return usesKind(node[1], kinds)
+    return False
+
+
+class SearchIndex(object):
+
+    """
+    Indice de encabezados, fechas y tamanos de un buzon, con un indice invertido opcional de las palabras del
+    texto, en una base sqlite dentro del maildir.
+
+    El servidor SMTP agrega cada mensaje al entregarlo y el buzon IMAP agrega los que falten y borra los
+    eliminados antes de buscar. Todos los metodos bloquean y corren en el pool de disco; el lock serializa los
+    hilos que comparten la conexion.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dbFile = os.path.join(path, INDEX_FILE)
+        self.lock = threading.Lock()
+        self.db = None
+        self.bodies = None
+        self.queries = 0
+
+    def _connect(self):
+        if self.db is None:
+            db = sqlite3.connect(self.dbFile, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(SCHEMA)
+            columns = [row[1] for row in db.execute('PRAGMA table_info(messages)')]
+            if 'structure' not in columns:
+                # Indices anteriores a los registros de estructura; se completan al hacer FETCH.
+                db.execute('ALTER TABLE messages ADD COLUMN structure BLOB')
+            db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('bodies', ?)", (str(int(indexBodies)),))
+            self.bodies = db.execute("SELECT value FROM meta WHERE key = 'bodies'").fetchone()[0] == '1'
+            self.db = db
+        return self.db
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def add(self, messagePaths, batchSize=500):
+        """
+        Agrega los mensajes que no esten en el indice y retorna cuantos agrego. Los archivos que ya no existen
+        se ignoran.
+        """
+        added = 0
+        for start in range(0, len(messagePaths), batchSize):
+            added += self._addBatch(messagePaths[start:start + batchSize])
+        return added
+
+    def _addBatch(self, messagePaths):
+        with self.lock:
+            db = self._connect()
+            withBody = self.bodies
+            missing = [messagePath for messagePath in messagePaths
+                       if db.execute('SELECT 1 FROM messages WHERE name = ?',
+                                     (os.path.basename(messagePath),)).fetchone() is None]
+        if not missing:
+            return 0
+
+        records = []
+        for messagePath in missing:
+            try:
+                records.append((os.path.basename(messagePath), parseMessage(messagePath, withBody)))
+            except FileNotFoundError:
+                pass
+
+        with self.lock:
+            db = self._connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                added = 0
+                for name, (columns, tokens) in records:
+                    cursor = db.execute(
+                        'INSERT OR IGNORE INTO messages (name, fromAddr, toAddr, cc, bcc, subject, sentDate, '
+                        'internalDate, size, structure) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (name,) + columns)
+                    if cursor.rowcount:
+                        added += 1
+                        db.executemany('INSERT OR IGNORE INTO tokens (token, messageId) VALUES (?, ?)',
+                                       [(token, cursor.lastrowid) for token in tokens])
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        return added
+
+    def structures(self, messagePaths, batchSize=500):
+        """
+        Registros de estructura de los mensajes, en el mismo orden; None para los que ya no existen. Los
+        mensajes que faltan en el indice se agregan y a las filas sin registro se les calcula.
+        """
+        found = {}
+        for start in range(0, len(messagePaths), batchSize):
+            names = [os.path.basename(messagePath) for messagePath in messagePaths[start:start + batchSize]]
+            with self.lock:
+                db = self._connect()
+                found.update(db.execute('SELECT name, structure FROM messages WHERE name IN (%s)' %
+                                        ', '.join('?' * len(names)), names))
+
+        missing = [messagePath for messagePath in messagePaths if os.path.basename(messagePath) not in found]
+        if missing:
+            self.add(missing)
+            for messagePath in missing:
+                with self.lock:
+                    row = self._connect().execute('SELECT structure FROM messages WHERE name = ?',
+                                                  (os.path.basename(messagePath),)).fetchone()
+                if row is not None:
+                    found[os.path.basename(messagePath)] = row[0]
+
+        records = []
+        for messagePath in messagePaths:
+            name = os.path.basename(messagePath)
+            structure = found.get(name)
+            if structure is None and name in found:
+                try:
+                    structure = readStructure(messagePath)
+                except FileNotFoundError:
+                    records.append(None)
+                    continue
+                with self.lock:
+                    self._connect().execute('UPDATE messages SET structure = ? WHERE name = ?', (structure, name))
+            records.append(pickle.loads(structure) if structure is not None else None)
+        return records
+
+    def remove(self, names):
+        """
+        Borra del indice los mensajes con esos nombres de archivo.
+        """
+        with self.lock:
+            db = self._connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                for name in names:
+                    row = db.execute('SELECT id FROM messages WHERE name = ?', (name,)).fetchone()
+                    if row is not None:
+                        db.execute('DELETE FROM tokens WHERE messageId = ?', row)
+                        db.execute('DELETE FROM messages WHERE id = ?', row)
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def search(self, node, snapshot):
+        """
+        Evalua el arbol de compileQuery y retorna los uids que coinciden, ordenados. Salen de la misma foto que
+        evaluo la busqueda, por lo que un EXPUNGE o APPEND posterior no los cambia.
+        """
+        with self.lock:
+            self.queries += 1
+            self._connect()
+            positions = self._evaluate(node, snapshot)
+        return [snapshot.uidList[index] for index in sorted(positions)]
+
+    def _sql(self, node):
+        """
+        Condicion sql sobre messages para el nodo, o None si alguna parte no se resuelve en la base.
+        """
+        kind = node[0]
+        if kind == 'all':
+            return '1', []
+        if kind == 'column':
+            return 'instr(%s, ?) > 0' % node[1], [node[2]]
+        if kind == 'range':
+            return '%s %s ?' % (node[1], node[2]), [node[3]]
+        if kind == 'text':
+            terms = searchTerms(node[2])
+            if not self.bodies or not terms:
+                return None
+            if node[1] == 'body':
+                selects = ['SELECT messageId FROM tokens WHERE token = ?'] * len(terms)
+                params = terms
+            else:
+                selects = ['SELECT messageId FROM tokens WHERE token IN (?, ?)'] * len(terms)
+                params = []
+                for term in terms:
+                    params.extend([term, HEADER_TOKEN + term])
+            return 'id IN (%s)' % ' INTERSECT '.join(selects), params
+        if kind == 'and':
+            parts = [self._sql(child) for child in node[1]]
+            if None in parts:
+                return None
+            return ' AND '.join('(%s)' % sql for sql, params in parts), [p for sql, params in parts for p in params]
+        if kind == 'or':
+            first, second = self._sql(node[1]), self._sql(node[2])
+            if first is None or second is None:
+                return None
+            return '(%s) OR (%s)' % (first[0], second[0]), first[1] + second[1]
+        if kind == 'not':
+            child = self._sql(node[1])
+            if child is None:
+                return None
+            return 'NOT (%s)' % child[0], child[1]
+        return None
+
+    def _select(self, sql, params, snapshot):
+        positions = set()
+        for name, in self.db.execute('SELECT name FROM messages WHERE ' + sql, params):
+            index = snapshot.position(name)
+            if index is not None:
+                positions.add(index)
+        return positions
+
+    def _evaluate(self, node, snapshot, candidates=None):
+        """
+        Posiciones que coinciden con el nodo, dentro de candidates (None son todas). Los terminos de flags,
+        secuencia y uid filtran en memoria y los que necesitan los archivos se evaluan al final, solo sobre los
+        candidatos que quedan.
+        """
+        sql = self._sql(node)
+        if sql is not None:
+            if sql[0] == '1':
+                return self._all(snapshot, candidates)
+            positions = self._select(sql[0], sql[1], snapshot)
+            return positions if candidates is None else candidates & positions
+
+        kind = node[0]
+        if kind == 'and':
+            children = list(node[1])
+            sqlParts = [self._sql(child) for child in children]
+            conditions = [part for part in sqlParts if part is not None]
+            if conditions:
+                candidates = self._evaluate(('and', [child for child, part in zip(children, sqlParts)
+                                                     if part is not None]), snapshot, candidates)
+            rest = [child for child, part in zip(children, sqlParts) if part is None]
+            rest.sort(key=lambda child: usesKind(child, ('header', 'text')))
+            for child in rest:
+                if candidates is not None and not candidates:
+                    break
+                candidates = self._evaluate(child, snapshot, candidates)
+            return candidates
+        if kind == 'or':
+            first = self._evaluate(node[1], snapshot, candidates)
+            return first | self._evaluate(node[2], snapshot, self._all(snapshot, candidates) - first)
+        if kind == 'not':
+            return self._all(snapshot, candidates) - self._evaluate(node[1], snapshot, candidates)
+
+        candidates = self._all(snapshot, candidates)
+        if kind == 'flag':
+            flagged = snapshot.withFlag(node[1], candidates)
+            return flagged if node[2] else candidates - flagged
+        if kind == 'seq':
+            return set(index for index in candidates if index + 1 in node[1])
+        if kind == 'uid':
+            return set(index for index in candidates if snapshot.uidList[index] in node[1])
+        return set(index for index in candidates if messageMatches(snapshot.paths[index], node))
+
+    def _all(self, snapshot, candidates):
+        if candidates is None:
+            return set(range(len(snapshot.uidList)))
+        return candidates
+
+
+openIndexes = collections.OrderedDict()
+
+def getIndex(path):
+    """
+    Indice del buzon; el registro cierra la conexion de los menos usados cuando pasan de maxOpenIndexes.
+    """
+    path = os.path.abspath(path)
+    index = openIndexes.pop(path, None)
+    if index is None:
+        index = SearchIndex(path)
+    openIndexes[path] = index
+    while len(openIndexes) > maxOpenIndexes:
+        oldPath, oldIndex = openIndexes.popitem(last=False)
+        deferToDisk(oldIndex.close).addErrback(log.err)
+    return index
+
+def indexDelivery(inboxDir, messagePath):
+    """
+    Agrega al indice un mensaje recien entregado. Se registra con
+    smtpserver.deliveryObservers.append(searchindex.indexDelivery).
+    """
+    deferToDisk(getIndex(inboxDir).add, [messagePath]).addErrback(log.err)
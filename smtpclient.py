@@ -1,12 +1,10 @@
 import sys
 
-from email.mime.text import MIMEText
-
-from twisted.internet import reactor
-from twisted.mail.smtp import sendmail
+from twisted.internet import reactor, tksupport
 from twisted.python import log
 from tkinter.filedialog import askopenfilename
-import csv
+
+from bulksender import BulkSender, readRecipients, textMessage
 
 log.startLogging(sys.stdout)
 
@@ -25,25 +23,11 @@ def send_data():
     print(from_info, "\t", to_info, "\t", subject_info, "\t", message_info)
     host = "localhost"
 
-    addresses = []
-
-    with open(to_info, 'r') as csvfile:
-        spamreader = csv.reader(csvfile, delimiter='\n', quotechar='|')
-        for row in spamreader:
-            new = row[0].split(sep=',')
-            addresses = addresses + new
-        print(addresses)
-
-
-    msg = MIMEText(message_info)
-    msg["Subject"] = subject_info
-    msg["From"] = from_info
-    recipients = addresses
-    msg["To"] = ", ".join(recipients)
-    deferred = sendmail(host, from_info, recipients, msg, port=2525)
-    deferred.addBoth(lambda result : reactor.stop())
-
-    reactor.run()
+    # El reactor corre junto al mainloop de Tk, por lo que se pueden enviar varias tandas sin cerrar la ventana.
+    bulk = BulkSender(from_info, lambda domain: (host, 2525))
+    deferred = bulk.send(readRecipients(to_info), textMessage(from_info, subject_info, message_info))
+    deferred.addCallback(lambda bulk: print("Sent to %d recipients, %d failed" % (bulk.sent, len(bulk.failed))))
+    deferred.addErrback(log.err)
 
     from_entry.delete(0, END)
     subject_entry.delete(0, END)
@@ -102,4 +86,6 @@ message_entry.place(x=22, y=280,height=100)
 submit_btn = Button(mywindow, text="Send", width="15", height="2", command=send_data, bg="#7312FF",fg="white")
 submit_btn.place(x=200, y=400)
 
-mywindow.mainloop()
\ No newline at end of file
+tksupport.install(mywindow)
+mywindow.protocol("WM_DELETE_WINDOW", reactor.stop)
+reactor.run()
@@ -1,76 +1,455 @@
 import sys
 from twisted.mail import smtp, maildir
-from twisted.internet import protocol, reactor
+from twisted.internet import protocol, reactor, defer
 from zope.interface import implementer
 import os
+import shutil
 from email.header import Header
-from twisted.names import client
+from twisted.python import failure, log
 
-from twisted.mail import relaymanager
+import newsstore
+import prefork
+import relayqueue
+import searchindex
+from diskio import deferToDisk
 
-mxCalc = relaymanager.MXCalculator()
+# Funciones llamadas con (inboxDir, messagePath) por cada mensaje entregado. Un servidor IMAP que corre
+# en el mismo proceso se registra aqui para avisar a sus clientes en IDLE sin esperar al sistema de archivos.
+deliveryObservers = []
 
-def getSMTPServer(domain):
+def notifyDelivery(inboxDir, messagePath):
+    for observer in deliveryObservers:
+        observer(inboxDir, messagePath)
+
+def initializeInbox(userDir, user):
+    """
+    Crea el Inbox del destinatario si no existe y retorna su direccion. Usa makedirs con exist_ok porque
+    varios procesos pueden estar creando el mismo buzon a la vez.
+    """
+    inboxDir = os.path.join(userDir, str(user.dest), 'Inbox')
+    if not os.path.isdir(os.path.join(inboxDir, 'tmp')):
+        for subdir in ('new', 'cur', 'tmp', os.path.join('.Trash', 'new'), os.path.join('.Trash', 'cur'),
+                       os.path.join('.Trash', 'tmp')):
+            os.makedirs(os.path.join(inboxDir, subdir), 0o700, exist_ok=True)
+        open(os.path.join(inboxDir, '.Trash', 'maildirfolder'), 'a').close()
+    return inboxDir
+
+class RecipientIndex(object):
+
+    """
+    Indice de destinatarios armado al iniciar: el conjunto de dominios locales y el Inbox de cada buzon que
+    ya existe en userDir. validateTo lo consulta sin tocar el disco; los buzones nuevos se agregan cuando se
+    crean y reload() vuelve a leer userDir (y domainsFile si hay) en el pool de disco.
+
+    Con requireMailbox=True solo se aceptan destinatarios que ya tienen buzon.
+    """
+
+    def __init__(self, userDir, domains=(), domainsFile=None, requireMailbox=False):
+        self.userDir = userDir
+        self.staticDomains = list(domains)
+        self.domainsFile = domainsFile
+        self.requireMailbox = requireMailbox
+        self.reloads = 0
+        self._loaded(self._scan())
+
+    def _scan(self):
+        """
+        Lee los dominios y los buzones. Corre en el pool de disco salvo al iniciar.
+        """
+        domains = set(self.staticDomains)
+        if self.domainsFile is not None:
+            with open(self.domainsFile) as domainsFile:
+                domains.update(line.strip() for line in domainsFile if line.strip())
+        mailboxes = {}
+        for name in os.listdir(self.userDir):
+            inboxDir = os.path.join(self.userDir, name, 'Inbox')
+            if '@' in name and os.path.isdir(os.path.join(inboxDir, 'tmp')):
+                mailboxes[name] = inboxDir
+        return domains, mailboxes
+
+    def _loaded(self, result):
+        domains, mailboxes = result
+        self.domains = frozenset(domain.lower().encode("utf-8") for domain in domains)
+        self.mailboxes = mailboxes
+        self.mtime = os.stat(self.userDir).st_mtime
+
+    def reload(self):
+        """
+        Vuelve a leer los dominios y los buzones sin bloquear el reactor.
+        """
+        self.reloads += 1
+        return deferToDisk(self._scan).addCallback(self._loaded)
+
+    def checkReload(self):
+        """
+        Recarga si cambio el directorio de usuarios. Pensado para llamarse periodicamente con un LoopingCall.
+        """
+        d = deferToDisk(os.stat, self.userDir)
+        d.addCallback(lambda stat: stat.st_mtime != self.mtime and self.reload())
+        d.addErrback(log.err)
+        return d
+
+    def isLocal(self, user):
+        return user.dest.domain.lower() in self.domains
+
+    def accepts(self, user):
+        """
+        Retorna True si el destinatario es de un dominio local y, con requireMailbox, si su buzon existe.
+        """
+        if user.dest.domain.lower() not in self.domains:
+            return False
+        return not self.requireMailbox or str(user.dest) in self.mailboxes
+
+    def inbox(self, user):
+        """
+        Retorna la funcion que da el Inbox del destinatario. Si el buzon es conocido no se revisa el disco;
+        si no, se crea en el pool de disco. El indice no se toca desde el pool: el buzon se agrega en
+        deliveryReceived, ya en el reactor.
+        """
+        inboxDir = self.mailboxes.get(str(user.dest))
+        if inboxDir is not None:
+            return lambda: inboxDir
+        return lambda: initializeInbox(self.userDir, user)
+
+    def deliveryReceived(self, inboxDir, messagePath):
+        """
+        Observador de entregas: agrega al indice el Inbox de un buzon creado por inbox().
+        """
+        userDir, inbox = os.path.split(inboxDir)
+        if inbox == 'Inbox' and os.path.normpath(os.path.dirname(userDir)) == os.path.normpath(self.userDir):
+            self.mailboxes.setdefault(os.path.basename(userDir), inboxDir)
+
+def createMaildirTempFile(mailboxDir):
     """
-    Imprime el nombre del smpt server del dominio ingresado
+    Crea un archivo unico en el tmp/ del maildir y lo retorna abierto en modo binario junto a su direccion.
     """
-    return print(mxCalc.getMX(domain).name)
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0)
+    while True:
+        tmpName = os.path.join(mailboxDir, 'tmp', maildir._generateMaildirName())
+        try:
+            fd = os.open(tmpName, flags, 0o600)
+        except FileExistsError:
+            continue
+        return tmpName, os.fdopen(fd, 'wb')
+
+def moveMaildirTempFile(tmpName, mailboxDir):
+    """
+    Mueve un archivo de tmp/ a new/ sin sobreescribir otro mensaje y retorna su nueva direccion.
+    El nombre lleva el tamano en el campo S= para que el servidor IMAP no tenga que leerlo.
+    """
+    size = os.stat(tmpName).st_size
+    while True:
+        newName = os.path.join(mailboxDir, 'new', '%s,S=%d' % (maildir._generateMaildirName(), size))
+        if not os.path.exists(newName):
+            os.rename(tmpName, newName)
+            return newName
+
+class MaildirTempFile(object):
 
-def printResult(address, hostname):
     """
-    Imprime la direccion ip si fue encontrada
+    Archivo de tmp/ de un maildir que se escribe desde el pool de disco. Las lineas se juntan en bloques de
+    chunkSize bytes y cada bloque se escribe en orden en un hilo, sin bloquear el reactor. Si el disco no da
+    abasto y se acumulan mas de maxPendingChunks bloques, se pausa la lectura de la conexion hasta que baje.
     """
-    if address:
-        sys.stdout.write(address + '\n')
-    else:
-        sys.stderr.write(
-            'ERROR: No IP addresses found for name %r\n' % (hostname,))
 
+    chunkSize = 64 * 1024
+    maxPendingChunks = 16
+
+    def __init__(self, prepare, protocol=None):
+        self.protocol = protocol
+        self.buffer = []
+        self.bufferSize = 0
+        self.pending = 0
+        self.paused = False
+        self.inboxDir = None
+        self.tmpName = None
+        self.file = None
+        self.chain = deferToDisk(self._open, prepare)
+
+    def _open(self, prepare):
+        self.inboxDir = prepare()
+        self.tmpName, self.file = createMaildirTempFile(self.inboxDir)
+
+    def write(self, line):
+        if type(line) == str:
+            line = line.encode("utf-8")
+        self.buffer.append(line + b'\n')
+        self.bufferSize += len(line) + 1
+        if self.bufferSize >= self.chunkSize:
+            self._flush()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.bufferSize = 0
+        self.pending += 1
+        if self.pending > self.maxPendingChunks and not self.paused and self.protocol is not None:
+            self.protocol.transport.pauseProducing()
+            self.paused = True
+        self.chain.addCallback(lambda ignored: deferToDisk(self.file.write, data))
+        self.chain.addBoth(self._chunkWritten)
+
+    def _chunkWritten(self, result):
+        self.pending -= 1
+        if self.paused and self.pending <= self.maxPendingChunks // 2:
+            self._resume()
+        return result
+
+    def _resume(self):
+        if self.paused:
+            self.paused = False
+            self.protocol.transport.resumeProducing()
+
+    def close(self, publish):
+        """
+        Escribe lo que queda, cierra el archivo y llama publish(tmpName, inboxDir) en el pool.
+        Retorna un Deferred con el resultado de publish.
+        """
+        self._flush()
+        self._resume()
+        self.chain.addCallback(lambda ignored: deferToDisk(self._closeAndPublish, publish))
+        return self.chain
+
+    def _closeAndPublish(self, publish):
+        self.file.close()
+        return publish(self.tmpName, self.inboxDir)
+
+    def abort(self):
+        """
+        Descarta el archivo temporal despues de las escrituras pendientes.
+        """
+        self.buffer = []
+        self._resume()
+        self.chain.addBoth(lambda ignored: deferToDisk(self._discard))
+        self.chain.addErrback(log.err)
+
+    def _discard(self):
+        if self.file is not None:
+            self.file.close()
+        if self.tmpName is not None and os.path.exists(self.tmpName):
+            os.remove(self.tmpName)
 
 @implementer(smtp.IMessage)
 class MaildirMessageWriter(object):
 
-    def __init__(self, user):
+    def __init__(self, prepare, protocol=None):
 
-        if not os.path.exists(userDir):
-            os.mkdir(userDir)
+        self.file = MaildirTempFile(prepare, protocol)
 
-        destDir = os.path.join(userDir,str(user.dest))
-        if not os.path.exists(destDir):
-            os.mkdir(destDir)
+    def lineReceived(self, line):
+        """
+        Agrega la informacion recibida del cliente al archivo temporal.
+        """
+        self.file.write(line)
+
+    def eomReceived(self):
+        """
+        Mueve el mensaje de tmp/ a new/ cuando esta listo.
+        """
+        return self.file.close(moveMaildirTempFile).addCallback(self._delivered)
 
-        inboxDir = os.path.join(destDir, 'Inbox')
-        self.mailbox = maildir.MaildirMailbox(inboxDir)
-        self.lines = []
+    def _delivered(self, newName):
+        notifyDelivery(self.file.inboxDir, newName)
+        return newName
+
+    def connectionLost(self):
+        """
+        Elimina el archivo temporal ya que se perdio la conexion.
+        """
+        self.file.abort()
+
+class MaildirSpool(object):
+    """
+    Mensaje de una transaccion que se escribe una sola vez y se enlaza a cada buzon destino.
+    """
+
+    def __init__(self, protocol=None):
+        self.protocol = protocol
+        self.recipients = 0
+        self.inboxes = []
+        self.file = None
+        self.finished = None
+        self.outcome = None
+        self.waiters = []
+
+    def addInbox(self, prepare):
+        """
+        Registra un buzon destino y retorna su posicion. El primero recibe el archivo temporal y es el
+        unico que escribe.
+        """
+        self.inboxes.append(prepare)
+        if self.file is None:
+            self.file = MaildirTempFile(prepare, self.protocol)
+        return len(self.inboxes) - 1
+
+    def write(self, line):
+        self.file.write(line)
+
+    def _publish(self, tmpName, inboxDir):
+        """
+        Publica el archivo en el new/ de cada buzon con hard links, copiando si estan en otro sistema de
+        archivos. Corre en el pool de disco y retorna (inboxDir, messagePath) por destinatario.
+        """
+        inboxDirs = [inboxDir]
+        names = {inboxDir: None}
+        for prepare in self.inboxes[1:]:
+            otherDir = prepare()
+            if otherDir not in names:
+                names[otherDir] = linkMaildirFile(tmpName, otherDir)
+            inboxDirs.append(otherDir)
+        names[inboxDir] = moveMaildirTempFile(tmpName, inboxDir)
+        return [(otherDir, names[otherDir]) for otherDir in inboxDirs]
+
+    def finish(self, index):
+        """
+        Publica el spool la primera vez que se llama y retorna un Deferred con el archivo del destinatario.
+        """
+        result = defer.Deferred()
+        self.waiters.append((result, index))
+        if self.finished is None:
+            self.finished = self.file.close(self._publish)
+            self.finished.addBoth(self._finished)
+        elif self.outcome is not None:
+            self._fire()
+        return result
+
+    def _finished(self, outcome):
+        self.outcome = outcome
+        if not isinstance(outcome, failure.Failure):
+            for inboxDir, messagePath in set(outcome):
+                notifyDelivery(inboxDir, messagePath)
+        self._fire()
+
+    def _fire(self):
+        waiters, self.waiters = self.waiters, []
+        for result, index in waiters:
+            if isinstance(self.outcome, failure.Failure):
+                result.errback(self.outcome)
+            else:
+                result.callback(self.outcome[index][1])
+
+    def abort(self):
+        """
+        Elimina el archivo temporal si el mensaje no llego a entregarse.
+        """
+        if self.file is not None and self.finished is None:
+            self.finished = self.file.chain
+            self.file.abort()
+
+def linkMaildirFile(sourceName, mailboxDir):
+    """
+    Agrega un archivo existente al new/ del maildir con un hard link o una copia.
+    """
+    size = os.stat(sourceName).st_size
+    while True:
+        newName = os.path.join(mailboxDir, 'new', '%s,S=%d' % (maildir._generateMaildirName(), size))
+        try:
+            os.link(sourceName, newName)
+        except FileExistsError:
+            continue
+        except OSError:
+            tmpName, file = createMaildirTempFile(mailboxDir)
+            with open(sourceName, 'rb') as source:
+                shutil.copyfileobj(source, file)
+            file.close()
+            newName = moveMaildirTempFile(tmpName, mailboxDir)
+        return newName
+
+@implementer(smtp.IMessage)
+class SpooledMessage(object):
+
+    def __init__(self, prepare, spool):
+
+        self.spool = spool
+        self.index = spool.addInbox(prepare)
 
     def lineReceived(self, line):
         """
-        Recibe informacion de la comunicacion con el cliente.
+        Solo el primer destinatario de la transaccion escribe en el spool.
         """
-        if type(line) != str:
-            line = line.decode("utf-8")
-        self.lines.append(line)
+        if self.index == 0:
+            self.spool.write(line)
 
     def eomReceived(self):
         """
-        Guarda el mensaje cuando esta listo.
+        Publica el spool en todos los buzones la primera vez que se llama.
         """
-        self.lines.append('')
-        messageData = '\n'.join(self.lines)
-        return self.mailbox.appendMessage(bytes(messageData,'utf-8'))
+        return self.spool.finish(self.index)
 
     def connectionLost(self):
         """
-        Elimina las lineas guardadas ya que se perdio la conexion.
+        Elimina el spool ya que se perdio la conexion.
         """
-        del self.lines
+        self.spool.abort()
+
+class RelaySpool(object):
+    """
+    Mensaje de una transaccion para los destinatarios de un dominio remoto. Se escribe una sola vez en el
+    tmp/ de la cola de salida y al terminar se agrega a la cola con todos sus destinatarios.
+    """
+
+    def __init__(self, relay, origin, protocol=None):
+        self.relay = relay
+        self.origin = origin
+        self.recipients = []
+        self.file = MaildirTempFile(lambda: relay.directory, protocol)
+
+    def write(self, line):
+        self.file.write(line)
+
+    def finish(self):
+        now = self.relay.reactor.seconds()
+        publish = lambda tmpName, queueDir: self.relay.store(tmpName, self.origin, self.recipients, now)
+        return self.file.close(publish).addCallback(self.relay.queued)
+
+    def abort(self):
+        self.file.abort()
+
+@implementer(smtp.IMessage)
+class RelayMessage(object):
+
+    def __init__(self, spool, first):
+
+        self.spool = spool
+        self.first = first
+
+    def lineReceived(self, line):
+        """
+        Solo el primer destinatario del dominio escribe en el spool.
+        """
+        if self.first:
+            self.spool.write(line)
+
+    def eomReceived(self):
+        """
+        Agrega el mensaje a la cola de salida.
+        """
+        if self.first:
+            return self.spool.finish()
+        return defer.succeed(None)
+
+    def connectionLost(self):
+        if self.first:
+            self.spool.abort()
 
 @implementer(smtp.IMessageDelivery)
 class LocalDelivery(object):
 
-    def __init__ (self, userDir ,validDomains):
-        self.validDomains = validDomains
+    def __init__ (self, userDir ,validDomains, singleSpool=True, relay=None, relayClients=('127.0.0.1',),
+                  recipients=None):
+        if recipients is None:
+            recipients = RecipientIndex(userDir, validDomains)
+        self.recipients = recipients
         self.userDir = userDir
+        self.singleSpool = singleSpool
+        self.spool = None
+        self.protocol = None
+        # Cola de salida para dominios remotos; solo se acepta correo para ellos desde relayClients.
+        self.relay = relay
+        self.relayClients = relayClients
+        self.relaySpools = {}
 
     def receivedHeader (self, helo, origin, recipients):
         """
@@ -80,9 +459,15 @@ class LocalDelivery(object):
         recipient = recipients[0]
         # this must be our CNAME
         myself= 'localhost'
-        value= """from %s [%s] by %s with SMTP for %s; %s""" % (
-            client.decode("utf-8"), clientIP.decode("utf-8"), myself, recipient, smtp.rfc822date().decode("utf-8")
-            )
+        if self.spool is not None and self.spool.recipients > 1:
+            # El spool se comparte entre destinatarios, no se debe revelar a ninguno.
+            value= """from %s [%s] by %s with SMTP; %s""" % (
+                client.decode("utf-8"), clientIP.decode("utf-8"), myself, smtp.rfc822date().decode("utf-8")
+                )
+        else:
+            value= """from %s [%s] by %s with SMTP for %s; %s""" % (
+                client.decode("utf-8"), clientIP.decode("utf-8"), myself, recipient, smtp.rfc822date().decode("utf-8")
+                )
         return "Received: %s" % Header(value)
 
     def validateFrom (self, helo, originAddress):
@@ -90,58 +475,94 @@ class LocalDelivery(object):
         Valida el dominio del from.
         """
         self.client = helo
+        self.origin = originAddress
+        self.spool = None
+        self.relaySpools = {}
         return originAddress
 
     def validateTo(self, user):
         """
         Valida el dominio del to.
         """
-        if user.dest.domain.decode("utf-8") in self.validDomains:
-            print("Domain: %s accepted" % user.dest.domain.decode("utf-8"))
-            print()
-            print("Server ready.")
-            print("Waiting for connections...")
-            print()
-            return lambda: MaildirMessageWriter(user)
+        if self.recipients.accepts(user):
+            if self.singleSpool:
+                if self.spool is None:
+                    self.spool = MaildirSpool(self.protocol)
+                spool = self.spool
+                spool.recipients += 1
+                return lambda: SpooledMessage(self.recipients.inbox(user), spool)
+            return lambda: MaildirMessageWriter(self.recipients.inbox(user), self.protocol)
+        elif (self.relay is not None and not self.recipients.isLocal(user)
+              and self.client[1].decode("utf-8") in self.relayClients):
+            domain = user.dest.domain.decode("utf-8").lower()
+            spool = self.relaySpools.get(domain)
+            first = spool is None
+            if first:
+                spool = self.relaySpools[domain] = RelaySpool(self.relay, str(self.origin), self.protocol)
+            spool.recipients.append(str(user.dest))
+            return lambda: RelayMessage(spool, first)
         else:
-            '''
-            Descomentar para conocer el ip y nombre del server de un dominio no aceptado.
-            
-            d = client.getHostByName(user.dest.domain.decode("utf-8"))
-            d.addCallback(printResult, user.dest.domain.decode("utf-8"))
-            
-            getSMTPServer(user.dest.domain.decode("utf-8"))
-            '''
-            print("Domain: %s not listed" % user.dest.domain.decode("utf-8"))
-            print("Domains available:")
-            print(self.validDomains)
-            print()
-            print("Server ready.")
-            print("Waiting for connections...")
-            print()
             raise smtp.SMTPBadRcpt(user)
 
 class SMTPFactory (protocol.ServerFactory):
-    def __init__(self, userDir ,validDomains):
+    def __init__(self, userDir ,validDomains, singleSpool=True, relay=None, relayClients=('127.0.0.1',),
+                 recipients=None):
         print("Server ready.")
         print("Waiting for connections...")
         print()
-        self.validDomains = validDomains
+        if recipients is None:
+            recipients = RecipientIndex(userDir, validDomains)
+        self.recipients = recipients
         self.userDir = userDir
+        self.singleSpool = singleSpool
+        self.relay = relay
+        self.relayClients = relayClients
 
     def buildProtocol(self, addr):
         """
         Prepara el protocolo smpt para la recepcion de correo.
         """
-        delivery = LocalDelivery(self.userDir,self.validDomains)
+        delivery = LocalDelivery(self.userDir,None,self.singleSpool,self.relay,self.relayClients,self.recipients)
         smtpProtocol = smtp.SMTP(delivery)
+        delivery.protocol = smtpProtocol
         smtpProtocol.factory = self
         return smtpProtocol
 
-#python3 smtpserver.py -d <domains> -s <mail-storage> -p <port>
+#python3 smtpserver.py -d <domains|domains-file> -s <mail-storage> -p <port> [-w <workers>] [-g <address>=<group>,...] [-r <relay-clients>] [-k 1]
 if __name__=='__main__':
+    import signal
+    from twisted.internet import task
+
     domains = sys.argv[2].split(',')
+    domainsFile = None
+    if os.path.isfile(sys.argv[2]):
+        # Un archivo con un dominio por linea se vuelve a leer junto con los buzones.
+        domains, domainsFile = [], sys.argv[2]
     userDir = sys.argv[4]
     port = int(sys.argv[6])
-    reactor.listenTCP(port, SMTPFactory(userDir,domains))
+    options = dict(zip(sys.argv[7::2], sys.argv[8::2]))
+    workers = int(options.get('-w', 1))
+    # Cada entrega se agrega al indice de busqueda del buzon para que el SEARCH de IMAP no lea los mensajes.
+    deliveryObservers.append(searchindex.indexDelivery)
+    if '-g' in options:
+        # Gateway a NNTP: -g direccion=grupo[,direccion=grupo...]
+        gateway = newsstore.NewsGateway(userDir, dict(pair.split('=', 1) for pair in options['-g'].split(',')))
+        deliveryObservers.append(gateway.deliveryReceived)
+
+    def makeFactory():
+        # -k 1 acepta solo destinatarios con buzon. El indice se recarga cada 30 segundos si cambio
+        # <mail-storage> y con SIGHUP.
+        recipients = RecipientIndex(userDir, domains, domainsFile, options.get('-k') == '1')
+        task.LoopingCall(recipients.checkReload).start(30, now=False)
+        deliveryObservers.append(recipients.deliveryReceived)
+        signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(recipients.reload))
+        if '-r' in options:
+            # Acepta correo para dominios remotos desde las ip de -r y lo envia desde <mail-storage>/.relay.
+            relay = relayqueue.RelayQueue(os.path.join(userDir, '.relay'))
+            reactor.callWhenRunning(relay.checkState)
+            return SMTPFactory(userDir, domains, relay=relay, relayClients=options['-r'].split(','),
+                               recipients=recipients)
+        return SMTPFactory(userDir, domains, recipients=recipients)
+
+    prefork.listen(port, makeFactory, workers, reload=True)
     reactor.run()
\ No newline at end of file
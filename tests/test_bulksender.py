@@ -0,0 +1,174 @@
+"""
+Pruebas del envio masivo: la lectura de la lista sin repetidos, los lotes por dominio y los reintentos con
+espera, con un reloj de prueba en lugar del reactor y sin abrir conexiones.
+
+python3 -m twisted.trial tests
+"""
+import os
+import shutil
+import tempfile
+
+from twisted.internet import error, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+import bulksender
+
+
+class FakeReactor(task.Clock):
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.connections = []
+
+    def connectTCP(self, host, port, factory):
+        self.connections.append(factory)
+
+
+class RecipientTests(unittest.TestCase):
+
+    def test_domainBatches(self):
+        addresses = ['a@uno.com', 'b@dos.com', 'c@UNO.com', 'd@uno.com', 'e@dos.com']
+        self.assertEqual(list(bulksender.domainBatches(addresses, 2)),
+                         [('uno.com', ['a@uno.com', 'c@UNO.com']), ('dos.com', ['b@dos.com', 'e@dos.com']),
+                          ('uno.com', ['d@uno.com'])])
+
+    def test_openBatchesAreBounded(self):
+        """
+        Con mas de maxOpenBatches dominios abiertos sale el lote mas antiguo aunque no este lleno.
+        """
+        addresses = ['a@uno.com', 'b@dos.com', 'c@tres.com', 'd@uno.com']
+        self.assertEqual(list(bulksender.domainBatches(addresses, 10, maxOpenBatches=2)),
+                         [('uno.com', ['a@uno.com']), ('dos.com', ['b@dos.com']), ('tres.com', ['c@tres.com']),
+                          ('uno.com', ['d@uno.com'])])
+
+    def test_normalizeAddress(self):
+        self.assertEqual(bulksender.normalizeAddress(' Ana <ana@Example.COM> '), 'ana@example.com')
+        self.assertEqual(bulksender.normalizeAddress('Ana@example.com'), 'Ana@example.com')
+        for field in ('email', 'ana@', '@example.com', 'a b@example.com'):
+            self.assertIdentical(bulksender.normalizeAddress(field), None)
+
+    def readRecipients(self, text, maxInMemory=1000000):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'recipients.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(text)
+        reader = bulksender.RecipientReader(path, maxInMemory)
+        return reader, list(reader)
+
+    def test_duplicates(self):
+        reader, addresses = self.readRecipients('email\nana@example.com, bob@EXAMPLE.com\n'
+                                                '<ana@example.COM>\n\ncarl@example.com,bob@example.com\n')
+        self.assertEqual(addresses, ['ana@example.com', 'bob@example.com', 'carl@example.com'])
+        self.assertEqual((reader.read, reader.invalid, reader.duplicates), (6, 1, 2))
+
+    def test_duplicatesAfterSpill(self):
+        """
+        Pasado maxInMemory las direcciones se siguen comparando contra las que quedaron en sqlite.
+        """
+        reader, addresses = self.readRecipients('a@x.com\nb@x.com\nc@x.com\na@x.com\nc@x.com\nd@x.com\n', 2)
+        self.assertEqual(addresses, ['a@x.com', 'b@x.com', 'c@x.com', 'd@x.com'])
+        self.assertEqual(reader.duplicates, 2)
+
+    def test_readsLazily(self):
+        """
+        Las direcciones salen a medida que se lee el archivo, sin cargarlo completo antes del primer envio.
+        """
+        reader = bulksender.RecipientReader(self.readRecipients('a@x.com\nb@x.com\nc@x.com\n')[0].path)
+        addresses = iter(reader)
+        self.assertEqual(next(addresses), 'a@x.com')
+        self.assertEqual(reader.read, 1)
+        self.assertEqual(list(addresses), ['b@x.com', 'c@x.com'])
+        self.assertEqual(reader.read, 3)
+
+    def test_quotedNameWithComma(self):
+        reader, addresses = self.readRecipients('"Perez, Ana" <ana@example.com>,bob@example.com\n'
+                                                '"Perez, Ana" <ana@EXAMPLE.com>\n')
+        self.assertEqual(addresses, ['ana@example.com', 'bob@example.com'])
+        self.assertEqual(reader.duplicates, 1)
+
+    def test_seenAddressesSpill(self):
+        """
+        Al llegar a maxInMemory el set pasa a sqlite y se vacia; las direcciones anteriores siguen contando.
+        """
+        seen = bulksender.SeenAddresses(3)
+        self.addCleanup(seen.close)
+        self.assertEqual([seen.add(address) for address in ('a@x.com', 'b@x.com', 'c@x.com')], [True] * 3)
+        self.assertEqual(seen.addresses, set())
+        self.assertEqual([seen.add(address) for address in ('b@x.com', 'd@x.com', 'd@x.com')], [False, True, False])
+        dbFile = seen.dbFile.name
+        seen.close()
+        self.assertFalse(os.path.exists(dbFile))
+
+class SenderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.bulk = bulksender.BulkSender('yo@example.com', lambda domain: (domain, 25), batchSize=2,
+                                          maxAttempts=3, retryDelay=10, maxRetryDelay=15, reactor=self.reactor)
+
+    def send(self, addresses):
+        return self.bulk.send(addresses, lambda recipients: b'Subject: hola\r\n\r\nhola\r\n')
+
+    def session(self, factory):
+        session = factory.buildProtocol(None)
+        self.assertEqual(session.getMailFrom(), 'yo@example.com')
+        return session
+
+    def refuse(self, factory):
+        factory.clientConnectionFailed(None, failure.Failure(error.ConnectionRefusedError()))
+
+    def test_temporaryRejectionWaits(self):
+        """
+        Un 4xx de un destinatario lo vuelve a encolar solo despues de retryDelay; los aceptados no se repiten.
+        """
+        done = self.send(['a@uno.com', 'b@uno.com'])
+        [factory] = self.reactor.connections
+        session = self.session(factory)
+        self.assertEqual(session.getMailTo(), ['a@uno.com', 'b@uno.com'])
+        session.sentMail(250, b'ok', 1, [('a@uno.com', 250, b'ok'), ('b@uno.com', 451, b'later')], None)
+        session.finished = True
+        self.bulk.sessionEnded(factory.destination, False, 'done')
+        self.assertEqual((self.bulk.queued, self.bulk.delayed), (0, 1))
+        self.assertNoResult(done)
+
+        self.reactor.advance(10)
+        self.assertEqual(len(self.reactor.connections), 2)
+        session = self.session(self.reactor.connections[1])
+        self.assertEqual(session.getMailTo(), ['b@uno.com'])
+        session.sentMail(250, b'ok', 1, [('b@uno.com', 250, b'ok')], None)
+        self.bulk.sessionEnded(factory.destination, False, 'done')
+        self.assertIdentical(self.successResultOf(done), self.bulk)
+        self.assertEqual((self.bulk.sent, self.bulk.failed), (2, []))
+
+    def test_hostBackoff(self):
+        """
+        Un destino que rechaza la conexion espera retryDelay, luego el doble sin pasar maxRetryDelay, y a los
+        maxAttempts fallos sus mensajes fallan.
+        """
+        done = self.send(['a@uno.com'])
+        self.refuse(self.reactor.connections[0])
+        self.reactor.advance(9)
+        self.assertEqual(len(self.reactor.connections), 1)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.reactor.connections), 2)
+
+        self.refuse(self.reactor.connections[1])
+        self.reactor.advance(14)
+        self.assertEqual(len(self.reactor.connections), 2)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.reactor.connections), 3)
+
+        self.refuse(self.reactor.connections[2])
+        self.assertEqual(self.bulk.failed, [('a@uno.com', -1, 'Connection was refused by other side.')])
+        self.successResultOf(done)
+
+    def test_acceptedMessageResetsHostFailures(self):
+        self.send(['a@uno.com', 'b@uno.com', 'c@uno.com'])
+        self.refuse(self.reactor.connections[0])
+        self.reactor.advance(10)
+        session = self.session(self.reactor.connections[1])
+        session.sentMail(250, b'ok', 2, [('a@uno.com', 250, b'ok'), ('b@uno.com', 250, b'ok')], None)
+        self.assertEqual(self.bulk.connectFailures, {})
+        self.assertEqual(self.bulk.hostBackoff, {})
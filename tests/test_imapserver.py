@@ -0,0 +1,429 @@
+"""
+Pruebas de los contadores de STATUS de IMAPMailbox: MESSAGES, RECENT, UIDNEXT y UNSEEN despues de entregas,
+STORE, EXPUNGE y mensajes borrados por fuera del servidor. Sin inotify, el buzon revisa el mtime de cur/ y new/.
+Tambien las vistas de cada sesion con sus EXPUNGE pendientes, el registro de cuentas compartidas y las lecturas
+y renombres que corren en el pool de disco.
+
+python3 -m twisted.trial tests
+"""
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, task
+from twisted.mail import imap4
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+import diskio
+import IMAPserver
+import mailmetadata
+import searchindex
+from tests.test_mailmetadata import ManualDisk
+
+
+STATUS = ['MESSAGES', 'RECENT', 'UIDNEXT', 'UNSEEN']
+
+
+class MaildirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        diskio.diskPool.synchronous = True
+        self.addCleanup(setattr, diskio.diskPool, 'synchronous', False)
+        self.patch(IMAPserver, 'getNotifier', lambda: None)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for name in ('cur', 'new', 'tmp', '.Trash/cur', '.Trash/new', '.Trash/tmp'):
+            os.makedirs(os.path.join(self.directory, name))
+        self.delivered = 0
+
+    def deliver(self, count=1):
+        paths = []
+        for i in range(count):
+            self.delivered += 1
+            path = os.path.join(self.directory, 'new', '1600000000.M%dP1.host' % (self.delivered,))
+            with open(path, 'wb') as messageFile:
+                messageFile.write(b'Subject: %d\r\n\r\nhola\r\n' % (self.delivered,))
+            paths.append(path)
+        # El mtime del directorio cambia con cada archivo, pero puede caer en el mismo tick que la ultima revision.
+        for name in ('cur', 'new'):
+            os.utime(os.path.join(self.directory, name), ns=(0, self.delivered))
+        return paths
+
+    def open(self):
+        mailbox = IMAPserver.IMAPMailbox(self.directory)
+        self.addCleanup(self.closeMailbox, mailbox)
+        return mailbox
+
+    def closeMailbox(self, mailbox):
+        mailbox.close()
+        index = searchindex.openIndexes.pop(os.path.abspath(self.directory), None)
+        if index is not None:
+            index.close()
+
+
+
+class StatusTests(MaildirTestCase):
+
+    def status(self, mailbox):
+        return self.successResultOf(mailbox.requestStatus(STATUS))
+
+    def markSeen(self, mailbox, messages):
+        self.successResultOf(mailbox.store(imap4.parseIdList(messages), ['\\Seen'], 1, False))
+
+    def test_counters(self):
+        self.deliver(3)
+        mailbox = self.open()
+        self.assertEqual(self.status(mailbox), {'MESSAGES': 3, 'RECENT': 3, 'UIDNEXT': 4, 'UNSEEN': 3})
+        self.markSeen(mailbox, b'1:2')
+        mailbox.claimRecent()
+        self.deliver()
+        self.assertEqual(self.status(mailbox), {'MESSAGES': 4, 'RECENT': 4, 'UIDNEXT': 5, 'UNSEEN': 2})
+
+    def test_expunge(self):
+        self.deliver(3)
+        mailbox = self.open()
+        self.markSeen(mailbox, b'1:2')
+        self.successResultOf(mailbox.store(imap4.parseIdList(b'1'), ['\\Deleted'], 1, False))
+        self.assertEqual(self.successResultOf(mailbox.expunge()), [1])
+        self.assertEqual(self.status(mailbox), {'MESSAGES': 2, 'RECENT': 2, 'UIDNEXT': 4, 'UNSEEN': 1})
+
+    def test_removedWhileOpen(self):
+        """
+        Un mensaje leido que otro cliente borra deja de contar en MESSAGES y su \\Seen no resta de UNSEEN.
+        """
+        first, second = self.deliver(2)
+        mailbox = self.open()
+        self.markSeen(mailbox, b'1')
+        os.remove(first)
+        self.deliver()
+        self.assertEqual(self.status(mailbox)['MESSAGES'], 2)
+        self.assertEqual(self.status(mailbox)['UNSEEN'], 2)
+
+    def test_removedWhileClosed(self):
+        paths = self.deliver(3)
+        mailbox = self.open()
+        self.markSeen(mailbox, b'1:3')
+        self.successResultOf(mailbox.metadataStore.flush())
+        self.closeMailbox(mailbox)
+        os.remove(paths[0])
+        os.remove(paths[1])
+
+        reopened = self.open()
+        self.assertEqual(reopened.metadataStore.seenCount, 1)
+        self.assertEqual(self.status(reopened), {'MESSAGES': 1, 'RECENT': 1, 'UIDNEXT': 4, 'UNSEEN': 0})
+
+    def test_staleSeenBitsDoNotMakeUnseenNegative(self):
+        """
+        Flags de uids que ya no estan en la secuencia, escritos por otro proceso, no cuentan.
+        """
+        self.deliver(2)
+        mailbox = self.open()
+        mailbox.metadataStore.setFlags(90, ['\\Seen'])
+        mailbox.metadataStore.setFlags(91, ['\\Seen'])
+        mailbox.metadataStore.setFlags(92, ['\\Seen'])
+        self.assertEqual(self.status(mailbox)['UNSEEN'], 2)
+        self.markSeen(mailbox, b'2')
+        self.assertEqual(self.status(mailbox)['UNSEEN'], 1)
+
+    def test_orphanFlagsAreForgotten(self):
+        """
+        Si el contador de \\Seen pasa de MESSAGES se borran de la FlagTable los flags sin mensaje, tambien
+        para los demas procesos, y el contador vuelve a ser exacto.
+        """
+        self.deliver(2)
+        mailbox = self.open()
+        self.markSeen(mailbox, b'1')
+        for uid in (90, 91):
+            mailbox.metadataStore.setFlags(uid, ['\\Seen'])
+        self.assertEqual(mailbox.metadataStore.seenCount, 3)
+        self.assertEqual(self.status(mailbox)['UNSEEN'], 1)
+        self.assertEqual(mailbox.metadataStore.seenCount, 1)
+        self.assertNotIn(90, mailbox.metadata['flags'])
+        self.successResultOf(mailbox.metadataStore.flush())
+
+        other = self.open()
+        self.assertEqual(other.metadataStore.seenCount, 1)
+        self.assertEqual(self.status(other)['UNSEEN'], 1)
+
+    def test_otherProcessStore(self):
+        self.deliver(2)
+        first = self.open()
+        second = self.open()
+        self.markSeen(first, b'1:2')
+        self.successResultOf(first.metadataStore.flush())
+        self.assertEqual(self.status(second)['UNSEEN'], 0)
+
+
+class UIDTests(MaildirTestCase):
+
+    def write(self, name):
+        path = os.path.join(self.directory, 'new', name)
+        with open(path, 'wb') as messageFile:
+            messageFile.write(b'Subject: %s\r\n\r\nhola\r\n' % (name.encode(),))
+        os.utime(os.path.join(self.directory, 'new'), ns=(0, len(os.listdir(os.path.join(self.directory, 'new')))))
+        return path
+
+    def fetchUIDs(self, mailbox, messages):
+        fetched = self.successResultOf(mailbox.fetch(imap4.parseIdList(messages), True))
+        return sorted((seq, message.getUID(), os.path.basename(message.path)) for seq, message in fetched)
+
+    def test_outOfOrderDelivery(self):
+        """
+        Si otro proceso asigno los uids en otro orden que el del listado, el mensaje de uid menor se inserta en
+        su lugar y UID FETCH sigue ubicando cada rango con bisect.
+        """
+        self.write('1600000000.M1P1.host')
+        self.write('1600000000.M2P1.host')
+        mailbox = self.open()
+        other = mailmetadata.MetadataStore(self.directory)
+        self.addCleanup(other.close)
+        self.write('1600000000.M9P1.host')
+        self.write('1600000000.M5P1.host')
+        self.assertEqual(other.assignUID('1600000000.M9P1.host'), 3)
+        self.assertEqual(other.assignUID('1600000000.M5P1.host'), 4)
+        self.successResultOf(mailbox.sync())
+
+        self.assertEqual(mailbox.uidList, [1, 2, 3, 4])
+        self.assertEqual(self.fetchUIDs(mailbox, b'3:*'), [(3, 3, '1600000000.M9P1.host'),
+                                                          (4, 4, '1600000000.M5P1.host')])
+        self.assertEqual(self.fetchUIDs(mailbox, b'2,4'), [(2, 2, '1600000000.M2P1.host'),
+                                                          (4, 4, '1600000000.M5P1.host')])
+        self.assertEqual(self.fetchUIDs(mailbox, b'5:7'), [])
+
+    def test_uidRangesAfterExpunge(self):
+        self.deliver(5)
+        mailbox = self.open()
+        self.successResultOf(mailbox.store(imap4.parseIdList(b'2,4'), ['\\Deleted'], 1, False))
+        self.assertEqual(self.successResultOf(mailbox.expunge()), [4, 2])
+        self.assertEqual([(seq, uid) for seq, uid, name in self.fetchUIDs(mailbox, b'2:5')], [(2, 3), (3, 5)])
+        self.assertEqual(mailbox.uidList, [1, 3, 5])
+
+class DiskTests(MaildirTestCase):
+
+    """
+    El listado de cur/ y new/ y los renombres de EXPUNGE corren en el pool de disco, no en el reactor.
+    """
+
+    def setUp(self):
+        MaildirTestCase.setUp(self)
+        self.disk = ManualDisk()
+        self.patch(IMAPserver, 'deferToDisk', self.disk)
+
+    def runCall(self, function):
+        [call] = [call for call in self.disk.calls if call[1] is function]
+        self.disk.calls.remove(call)
+        d, function, args, kwargs = call
+        d.callback(function(*args, **kwargs))
+
+    def test_syncListsInPool(self):
+        """
+        Una sincronizacion pedida mientras otra lee el directorio espera a la siguiente lectura.
+        """
+        self.deliver(2)
+        mailbox = self.open()
+        self.disk.run()
+        [path] = self.deliver()
+        first = mailbox.sync()
+        second = mailbox.sync()
+        self.assertEqual([call[1] for call in self.disk.calls], [IMAPserver.scanDirectories])
+        self.assertNoResult(first)
+
+        self.runCall(IMAPserver.scanDirectories)
+        self.assertEqual(self.successResultOf(first), ([path], set()))
+        self.assertNoResult(second)
+        self.assertEqual(mailbox.getMessageCount(), 3)
+        self.disk.run()
+        self.assertEqual(self.successResultOf(second), ([], set()))
+
+    def test_expungeMovesInPool(self):
+        """
+        Un listado hecho mientras el pool mueve los archivos a .Trash no los vuelve a agregar.
+        """
+        paths = self.deliver(3)
+        mailbox = self.open()
+        self.disk.run()
+        mailbox.store(imap4.parseIdList(b'2'), ['\\Deleted'], 1, False)
+        self.disk.run()
+
+        expunged = mailbox.expunge()
+        self.runCall(IMAPserver.scanDirectories)
+        self.assertEqual(mailbox.uidList, [1, 3])
+        self.assertTrue(os.path.exists(paths[1]))
+        self.deliver()
+        synced = mailbox.sync()
+        self.runCall(IMAPserver.scanDirectories)
+        self.assertEqual(self.successResultOf(synced)[0], [os.path.join(self.directory, 'new',
+                                                                        '1600000000.M4P1.host')])
+        self.assertNoResult(expunged)
+
+        self.disk.run()
+        self.assertEqual(self.successResultOf(expunged), [2])
+        self.assertFalse(os.path.exists(paths[1]))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, '.Trash', 'cur', os.path.basename(paths[1]))))
+        self.assertEqual(mailbox.uidList, [1, 3, 4])
+        self.assertNotIn(os.path.basename(paths[1]), mailbox.metadata['uids'])
+
+def runNow(iterator):
+    # Reemplaza a iterateInReactor: las respuestas del FETCH se escriben sin pasar por el reactor.
+    for ignored in iterator:
+        pass
+    return defer.succeed(None)
+
+
+class Listener(object):
+
+    def __init__(self):
+        self.events = []
+
+    def newMessages(self, exists, recent):
+        self.events.append(('exists', exists))
+
+    def expungesPending(self):
+        self.events.append(('expunge',))
+
+
+class ViewTests(MaildirTestCase):
+
+    """
+    Cada sesion ve el buzon compartido de la cuenta a traves de su MailboxView.
+    """
+
+    def view(self, mailbox):
+        view = IMAPserver.MailboxView(mailbox)
+        listener = Listener()
+        view.addListener(listener)
+        self.addCleanup(view.close)
+        return view, listener
+
+    def protocol(self, view):
+        protocol = IMAPserver.IMAPServerProtocol(scheduler=runNow)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        self.addCleanup(protocol.setTimeout, None)
+        protocol.state = 'select'
+        protocol.mbox = view
+        view.addListener(protocol)
+        transport.clear()
+        return protocol, transport
+
+    def test_expungeByOtherSession(self):
+        """
+        Los mensajes que elimina otra sesion siguen en la secuencia hasta que esta sesion recibe sus EXPUNGE.
+        """
+        self.deliver(3)
+        mailbox = self.open()
+        first, ignored = self.view(mailbox)
+        second, listener = self.view(mailbox)
+        self.successResultOf(first.store(imap4.parseIdList(b'2'), ['\\Deleted'], 1, False))
+        self.assertEqual(self.successResultOf(first.expunge()), [2])
+        self.assertEqual(first.getMessageCount(), 2)
+
+        self.assertEqual(listener.events, [('expunge',)])
+        self.assertEqual(second.getMessageCount(), 3)
+        fetched = self.successResultOf(second.fetch(imap4.parseIdList(b'1:3'), False))
+        self.assertEqual([seq for seq, message in fetched], [1, 3])
+        self.assertEqual(second.getUID(3), 3)
+        self.assertEqual(second.takeExpunges(), [2])
+        self.assertEqual((second.getMessageCount(), second.getUID(2)), (2, 3))
+
+    def test_removedOutsideServer(self):
+        paths = self.deliver(4)
+        mailbox = self.open()
+        view, listener = self.view(mailbox)
+        os.remove(paths[0])
+        os.remove(paths[2])
+        self.deliver()
+        self.successResultOf(mailbox.sync())
+        self.assertEqual(listener.events, [('expunge',), ('exists', 5)])
+        self.assertEqual(view.takeExpunges(), [3, 1])
+        self.assertEqual(view.uidList, [2, 4, 5])
+        self.assertEqual(view.takeExpunges(), [])
+
+    def test_expungeWaitsForAllowedCommand(self):
+        """
+        FETCH sin UID no puede recibir EXPUNGE; el siguiente NOOP los envia antes de su respuesta.
+        """
+        paths = self.deliver(3)
+        mailbox = self.open()
+        view = IMAPserver.MailboxView(mailbox)
+        protocol, transport = self.protocol(view)
+        os.remove(paths[1])
+        self.deliver()
+
+        protocol.dataReceived(b'A1 FETCH 1:* (FLAGS)\r\n')
+        response = transport.value()
+        transport.clear()
+        self.assertNotIn(b'EXPUNGE', response)
+        self.assertIn(b'* 4 EXISTS', response)
+        self.assertIn(b'* 3 FETCH', response)
+        self.assertIn(b'A1 OK', response)
+
+        protocol.dataReceived(b'A2 NOOP\r\n')
+        self.assertEqual(transport.value().split(b'\r\n')[:2], [b'* 2 EXPUNGE', b'A2 OK NOOP No operation performed'])
+
+        protocol.connectionLost(None)
+        self.assertEqual(mailbox.views, [])
+
+
+    def test_idlePushesDelivery(self):
+        """
+        Una entrega del servidor SMTP del mismo proceso llega a los clientes en IDLE como EXISTS, y lo que
+        elimina otra sesion como EXPUNGE, sin que el cliente envie nada.
+        """
+        clock = task.Clock()
+        self.patch(IMAPserver, 'reactor', clock)
+        self.deliver(3)
+        mailbox = self.open()
+        view = IMAPserver.MailboxView(mailbox)
+        protocol, transport = self.protocol(view)
+        other, ignored = self.view(mailbox)
+        protocol.dataReceived(b'A1 IDLE\r\n')
+        self.assertEqual(transport.value(), b'+\r\n')
+        transport.clear()
+
+        [path] = self.deliver()
+        IMAPserver.deliveryReceived(self.directory, path)
+        self.assertEqual(transport.value(), b'')
+        clock.advance(0)
+        self.assertEqual(transport.value(), b'* 4 EXISTS\r\n* 4 RECENT\r\n')
+        transport.clear()
+
+        self.successResultOf(other.store(imap4.parseIdList(b'1'), ['\\Deleted'], 1, False))
+        self.successResultOf(other.expunge())
+        self.assertEqual(transport.value(), b'* 1 EXPUNGE\r\n')
+        self.assertEqual(view.getMessageCount(), 3)
+        transport.clear()
+
+        protocol.dataReceived(b'DONE\r\n')
+        self.assertEqual(transport.value(), b'A1 OK IDLE terminated\r\n')
+
+class RegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(IMAPserver, 'getNotifier', lambda: None)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.clock = task.Clock()
+        self.registry = IMAPserver.AccountRegistry(60, self.clock)
+
+    def test_sessionsShareTheAccount(self):
+        account = self.registry.acquire(b'ana', self.directory)
+        self.assertIdentical(self.registry.acquire(b'ana', self.directory), account)
+        self.registry.release(b'ana')
+        self.clock.advance(60)
+        self.assertIn(b'ana', self.registry.accounts)
+        self.registry.release(b'ana')
+        self.clock.advance(59)
+        self.assertIn(b'ana', self.registry.accounts)
+        self.clock.advance(1)
+        self.assertNotIn(b'ana', self.registry.accounts)
+
+    def test_loginCancelsEviction(self):
+        account = self.registry.acquire(b'ana', self.directory)
+        self.registry.release(b'ana')
+        self.clock.advance(30)
+        self.assertIdentical(self.registry.acquire(b'ana', self.directory), account)
+        self.clock.advance(60)
+        self.assertIn(b'ana', self.registry.accounts)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,334 @@
+"""
+Pruebas del metadata de buzones: la FlagTable, la reproduccion del log al abrir, la escritura en grupo de los
+cambios pendientes y la compactacion, tambien con dos stores sobre el mismo buzon como dos procesos.
+
+python3 -m twisted.trial tests
+"""
+import os
+import pickle
+import shutil
+import tempfile
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+import diskio
+import mailmetadata
+
+
+class ManualDisk(object):
+
+    """
+    Reemplazo de deferToDisk que guarda las operaciones hasta que la prueba llama run.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, function, *args, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((d, function, args, kwargs))
+        return d
+
+    def run(self):
+        while self.calls:
+            d, function, args, kwargs = self.calls.pop(0)
+            d.callback(function(*args, **kwargs))
+
+
+class FlagTableTests(unittest.TestCase):
+
+    def test_updateModes(self):
+        table = mailmetadata.FlagTable({1: ['\\Seen'], 2: ['\\Seen', '\\Flagged'], 3: []})
+        table.update([1, 3], ['\\Deleted'], 1)
+        table.update([2], ['\\Seen'], -1)
+        table.update([3], ['foo'], 0)
+        self.assertEqual(sorted(table[1]), ['\\Deleted', '\\Seen'])
+        self.assertEqual(table[2], ['\\Flagged'])
+        self.assertEqual(table[3], ['foo'])
+        self.assertEqual(table.withFlag('\\Deleted'), [1])
+
+    def test_bulkUpdateMatchesSingleUpdates(self):
+        """
+        Sobre BULK_THRESHOLD uids update usa mascaras; el resultado es el mismo que mensaje por mensaje.
+        """
+        uids = list(range(1, 3 * mailmetadata.BULK_THRESHOLD))
+        bulk = mailmetadata.FlagTable(dict((uid, ['\\Seen'] if uid % 3 else []) for uid in uids))
+        single = mailmetadata.FlagTable(dict(bulk.items()))
+        bulk.update(uids[::2], ['\\Seen', '\\Answered'], 1)
+        for uid in uids[::2]:
+            single.update([uid], ['\\Seen', '\\Answered'], 1)
+        self.assertEqual(dict(bulk.items()), dict(single.items()))
+        self.assertEqual(bulk.withFlag('\\Answered'), uids[::2])
+
+    def test_setAndClear(self):
+        """
+        Asignar una lista reemplaza los bits de todos los flags; un mensaje sin flags sigue presente.
+        """
+        table = mailmetadata.FlagTable()
+        table[3] = ['\\Seen', '\\Flagged']
+        table[9] = ['\\seen']
+        self.assertEqual(table.withFlag('\\SEEN'), [3, 9])
+        table[3] = ['\\Flagged']
+        self.assertEqual(table.withFlag('\\Seen'), [9])
+        table[9] = []
+        self.assertEqual(table.withFlag('\\Seen'), [])
+        self.assertEqual((9 in table, table[9], len(table)), (True, [], 2))
+        self.assertEqual(table.pop(3), ['\\Flagged'])
+        self.assertEqual((3 in table, table.withFlag('\\Flagged'), table.withFlag('foo')), (False, [], []))
+        self.assertFalse(table.has(3, '\\Flagged'))
+
+    def test_largeUIDs(self):
+        table = mailmetadata.FlagTable({100000: ['\\Deleted'], 7: ['\\Deleted']})
+        table.update([100000], ['\\Deleted'], -1)
+        self.assertEqual(table.withFlag('\\Deleted'), [7])
+        self.assertEqual(table.items(), [(7, ['\\Deleted']), (100000, [])])
+
+    def test_count(self):
+        table = mailmetadata.FlagTable({1: ['\\Seen'], 2: ['\\Seen'], 5: ['\\Seen'], 7: []})
+        self.assertEqual(table.count('\\Seen'), 3)
+        self.assertEqual(table.count('\\Seen', [2, 5, 7]), 2)
+        self.assertEqual(table.count('\\Draft'), 0)
+        table.pop(5)
+        self.assertEqual(table.count('\\Seen'), 2)
+
+    def test_pickle(self):
+        table = mailmetadata.FlagTable({1: ['\\Seen'], 4: ['\\Deleted', 'foo']})
+        copy = pickle.loads(pickle.dumps(table, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(dict(copy.items()), dict(table.items()))
+
+
+class MetadataStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        diskio.diskPool.synchronous = True
+        self.addCleanup(setattr, diskio.diskPool, 'synchronous', False)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.clock = task.Clock()
+
+    def open(self, durability='none'):
+        store = mailmetadata.MetadataStore(self.directory, durability, self.clock)
+        self.addCleanup(store.close)
+        return store
+
+    def logSize(self):
+        return os.path.getsize(os.path.join(self.directory, '.imap-metadata.log'))
+
+    def test_replay(self):
+        store = self.open()
+        self.assertEqual([store.assignUID(name) for name in ('a', 'b', 'c')], [1, 2, 3])
+        store.storeFlags([1, 2], ['\\Seen'], 1)
+        store.setFlags(3, ['\\Deleted'])
+        store.expunge('b')
+        store.set('subscribed', ['Inbox'])
+        self.successResultOf(store.close())
+
+        reopened = self.open()
+        self.assertEqual(reopened.data['uids'], {'a': 1, 'c': 3})
+        self.assertEqual(reopened.data['uidnext'], 4)
+        self.assertEqual(dict(reopened.data['flags'].items()), {1: ['\\Seen'], 3: ['\\Deleted']})
+        self.assertEqual(reopened.get('subscribed'), ['Inbox'])
+        self.assertEqual(reopened.seenCount, 1)
+
+    def test_tornRecordIsTruncated(self):
+        store = self.open()
+        store.assignUID('a')
+        self.successResultOf(store.close())
+        size = self.logSize()
+        with open(os.path.join(self.directory, '.imap-metadata.log'), 'ab') as logFile:
+            logFile.write(pickle.dumps(('uid', 'b', 2), pickle.HIGHEST_PROTOCOL)[:-3])
+
+        reopened = self.open()
+        self.assertEqual(reopened.data['uids'], {'a': 1})
+        self.assertEqual(self.logSize(), size)
+        self.assertEqual(reopened.assignUID('b'), 2)
+
+    def test_pendingChangesWaitForTheTimer(self):
+        """
+        Los cambios de flags se ven al instante pero llegan al log en una sola escritura despues de flushDelay.
+        """
+        store = self.open()
+        store.assignUID('a')
+        size = self.logSize()
+        store.setFlags(1, ['\\Seen'])
+        store.storeFlags([1], ['\\Flagged'], 1)
+        self.assertEqual(sorted(store.data['flags'][1]), ['\\Flagged', '\\Seen'])
+        self.assertEqual(self.logSize(), size)
+
+        writes = store.writes
+        self.clock.advance(mailmetadata.flushDelay)
+        self.assertGreater(self.logSize(), size)
+        self.assertEqual(store.writes, writes + 1)
+        self.assertEqual(store.stats()['pending'], 0)
+
+    def test_alwaysWritesEachChange(self):
+        store = self.open('always')
+        store.assignUID('a')
+        size = self.logSize()
+        store.setFlags(1, ['\\Seen'])
+        self.assertGreater(self.logSize(), size)
+        self.assertEqual(store.stats()['pending'], 0)
+
+    def test_otherProcessChanges(self):
+        """
+        Un cambio pendiente sigue aplicado despues de leer lo que otro store escribio.
+        """
+        first = self.open()
+        second = self.open()
+        first.assignUID('a')
+        second.refresh()
+        second.setFlags(1, ['\\Seen'])
+        self.assertEqual(first.assignUID('b'), 2)
+        second.refresh()
+        self.assertEqual(second.data['uids'], {'a': 1, 'b': 2})
+        self.assertEqual(second.data['flags'][1], ['\\Seen'])
+
+        self.successResultOf(second.flush())
+        first.refresh()
+        self.assertEqual(first.data['flags'][1], ['\\Seen'])
+        self.assertEqual(second.assignUID('c'), 3)
+
+    def test_compaction(self):
+        store = self.open()
+        for name in ('a', 'b', 'c'):
+            store.assignUID(name)
+        store.setFlags(2, ['\\Seen'])
+        self.successResultOf(store.compact())
+        self.assertEqual(self.logSize(), 0)
+
+        reopened = self.open()
+        self.assertEqual(reopened.data['uids'], {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(reopened.data['flags'][2], ['\\Seen'])
+
+    def test_recordsWrittenDuringCompactionAreKept(self):
+        """
+        Lo que llega al log mientras la foto se escribe en el pool pasa al final de la foto.
+        """
+        store = self.open()
+        store.assignUID('a')
+        disk = ManualDisk()
+        self.patch(mailmetadata, 'deferToDisk', disk)
+        compacting = store.compact()
+        store.assignUID('b')
+        disk.run()
+        self.successResultOf(compacting)
+        self.assertEqual(self.logSize(), 0)
+
+        reopened = self.open()
+        self.assertEqual(reopened.data['uids'], {'a': 1, 'b': 2})
+
+    def test_compactionByOtherStore(self):
+        first = self.open()
+        second = self.open()
+        first.assignUID('a')
+        second.refresh()
+        first.assignUID('b')
+        self.successResultOf(first.compact())
+        first.assignUID('c')
+        second.refresh()
+        self.assertEqual(second.data['uids'], {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(second.assignUID('d'), 4)
+
+    def test_automaticCompaction(self):
+        """
+        Cuando el log pasa de COMPACT_MIN_RECORDS y del doble de mensajes se escribe una foto nueva.
+        """
+        self.patch(mailmetadata, 'COMPACT_MIN_RECORDS', 4)
+        store = self.open('always')
+        store.assignUID('a')
+        store.assignUID('b')
+        for i in range(4):
+            store.setFlags(1, ['\\Seen'] if i % 2 else [])
+        self.assertLess(store.logRecords, 4)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, '.imap-metadata.pickle')))
+        reopened = self.open()
+        self.assertEqual(reopened.data['uids'], {'a': 1, 'b': 2})
+        self.assertEqual(reopened.data['flags'][1], ['\\Seen'])
+
+    def test_automaticCompactionOfFlushedGroups(self):
+        """
+        Los cambios de flags escritos en grupo por el pool tambien cuentan para compactar, sin esperar a que se
+        asigne otro uid.
+        """
+        self.patch(mailmetadata, 'COMPACT_MIN_RECORDS', 4)
+        store = self.open()
+        store.assignUID('a')
+        store.assignUID('b')
+        for i in range(3):
+            store.setFlags(1, ['\\Seen'])
+            store.storeFlags([2], ['\\Flagged'], 1 if i % 2 else -1)
+            self.clock.advance(mailmetadata.flushDelay)
+        self.assertLessEqual(store.logRecords, 4)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, '.imap-metadata.pickle')))
+        reopened = self.open()
+        self.assertEqual(dict(reopened.data['flags'].items()), {1: ['\\Seen'], 2: []})
+
+    def test_ownGroupIsNotReadBack(self):
+        """
+        Un grupo que queda al final del log avanza la posicion leida; refresh no lo vuelve a aplicar.
+        """
+        store = self.open()
+        store.assignUID('a')
+        store.setFlags(1, ['\\Seen'])
+        self.successResultOf(store.flush())
+        self.assertEqual(store.logOffset, self.logSize())
+        self.assertEqual(store.logRecords, 2)
+
+    def test_flagTableThroughSnapshot(self):
+        """
+        La foto guarda la FlagTable como diccionario de listas y al abrirla se vuelve a armar con los mismos bits.
+        """
+        store = self.open()
+        for name in ('a', 'b', 'c', 'd'):
+            store.assignUID(name)
+        store.storeFlags([1, 2, 3], ['\\Seen'], 1)
+        store.storeFlags([2, 4], ['\\Deleted', 'Etiqueta'], 1)
+        store.storeFlags([3], ['\\Seen'], -1)
+        self.successResultOf(store.compact())
+        with open(os.path.join(self.directory, '.imap-metadata.pickle'), 'rb') as snapshot:
+            self.assertIs(type(pickle.load(snapshot)['flags']), dict)
+
+        reopened = self.open()
+        flags = reopened.data['flags']
+        self.assertIsInstance(flags, mailmetadata.FlagTable)
+        self.assertEqual(dict((uid, sorted(names)) for uid, names in flags.items()),
+                         dict((uid, sorted(names)) for uid, names in store.data['flags'].items()))
+        self.assertEqual((flags.withFlag('\\Seen'), flags.withFlag('\\Deleted'), flags.withFlag('Etiqueta')),
+                         ([1, 2], [2, 4], [2, 4]))
+        self.assertEqual(reopened.seenCount, 2)
+
+    def test_oldSnapshotWithFlagLists(self):
+        """
+        Los .imap-metadata.pickle anteriores guardan los flags como un diccionario de listas.
+        """
+        with open(os.path.join(self.directory, '.imap-metadata.pickle'), 'wb') as snapshot:
+            pickle.dump({'uids': {'a': 1, 'b': 2}, 'uidnext': 3, 'flags': {1: ['\\Seen'], 2: []}}, snapshot)
+        store = self.open()
+        self.assertIsInstance(store.data['flags'], mailmetadata.FlagTable)
+        self.assertEqual(store.seenCount, 1)
+        self.assertEqual(store.assignUID('c'), 3)
+
+    def test_oldSnapshotIsNotRewritten(self):
+        """
+        Un .imap-metadata.pickle de antes del log se lee tal cual; los uids nuevos van al log y la foto no se
+        vuelve a escribir por cada mensaje.
+        """
+        snapshotFile = os.path.join(self.directory, '.imap-metadata.pickle')
+        with open(snapshotFile, 'wb') as snapshot:
+            pickle.dump({'uids': {'a': 1}, 'uidnext': 2, 'uidvalidity': 1234567, 'flags': {1: ['\\Seen']}},
+                        snapshot)
+        before = os.stat(snapshotFile)
+        store = self.open('always')
+        sizes = [self.logSize()]
+        for name in ('b', 'c', 'd'):
+            store.assignUID(name)
+            sizes.append(self.logSize())
+
+        self.assertEqual((os.stat(snapshotFile).st_mtime_ns, os.stat(snapshotFile).st_size),
+                         (before.st_mtime_ns, before.st_size))
+        self.assertEqual(store.logRecords, 3)
+        self.assertEqual(len(set(after - size for size, after in zip(sizes, sizes[1:]))), 1)
+        reopened = self.open()
+        self.assertEqual(reopened.data['uids'], {'a': 1, 'b': 2, 'c': 3, 'd': 4})
+        self.assertEqual((reopened.get('uidvalidity'), reopened.data['flags'][1]), (1234567, ['\\Seen']))
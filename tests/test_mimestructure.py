@@ -0,0 +1,122 @@
+"""
+Pruebas del registro de estructura: ENVELOPE, BODY y BODYSTRUCTURE precalculados deben ser los mismos que
+calcula twisted.mail.imap4 sobre el arbol de partes, tambien con multiparts anidados, message/rfc822 y
+multipart/digest, y las partes se leen del archivo en los offsets del registro.
+
+python3 -m twisted.trial tests
+"""
+import io
+import os
+import shutil
+import tempfile
+
+from zope.interface import implementer
+
+from twisted.mail import imap4
+from twisted.trial import unittest
+
+import IMAPserver
+import mimestructure
+
+
+@implementer(imap4.IMessagePart)
+class FakePart(object):
+
+    """
+    Parte armada a mano para que twisted.mail.imap4 calcule la estructura de referencia. data() son los bytes
+    de la parte tal como quedan en el mensaje.
+    """
+
+    def __init__(self, headers, body=b'', parts=(), defaultType='text/plain'):
+        self.headers = headers
+        self.parts = list(parts)
+        self.defaultType = defaultType
+        self.body = body
+        contentType = dict((name.lower(), value) for name, value in headers).get('content-type', defaultType)
+        if contentType.startswith('multipart/'):
+            boundary = contentType.split('boundary="', 1)[1].split('"', 1)[0].encode()
+            self.body = b''.join(b'--' + boundary + b'\r\n' + part.data() + b'\r\n' for part in self.parts)
+            self.body += b'--' + boundary + b'--\r\n'
+        elif self.parts:
+            self.body = self.parts[0].data()
+
+    def data(self):
+        return b''.join(b'%s: %s\r\n' % (name.encode(), value.encode()) for name, value in self.headers) + \
+            b'\r\n' + self.body
+
+    def getHeaders(self, negate, *names):
+        names = set((name.decode() if isinstance(name, bytes) else name).lower() for name in names)
+        headers = dict((name.lower(), value) for name, value in self.headers if (name.lower() in names) != negate)
+        if not negate and 'content-type' in names and 'content-type' not in headers:
+            headers['content-type'] = self.defaultType
+        return headers
+
+    def getBodyFile(self):
+        return io.BytesIO(self.body)
+
+    def getSize(self):
+        return len(self.body)
+
+    def isMultipart(self):
+        return bool(self.parts)
+
+    def getSubPart(self, part):
+        return self.parts[part]
+
+
+def nestedMessage():
+    attached = FakePart([('From', 'carl@example.com'), ('Subject', 'adjunto')], b'cuerpo\r\nadjunto')
+    digested = FakePart([('From', 'x@example.com'), ('Subject', 'uno')], b'uno')
+    return FakePart(
+        [('From', 'Ana <ana@example.com>'), ('To', 'bob@example.com, "Perez, C" <c@example.com>'),
+         ('Subject', 'informe'), ('Date', 'Tue, 15 Sep 2020 10:00:00 +0000'), ('Message-ID', '<m1@example.com>'),
+         ('MIME-Version', '1.0'), ('Content-Type', 'multipart/mixed; boundary="ext"')],
+        parts=[
+            FakePart([('Content-Type', 'multipart/alternative; boundary="int"')], parts=[
+                FakePart([('Content-Type', 'text/plain; charset=utf-8')], b'hola\r\nmundo'),
+                FakePart([('Content-Type', 'text/html'), ('Content-Transfer-Encoding', 'quoted-printable')],
+                         b'<p>hola</p>')]),
+            FakePart([('Content-Type', 'message/rfc822')], parts=[attached]),
+            FakePart([('Content-Type', 'application/pdf; name="a.pdf"'),
+                      ('Content-Disposition', 'attachment; filename="a.pdf"'),
+                      ('Content-Transfer-Encoding', 'base64')], b'JVBERi0='),
+            FakePart([('Content-Type', 'multipart/digest; boundary="d"')], parts=[
+                FakePart([], parts=[digested], defaultType='message/rfc822')])])
+
+
+class StructureTests(unittest.TestCase):
+
+    def assertMatchesTwisted(self, message):
+        record = mimestructure.messageStructure(message.data())
+        self.assertEqual(record['envelope'], imap4.getEnvelope(message))
+        self.assertEqual(record['body'], imap4.getBodyStructure(message))
+        self.assertEqual(record['bodystructure'], imap4.getBodyStructure(message, True))
+        return record
+
+    def test_nestedMultipart(self):
+        record = self.assertMatchesTwisted(nestedMessage())
+        self.assertEqual(record['bodystructure'][-5], 'mixed')
+        self.assertEqual([part['type'] for part in record['parts']['parts']],
+                         ['multipart/alternative', 'message/rfc822', 'application/pdf', 'multipart/digest'])
+
+    def test_singlePart(self):
+        self.assertMatchesTwisted(FakePart([('From', 'ana@example.com'), ('Subject', 'hola')], b'uno\r\ndos\r\n'))
+
+    def test_partsReadFromFile(self):
+        """
+        BODY[1.2], BODY[2] y BODY[4.1] se leen del archivo en los offsets del registro.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        message = nestedMessage()
+        path = os.path.join(directory, '1600000000.M1P1.host')
+        with open(path, 'wb') as messageFile:
+            messageFile.write(message.data())
+
+        stored = IMAPserver.MaildirMessage(path, [], 1)
+        self.assertTrue(stored.isMultipart())
+        self.assertEqual(stored.getSubPart(0).getSubPart(1).getBodyFile().read(), b'<p>hola</p>')
+        self.assertEqual(stored.getSubPart(1).getBodyFile().read(), message.parts[1].body)
+        self.assertEqual(stored.getSubPart(3).getSubPart(0).getSize(), len(message.parts[3].parts[0].body))
+        self.assertEqual(stored.getSubPart(0).getSubPart(0).getHeaders(False, 'content-type'),
+                         {'content-type': 'text/plain; charset=utf-8'})
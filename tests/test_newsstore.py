@@ -0,0 +1,116 @@
+"""
+Pruebas del gateway de correo a NNTP: el enlace del mensaje en <storage>/news, los numeros de cada grupo y los
+mensajes repetidos, leyendo la base sqlite directamente. Tambien las consultas indexadas de NewsStore sobre lo
+que publico el gateway.
+
+python3 -m twisted.trial tests
+"""
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import newsstore
+
+
+class NewsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.gateway = newsstore.NewsGateway(self.directory, {})
+        self.delivered = 0
+
+    def message(self, messageId, body=b'hola\n'):
+        self.delivered += 1
+        path = os.path.join(self.directory, '1600000000.M%dP1.host,S=10' % (self.delivered,))
+        with open(path, 'wb') as messageFile:
+            messageFile.write(b'From: ana@example.com\nSubject: aviso\nMessage-ID: ' + messageId + b'\n\n' + body)
+        return path
+
+    def query(self, sql, *args):
+        connection = newsstore.openDatabase(self.gateway.dbFile)
+        try:
+            return connection.execute(sql, args).fetchall()
+        finally:
+            connection.close()
+
+
+class GatewayTests(NewsTestCase):
+
+    def test_post(self):
+        path = self.message(b'<a@example.com>', b'linea\n.punto\n')
+        self.assertEqual(self.gateway.post('local.avisos', path), 1)
+        [(spoolPath, bodyOffset, overview)] = self.query('SELECT path, bodyOffset, overview FROM articles')
+        self.assertEqual(os.stat(spoolPath).st_ino, os.stat(path).st_ino)
+        self.assertEqual(newsstore.readSpooledBody(spoolPath, bodyOffset), 'linea\r\n..punto\r\n')
+        self.assertEqual(overview.split('\t')[:4], ['aviso', 'ana@example.com', '', '<a@example.com>'])
+        self.assertEqual(self.query('SELECT low, high FROM groups WHERE name = ?', 'local.avisos'), [(1, 1)])
+
+    def test_duplicateReturnsStoredNumber(self):
+        """
+        Un Message-ID que ya esta en el grupo retorna el numero guardado, no el siguiente libre.
+        """
+        self.assertEqual(self.gateway.post('local.avisos', self.message(b'<a@example.com>')), 1)
+        self.assertEqual(self.gateway.post('local.avisos', self.message(b'<b@example.com>')), 2)
+        self.assertEqual(self.gateway.post('local.avisos', self.message(b'<a@example.com>')), 1)
+        self.assertEqual(self.query('SELECT high FROM groups WHERE name = ?', 'local.avisos'), [(2,)])
+        self.assertEqual(len(os.listdir(self.gateway.spoolDir)), 2)
+
+    def test_sameMessageInTwoGroups(self):
+        path = self.message(b'<a@example.com>')
+        self.assertEqual(self.gateway.post('local.avisos', self.message(b'<b@example.com>')), 1)
+        self.assertEqual(self.gateway.post('local.avisos', path), 2)
+        self.assertEqual(self.gateway.post('local.otros', path), 1)
+        self.assertEqual(self.query('SELECT COUNT(*) FROM articles'), [(2,)])
+        self.assertEqual(self.query('SELECT groupName, number FROM postings WHERE articleId = 2 ORDER BY groupName'),
+                         [('local.avisos', 2), ('local.otros', 1)])
+
+
+class StoreTests(NewsTestCase):
+
+    """
+    NewsStore sobre la misma base. Las consultas corren en el ConnectionPool de adbapi, por eso las pruebas
+    esperan los Deferreds con el reactor de trial.
+    """
+
+    def setUp(self):
+        NewsTestCase.setUp(self)
+        for i in range(1, 4):
+            self.gateway.post('local.avisos', self.message(b'<%d@example.com>' % (i,), b'cuerpo %d\n' % (i,)))
+        self.store = newsstore.NewsStore(self.directory)
+        self.addCleanup(self.store.dbpool.close)
+
+    @defer.inlineCallbacks
+    def test_groupAndListGroup(self):
+        self.assertEqual((yield self.store.groupRequest('local.avisos')), ('local.avisos', 3, 3, 1, 'y'))
+        self.assertEqual((yield self.store.listGroupRequest('local.avisos')), ('local.avisos', [1, 2, 3]))
+        self.assertEqual((yield self.store.listRequest()), [('local.avisos', 3, 1, 'y')])
+
+    @defer.inlineCallbacks
+    def test_xoverRange(self):
+        """
+        XOVER retorna las lineas precalculadas del rango pedido, sin leer los articulos.
+        """
+        rows = yield self.store.xoverRequest('local.avisos', 2, None)
+        self.assertEqual([row[:2] + row[4:5] for row in rows], [['2', 'aviso', '<2@example.com>'],
+                                                                ['3', 'aviso', '<3@example.com>']])
+        self.assertEqual((yield self.store.xoverRequest('local.avisos', 1, 1))[0][0], '1')
+        self.assertEqual((yield self.store.xoverRequest('local.avisos', 4, 10)), [])
+
+    @defer.inlineCallbacks
+    def test_xhdrFromOverview(self):
+        self.assertEqual((yield self.store.xhdrRequest('local.avisos', 1, 2, 'message-id')),
+                         [(1, '<1@example.com>'), (2, '<2@example.com>')])
+
+    @defer.inlineCallbacks
+    def test_articleByMessageId(self):
+        self.assertTrue((yield self.store.articleExistsRequest('<2@example.com>')))
+        self.assertFalse((yield self.store.articleExistsRequest('<9@example.com>')))
+        number, messageId, article = yield self.store.articleRequest(None, None, '<2@example.com>')
+        self.assertEqual((number, messageId), (2, '<2@example.com>'))
+        self.assertTrue(article.read().endswith('\r\n\r\ncuerpo 2\r\n'))
+        number, messageId, body = yield self.store.bodyRequest('local.avisos', 3)
+        self.assertEqual((number, messageId, body.read()), (3, '<3@example.com>', 'cuerpo 3\r\n'))
@@ -0,0 +1,96 @@
+"""
+Pruebas del cliente NNTP con un transporte falso: la ventana de comandos ARTICLE en vuelo, el orden de las
+respuestas y el estado guardado al terminar. Necesitan twisted.news; sin el se saltan.
+
+python3 -m twisted.trial tests
+"""
+import importlib.util
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+try:
+    from twisted.news import nntp
+except ImportError:
+    nntp = None
+
+
+def loadClient():
+    # El nombre del archivo tiene un guion, no se puede importar con import.
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'NNTP-Client.py')
+    spec = importlib.util.spec_from_file_location('nntpclient', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class PipelineTests(unittest.TestCase):
+
+    if nntp is None:
+        skip = 'twisted.news no esta instalado'
+
+    def setUp(self):
+        self.client = loadClient()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.client.output_storage = self.directory
+
+    def connect(self, window):
+        factory = self.client.NNTPGroupDownloadFactory('alt.prueba', 10, window)
+        self.addCleanup(factory.state.close)
+        factory.deferred.addErrback(lambda failure: None)
+        protocol = factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(b'200 servidor listo\r\n')
+        transport.clear()
+        protocol.dataReceived(b'211 5 1 5 alt.prueba group selected\r\n')
+        return factory, protocol, transport
+
+    def sent(self, transport):
+        lines = transport.value().split(b'\r\n')[:-1]
+        transport.clear()
+        return lines
+
+    def article(self, protocol, index):
+        protocol.dataReceived(b'220 %d <%d@example.com> article\r\nSubject: %d\r\n\r\n..punto\r\n.\r\n'
+                              % (index, index, index))
+
+    def test_window(self):
+        """
+        Con window=3 salen tres ARTICLE juntos y cada respuesta completa libera un lugar para el siguiente.
+        """
+        factory, protocol, transport = self.connect(3)
+        self.assertEqual(self.sent(transport), [b'ARTICLE 1', b'ARTICLE 2', b'ARTICLE 3'])
+        self.assertEqual(list(protocol.pending), [1, 2, 3])
+
+        self.article(protocol, 1)
+        self.assertEqual(self.sent(transport), [b'ARTICLE 4'])
+        self.assertEqual(list(protocol.pending), [2, 3, 4])
+        self.assertEqual(factory.highWaterMark(), 1)
+
+        for index in (2, 3, 4, 5):
+            self.article(protocol, index)
+        self.assertEqual(self.sent(transport), [b'ARTICLE 5', b'QUIT'])
+        self.assertEqual(self.successResultOf(factory.deferred), 0)
+        with open(os.path.join(self.directory, 'alt.prueba', 'Article 1'), 'rb') as articleFile:
+            self.assertEqual(articleFile.read(), b'Subject: 1\n\n.punto\n')
+
+    def test_failedArticleAdvances(self):
+        factory, protocol, transport = self.connect(2)
+        self.sent(transport)
+        protocol.dataReceived(b'423 no such article\r\n')
+        self.assertEqual(self.sent(transport), [b'ARTICLE 3'])
+        self.assertEqual(list(protocol.pending), [2, 3])
+        self.assertEqual(factory.highWaterMark(), 1)
+
+    def test_duplicateMessageIdIsNotSaved(self):
+        factory, protocol, transport = self.connect(1)
+        factory.state.execute('INSERT INTO messageIds (messageId) VALUES (?)', ('<1@example.com>',))
+        self.article(protocol, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'alt.prueba', 'Article 1')))
+        self.assertEqual(self.sent(transport), [b'ARTICLE 1', b'ARTICLE 2'])
@@ -0,0 +1,133 @@
+"""
+Pruebas del supervisor de prefork con un reactor falso: los workers no se levantan de verdad y el tiempo lo
+avanza la prueba.
+
+python3 -m twisted.trial tests
+"""
+import signal
+
+from twisted.internet import error, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+import prefork
+
+
+class FakeProcess(object):
+
+    def __init__(self):
+        self.signals = []
+
+    def signalProcess(self, signalName):
+        self.signals.append(signalName)
+
+
+class FakeReactor(task.Clock):
+
+    """
+    Reloj de twisted con lo que el supervisor usa del reactor.
+    """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.processes = []
+        self.stopped = False
+
+    def spawnProcess(self, protocol, executable, args, env, childFDs):
+        process = FakeProcess()
+        self.processes.append((protocol, process))
+        return process
+
+    def addSystemEventTrigger(self, phase, eventType, callable):
+        pass
+
+    def callFromThread(self, function, *args):
+        function(*args)
+
+    def stop(self):
+        self.stopped = True
+
+
+class SupervisorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.patch(prefork, 'reactor', self.reactor)
+        self.addCleanup(signal.signal, signal.SIGHUP, signal.getsignal(signal.SIGHUP))
+
+    def start(self, workers=2, reload=False):
+        supervisor = prefork.Supervisor(0, workers, '127.0.0.1', reload)
+        self.addCleanup(supervisor.socket.close)
+        supervisor.start()
+        return supervisor
+
+    def hangUp(self):
+        handler = signal.getsignal(signal.SIGHUP)
+        if callable(handler):
+            handler(signal.SIGHUP, None)
+        return handler
+
+    def test_reloadForwardsHangUp(self):
+        self.start(reload=True)
+        self.hangUp()
+        self.assertEqual([process.signals for protocol, process in self.reactor.processes], [['HUP'], ['HUP']])
+
+    def test_hangUpIgnoredWithoutReload(self):
+        """
+        Los workers del servidor IMAP no manejan SIGHUP; el supervisor no se los reenvia ni termina con el.
+        """
+        self.start()
+        self.assertEqual(self.hangUp(), signal.SIG_IGN)
+        self.assertEqual([process.signals for protocol, process in self.reactor.processes], [[], []])
+
+    def crash(self, index=0, uptime=1):
+        self.reactor.advance(uptime)
+        protocol, process = self.reactor.processes[index]
+        protocol.processEnded(failure.Failure(error.ProcessTerminated(1)))
+
+    def test_restartBackoff(self):
+        """
+        Cada caida rapida seguida duplica la espera antes de relevantar el worker; uno que duro minUptime
+        se releva al instante y vuelve la espera a restartDelay.
+        """
+        supervisor = self.start(workers=1)
+        for delay in (1, 2, 4):
+            self.crash(-1)
+            spawned = len(self.reactor.processes)
+            self.reactor.advance(delay - 0.5)
+            self.assertEqual(len(self.reactor.processes), spawned)
+            self.reactor.advance(0.5)
+            self.assertEqual(len(self.reactor.processes), spawned + 1)
+
+        self.crash(-1, uptime=supervisor.minUptime)
+        self.assertEqual(len(self.reactor.processes), 5)
+        self.assertEqual(supervisor.rapidFailures, 0)
+        self.crash(-1)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.reactor.processes), 6)
+
+    def test_delayIsCapped(self):
+        supervisor = self.start(workers=1)
+        supervisor.maxRestartDelay = 3
+        for i in range(4):
+            self.crash(-1)
+            self.reactor.advance(supervisor.maxRestartDelay)
+        self.assertEqual(len(self.reactor.processes), 5)
+
+    def test_giveUpAfterRapidFailures(self):
+        supervisor = self.start(workers=1)
+        for i in range(supervisor.maxRapidFailures):
+            self.crash(-1)
+            self.reactor.advance(supervisor.maxRestartDelay)
+        self.assertFalse(self.reactor.stopped)
+        self.crash(-1)
+        self.reactor.advance(supervisor.maxRestartDelay)
+        self.assertEqual(len(self.reactor.processes), supervisor.maxRapidFailures + 1)
+        self.assertTrue(self.reactor.stopped)
+
+    def test_stopCancelsRestarts(self):
+        supervisor = self.start(workers=2)
+        self.crash(0)
+        supervisor.stop()
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+        self.assertEqual(self.reactor.processes[1][1].signals, ['TERM'])
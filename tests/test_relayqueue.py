@@ -0,0 +1,227 @@
+"""
+Pruebas de relayqueue sin red: un resolver que siempre responde con un MX local y un servidor SMTP de prueba
+en 127.0.0.1 que responde segun la direccion.
+
+python3 -m twisted.trial tests
+"""
+import os
+import pickle
+import shutil
+import tempfile
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.names import dns
+from twisted.protocols import basic
+from twisted.trial import unittest
+
+import diskio
+import relayqueue
+
+
+class FakeResolver(object):
+
+    """
+    Todo dominio tiene un MX mx.<dominio> en 127.0.0.1.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def lookupMailExchange(self, name, timeout=None):
+        self.queries.append(('MX', name))
+        record = dns.RRHeader(name, dns.MX, ttl=60, payload=dns.Record_MX(10, 'mx.' + name))
+        return defer.succeed(([record], [], []))
+
+    def lookupAddress(self, name, timeout=None):
+        self.queries.append(('A', name))
+        record = dns.RRHeader(name, dns.A, ttl=60, payload=dns.Record_A('127.0.0.1'))
+        return defer.succeed(([record], [], []))
+
+
+class SinkProtocol(basic.LineReceiver):
+
+    """
+    Servidor SMTP minimo. factory.greeting es el codigo del saludo, factory.mailFrom el de MAIL FROM y cada RCPT
+    responde segun la parte local: temp 451, bad 550 y cualquier otra 250.
+    """
+
+    def connectionMade(self):
+        self.factory.connections += 1
+        self.data = None
+        code = self.factory.greeting
+        self.sendLine(b'%d sink' % (code,))
+        if code != 220:
+            self.transport.loseConnection()
+
+    def lineReceived(self, line):
+        if self.data is not None:
+            if line == b'.':
+                self.factory.messages.append(b'\r\n'.join(self.data))
+                self.data = None
+                self.sendLine(b'250 queued')
+            else:
+                self.data.append(line)
+            return
+        command = line[:4].upper()
+        if command in (b'HELO', b'EHLO', b'RSET', b'NOOP'):
+            self.sendLine(b'250 ok')
+        elif command == b'MAIL':
+            self.sendLine(b'%d sender' % (self.factory.mailFrom,))
+        elif command == b'RCPT':
+            local = line.split(b':', 1)[1].strip(b'<> ').split(b'@')[0]
+            self.sendLine({b'temp': b'451 try later', b'bad': b'550 no such user'}.get(local, b'250 ok'))
+        elif command == b'DATA':
+            self.data = []
+            self.sendLine(b'354 go ahead')
+        elif command == b'QUIT':
+            self.sendLine(b'221 bye')
+            self.transport.loseConnection()
+        else:
+            self.sendLine(b'500 what')
+
+
+class SinkFactory(protocol.ServerFactory):
+
+    protocol = SinkProtocol
+
+    def __init__(self):
+        self.greeting = 220
+        self.mailFrom = 250
+        self.connections = 0
+        self.messages = []
+
+
+def waitFor(condition, timeout=5):
+    """
+    Deferred que se dispara cuando condition() es verdadera, revisando cada 10 ms.
+    """
+    def check(elapsed):
+        if condition():
+            return None
+        if elapsed >= timeout:
+            raise AssertionError('timed out')
+        return task.deferLater(reactor, 0.01, check, elapsed + 0.01)
+    return task.deferLater(reactor, 0, check, 0)
+
+
+class RelayQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        diskio.diskPool.synchronous = True
+        self.addCleanup(setattr, diskio.diskPool, 'synchronous', False)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.sink = SinkFactory()
+        self.port = reactor.listenTCP(0, self.sink, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.relay = relayqueue.RelayQueue(self.directory, FakeResolver(), reactor, self.port.getHost().port)
+        self.addCleanup(self._stopRelay)
+
+    def _stopRelay(self):
+        for call in [self.relay.wakeup] + list(self.relay.resolver.cache.cancel.values()):
+            if call is not None and call.active():
+                call.cancel()
+        for name in list(self.relay.locks):
+            self.relay._unlock(name)
+
+    def enqueue(self, recipients, name='1600000000.M1P1.host'):
+        tmpName = os.path.join(self.directory, 'tmp', name)
+        with open(tmpName, 'wb') as messageFile:
+            messageFile.write(b'Subject: hola\n\ncuerpo\n')
+        self.relay.queued(self.relay.store(tmpName, 'ana@localhost', recipients, reactor.seconds()))
+        return self.relay.queue.getPath(name)
+
+    def envelope(self, path):
+        with open(path + '-H', 'rb') as envelopeFile:
+            return pickle.load(envelopeFile)
+
+    def settled(self):
+        return not self.relay.activeConnections and not self.relay.locks
+
+    @defer.inlineCallbacks
+    def test_delivery(self):
+        path = self.enqueue(['bob@example.com', 'carl@example.com'])
+        yield waitFor(lambda: self.relay.delivered == 2 and self.settled())
+        self.assertEqual(len(self.sink.messages), 1)
+        self.assertIn(b'cuerpo', self.sink.messages[0])
+        self.assertFalse(os.path.exists(path + '-D'))
+        self.assertFalse(os.path.exists(path + '-H'))
+
+    def deadLetters(self):
+        return sorted(os.listdir(os.path.join(self.directory, 'failed')))
+
+    @defer.inlineCallbacks
+    def test_temporaryRecipientIsRetried(self):
+        """
+        El destinatario con 451 queda para el reintento y el rechazado con 550 se avisa en un DSN, que se entrega
+        como cualquier otro mensaje de la cola.
+        """
+        path = self.enqueue(['bob@example.com', 'temp@example.com', 'bad@example.com'])
+        yield waitFor(lambda: self.relay.retried == 1 and self.relay.delivered == 2 and self.settled())
+        self.assertEqual((self.relay.failed, self.relay.bounced), (1, 1))
+        envelope = self.envelope(path)
+        self.assertEqual(envelope[1], ['temp@example.com'])
+        self.assertEqual(envelope[2], 1)
+        self.assertTrue(os.path.exists(path + '-D'))
+        bounce = self.sink.messages[1]
+        self.assertIn(b'Final-Recipient: rfc822; bad@example.com', bounce)
+        self.assertNotIn(b'temp@example.com', bounce)
+
+    @defer.inlineCallbacks
+    def test_permanentRecipientsFail(self):
+        path = self.enqueue(['bad@example.com'])
+        yield waitFor(lambda: self.relay.delivered == 1 and self.settled())
+        self.assertEqual((self.relay.failed, self.relay.retried, self.relay.bounced), (1, 0, 1))
+        self.assertFalse(os.path.exists(path + '-D'))
+        [bounce] = self.sink.messages
+        self.assertIn(b'To: <ana@localhost>', bounce)
+        self.assertIn(b'Content-Type: multipart/report; report-type=delivery-status;', bounce)
+        self.assertIn(b'Status: 5.0.0\r\nDiagnostic-Code: smtp; 550 no such user', bounce)
+        self.assertIn(b'Content-Type: text/rfc822-headers\r\n\r\nSubject: hola\r\n', bounce)
+        self.assertNotIn(b'cuerpo', bounce)
+        self.assertEqual(self.deadLetters(), [])
+
+    @defer.inlineCallbacks
+    def test_temporaryMailFromIsRetried(self):
+        self.sink.mailFrom = 451
+        path = self.enqueue(['bob@example.com'])
+        yield waitFor(lambda: self.relay.retried == 1 and self.settled())
+        self.assertEqual(self.relay.failed, 0)
+        self.assertEqual(self.envelope(path)[1], ['bob@example.com'])
+
+    @defer.inlineCallbacks
+    def test_permanentMailFromFails(self):
+        """
+        El DSN tambien es rechazado; como no tiene remitente no se responde y queda en failed/.
+        """
+        self.sink.mailFrom = 550
+        path = self.enqueue(['bob@example.com', 'carl@example.com'])
+        yield waitFor(lambda: len(self.deadLetters()) == 2 and self.settled())
+        self.assertEqual((self.relay.failed, self.relay.retried, self.relay.bounced), (3, 0, 1))
+        self.assertFalse(os.path.exists(path + '-D'))
+        name = self.deadLetters()[0][:-2]
+        origin, failures, created, failedAt = self.envelope(os.path.join(self.directory, 'failed', name))
+        self.assertEqual(origin, '')
+        self.assertEqual(failures, [('ana@localhost', '5.0.0', '550 sender')])
+
+    @defer.inlineCallbacks
+    def test_expiredMessageBounces(self):
+        self.relay.maxAge = 0
+        self.enqueue(['temp@example.com'])
+        yield waitFor(lambda: self.relay.delivered == 1 and self.settled())
+        self.assertEqual((self.relay.failed, self.relay.retried), (1, 0))
+        self.assertIn(b'Status: 4.4.7', self.sink.messages[0])
+
+    @defer.inlineCallbacks
+    def test_greetingRejectionBacksOff(self):
+        """
+        Un servidor que rechaza el saludo no se vuelve a conectar enseguida: el MX queda marcado como malo y
+        el mensaje espera su reintento.
+        """
+        self.sink.greeting = 554
+        path = self.enqueue(['bob@example.com'])
+        yield waitFor(lambda: self.relay.retried == 1 and self.settled())
+        yield task.deferLater(reactor, 0.2, lambda: None)
+        self.assertEqual(self.sink.connections, 1)
+        self.assertIn('mx.example.com', self.relay.mxcalc.badMXs)
+        self.assertEqual(self.envelope(path)[2], 1)
@@ -0,0 +1,170 @@
+"""
+Pruebas de la busqueda IMAP: compileQuery sobre las consultas que entrega parseNestedParens y SearchIndex
+resolviendo consultas sobre un buzon de prueba.
+
+python3 -m twisted.trial tests
+"""
+import base64
+import os
+import shutil
+import tempfile
+
+from twisted.mail import imap4
+from twisted.trial import unittest
+
+import mailmetadata
+import searchindex
+
+
+DAY = 1600041600
+
+
+class CompileQueryTests(unittest.TestCase):
+
+    def compile(self, query, lastSequence=10, lastUID=40):
+        return searchindex.compileQuery(imap4.parseNestedParens(query), lastSequence, lastUID)
+
+    def test_flags(self):
+        self.assertEqual(self.compile(b'SEEN'), ('flag', '\\seen', True))
+        self.assertEqual(self.compile(b'undeleted'), ('flag', '\\deleted', False))
+        self.assertEqual(self.compile(b'KEYWORD Foo'), ('flag', 'foo', True))
+        self.assertEqual(self.compile(b'NEW'), ('and', [('flag', '\\recent', True), ('flag', '\\seen', False)]))
+        self.assertEqual(self.compile(b'OLD'), ('flag', '\\recent', False))
+
+    def test_headers(self):
+        self.assertEqual(self.compile(b'FROM "Ana"'), ('column', 'fromAddr', 'ana'))
+        self.assertEqual(self.compile(b'HEADER Subject Hola'), ('column', 'subject', 'hola'))
+        self.assertEqual(self.compile(b'HEADER Message-ID abc'), ('header', 'message-id', 'abc'))
+        self.assertEqual(self.compile(b'BODY Hola'), ('text', 'body', 'hola'))
+
+    def test_dates(self):
+        self.assertEqual(self.compile(b'SINCE 14-Sep-2020'), ('range', 'internalDate', '>=', DAY))
+        self.assertEqual(self.compile(b'SENTON 14-Sep-2020'),
+                         ('and', [('range', 'sentDate', '>=', DAY), ('range', 'sentDate', '<', DAY + 86400)]))
+        self.assertEqual(self.compile(b'LARGER 100'), ('range', 'size', '>', 100))
+
+    def test_nesting(self):
+        """
+        Varios terminos son un AND; OR y NOT toman los terminos siguientes, incluidos los parentesis.
+        """
+        self.assertEqual(self.compile(b'OR SEEN (FROM a TO b) NOT DELETED'),
+                         ('and', [('or', ('flag', '\\seen', True),
+                                   ('and', [('column', 'fromAddr', 'a'), ('column', 'toAddr', 'b')])),
+                                  ('not', ('flag', '\\deleted', True))]))
+
+    def test_messageSets(self):
+        node = self.compile(b'2:* UID 30:*')
+        self.assertEqual(node[0], 'and')
+        self.assertEqual(node[1][0][0], 'seq')
+        self.assertEqual(list(node[1][0][1]), list(range(2, 11)))
+        self.assertEqual(node[1][1][0], 'uid')
+        self.assertEqual(list(node[1][1][1]), list(range(30, 41)))
+
+    def test_errors(self):
+        self.assertRaises(searchindex.UnindexedQuery, self.compile, b'FOO')
+        for query in (b'', b'LARGER big', b'SINCE yesterday', b'FROM', b'OR SEEN', b'NOT', b'UID x'):
+            self.assertRaises(imap4.IllegalQueryError, self.compile, query)
+
+
+MESSAGES = [
+    ('%d.M1P1.host' % (DAY + 3600,),
+     b'From: Ana <ana@example.com>\r\nTo: bob@example.com\r\nSubject: Reunion\r\n'
+     b'Date: Mon, 14 Sep 2020 10:00:00 -0500\r\nMessage-ID: <one@example.com>\r\n\r\n'
+     b'Nos vemos el lunes en la oficina.\r\n'),
+    ('%d.M2P1.host' % (DAY + 86400,),
+     b'From: carl@example.com\r\nTo: ana@example.com\r\nSubject: =?utf-8?q?caf=C3=A9?=\r\n'
+     b'Date: Tue, 15 Sep 2020 10:00:00 +0000\r\nMIME-Version: 1.0\r\n'
+     b'Content-Type: multipart/mixed; boundary="b"\r\n\r\n'
+     b'--b\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: base64\r\n\r\n' +
+     base64.encodebytes('El presupuesto esta listo'.encode('utf-8')) +
+     b'\r\n--b\r\nContent-Type: application/octet-stream\r\n\r\nsecretoadjunto\r\n--b--\r\n'),
+    ('%d.M3P1.host' % (DAY + 2 * 86400,),
+     b'From: bob@example.com\r\nTo: carl@example.com\r\nSubject: Re: Reunion\r\n'
+     b'Date: Wed, 16 Sep 2020 10:00:00 +0000\r\n\r\n' + b'relleno ' * 200 + b'\r\n'),
+]
+
+
+class SearchIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.mkdir(os.path.join(self.directory, 'cur'))
+        self.paths = []
+        self.uids = {}
+        for uid, (name, data) in zip((5, 9, 12), MESSAGES):
+            path = os.path.join(self.directory, 'cur', name)
+            with open(path, 'wb') as messageFile:
+                messageFile.write(data)
+            self.paths.append(path)
+            self.uids[name] = uid
+        self.uidList = [5, 9, 12]
+        self.flags = mailmetadata.FlagTable({5: ['\\Seen'], 9: ['\\Seen', '\\Flagged'], 12: []})
+        self.index = searchindex.SearchIndex(self.directory)
+        self.addCleanup(self.index.close)
+        self.assertEqual(self.index.add(self.paths), 3)
+
+    def search(self, query):
+        node = searchindex.compileQuery(imap4.parseNestedParens(query), len(self.uidList), self.uidList[-1])
+        snapshot = searchindex.MailboxSnapshot(self.uidList, self.paths, self.uids, self.flags, 12)
+        return self.index.search(node, snapshot)
+
+    def test_indexedTerms(self):
+        self.assertEqual(self.search(b'ALL'), [5, 9, 12])
+        self.assertEqual(self.search(b'FROM ana'), [5])
+        self.assertEqual(self.search(b'SUBJECT caf\xc3\xa9'), [9])
+        self.assertEqual(self.search(b'SUBJECT reunion'), [5, 12])
+        self.assertEqual(self.search(b'SENTON 15-Sep-2020'), [9])
+        self.assertEqual(self.search(b'SINCE 15-Sep-2020'), [9, 12])
+        self.assertEqual(self.search(b'LARGER 1000'), [12])
+
+    def test_flagsAndSets(self):
+        self.assertEqual(self.search(b'UNSEEN'), [12])
+        self.assertEqual(self.search(b'SEEN NOT FLAGGED'), [5])
+        self.assertEqual(self.search(b'RECENT'), [12])
+        self.assertEqual(self.search(b'OR FLAGGED 3'), [9, 12])
+        self.assertEqual(self.search(b'UID 6:*'), [9, 12])
+
+    def test_bodyTokens(self):
+        """
+        El texto de una parte en base64 se indexa decodificado y los adjuntos que no son texto no se leen.
+        """
+        self.assertEqual(self.search(b'BODY presupuesto'), [9])
+        self.assertEqual(self.search(b'TEXT ana'), [5, 9])
+        self.assertEqual(self.search(b'BODY secretoadjunto'), [])
+        self.assertEqual(self.search(b'BODY "oficina lunes"'), [5])
+
+    def test_fileTerms(self):
+        """
+        HEADER de un encabezado sin columna y BODY sin palabras indexables se buscan en los archivos.
+        """
+        self.assertEqual(self.search(b'HEADER Message-ID one@example'), [5])
+        self.assertEqual(self.search(b'BODY "."'), [5])
+        self.assertEqual(self.search(b'FROM bob BODY "."'), [])
+
+    def test_bodyLimit(self):
+        self.patch(searchindex, 'maxBodyBytes', 20)
+        name = '%d.M4P1.host' % (DAY,)
+        path = os.path.join(self.directory, 'cur', name)
+        with open(path, 'wb') as messageFile:
+            messageFile.write(b'Subject: largo\r\n\r\nprincipio ' + b'x' * 100 + b' final\r\n')
+        self.index.add([path])
+        self.paths.append(path)
+        self.uids[name] = 13
+        self.uidList.append(13)
+        self.assertEqual(self.search(b'BODY principio'), [13])
+        self.assertEqual(self.search(b'BODY final'), [])
+
+    def test_resultsComeFromTheSnapshot(self):
+        """
+        Los uids salen de la foto: un EXPUNGE en el buzon despues de tomarla no corre los resultados.
+        """
+        node = searchindex.compileQuery([b'ALL'], 3, 12)
+        snapshot = searchindex.MailboxSnapshot(self.uidList, self.paths, self.uids, self.flags)
+        del self.uidList[0]
+        self.assertEqual(self.index.search(node, snapshot), [5, 9, 12])
+
+    def test_removedMessagesDoNotMatch(self):
+        self.index.remove([os.path.basename(self.paths[0])])
+        self.assertEqual(self.search(b'FROM ana'), [])
+        self.assertEqual(self.index.add(self.paths), 1)
@@ -0,0 +1,230 @@
+"""
+Pruebas de la escritura de mensajes entregados: MaildirMessageWriter para un destinatario y MaildirSpool con
+SpooledMessage para una transaccion con varios.
+
+python3 -m twisted.trial tests
+"""
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+from twisted.mail import smtp
+from twisted.trial import unittest
+
+import diskio
+import smtpserver
+
+
+class ManualDisk(object):
+
+    """
+    Reemplazo de deferToDisk que guarda las operaciones hasta que la prueba llama run; sirve para ver que pasa
+    mientras el disco va atrasado.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, function, *args, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((d, function, args, kwargs))
+        return d
+
+    def run(self):
+        while self.calls:
+            d, function, args, kwargs = self.calls.pop(0)
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                d.errback()
+            else:
+                d.callback(result)
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.paused = 0
+        self.resumed = 0
+
+    def pauseProducing(self):
+        self.paused += 1
+
+    def resumeProducing(self):
+        self.resumed += 1
+
+
+class FakeProtocol(object):
+
+    def __init__(self):
+        self.transport = FakeTransport()
+
+
+def makeInbox(directory, name):
+    inboxDir = os.path.join(directory, name, 'Inbox')
+    for subdir in ('new', 'cur', 'tmp'):
+        os.makedirs(os.path.join(inboxDir, subdir))
+    return inboxDir
+
+
+class DeliveryTests(unittest.TestCase):
+
+    def setUp(self):
+        diskio.diskPool.synchronous = True
+        self.addCleanup(setattr, diskio.diskPool, 'synchronous', False)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.delivered = []
+        smtpserver.deliveryObservers.append(self.observe)
+        self.addCleanup(smtpserver.deliveryObservers.remove, self.observe)
+
+    def observe(self, inboxDir, messagePath):
+        self.delivered.append((inboxDir, messagePath))
+
+    def read(self, path):
+        with open(path, 'rb') as messageFile:
+            return messageFile.read()
+
+    @defer.inlineCallbacks
+    def test_writerPublishesToNew(self):
+        inboxDir = makeInbox(self.directory, 'ana')
+        writer = smtpserver.MaildirMessageWriter(lambda: inboxDir)
+        for line in [b'Subject: hola', b'', 'cuerpo con acento \xe1']:
+            writer.lineReceived(line)
+        newName = yield writer.eomReceived()
+        data = b'Subject: hola\n\ncuerpo con acento \xc3\xa1\n'
+        self.assertEqual(os.path.dirname(newName), os.path.join(inboxDir, 'new'))
+        self.assertTrue(newName.endswith(',S=%d' % (len(data),)))
+        self.assertEqual(self.read(newName), data)
+        self.assertEqual(os.listdir(os.path.join(inboxDir, 'tmp')), [])
+        self.assertEqual(self.delivered, [(inboxDir, newName)])
+
+    def test_writerPausesWhileDiskIsBehind(self):
+        """
+        Con mas de maxPendingChunks bloques sin escribir se pausa la conexion y se reanuda cuando bajan; el
+        archivo queda con las lineas en orden.
+        """
+        disk = ManualDisk()
+        self.patch(smtpserver, 'deferToDisk', disk)
+        inboxDir = makeInbox(self.directory, 'ana')
+        protocol = FakeProtocol()
+        writer = smtpserver.MaildirMessageWriter(lambda: inboxDir, protocol)
+        self.patch(writer.file, 'chunkSize', 100)
+        lines = [b'%099d' % (i,) for i in range(writer.file.maxPendingChunks + 4)]
+        for line in lines:
+            writer.lineReceived(line)
+        self.assertEqual((protocol.transport.paused, protocol.transport.resumed), (1, 0))
+
+        delivered = writer.eomReceived()
+        disk.run()
+        newName = self.successResultOf(delivered)
+        self.assertEqual((protocol.transport.paused, protocol.transport.resumed), (1, 1))
+        self.assertEqual(self.read(newName), b''.join(line + b'\n' for line in lines))
+
+    def test_writerConnectionLostRemovesTemporaryFile(self):
+        inboxDir = makeInbox(self.directory, 'ana')
+        writer = smtpserver.MaildirMessageWriter(lambda: inboxDir)
+        writer.lineReceived(b'Subject: cortado')
+        self.assertEqual(len(os.listdir(os.path.join(inboxDir, 'tmp'))), 1)
+        writer.connectionLost()
+        self.assertEqual(os.listdir(os.path.join(inboxDir, 'tmp')), [])
+        self.assertEqual(os.listdir(os.path.join(inboxDir, 'new')), [])
+        self.assertEqual(self.delivered, [])
+
+    @defer.inlineCallbacks
+    def test_spoolLinksEveryRecipient(self):
+        """
+        El mensaje se escribe una vez y aparece en el new/ de cada buzon; dos destinatarios del mismo buzon
+        reciben el mismo archivo.
+        """
+        anaDir = makeInbox(self.directory, 'ana')
+        bobDir = makeInbox(self.directory, 'bob')
+        spool = smtpserver.MaildirSpool()
+        messages = [smtpserver.SpooledMessage(lambda inboxDir=inboxDir: inboxDir, spool)
+                    for inboxDir in (anaDir, bobDir, anaDir)]
+        for line in [b'Subject: a todos', b'', b'hola']:
+            for message in messages:
+                message.lineReceived(line)
+        names = []
+        for message in messages:
+            names.append((yield message.eomReceived()))
+
+        self.assertEqual(names[0], names[2])
+        self.assertEqual(os.path.dirname(names[1]), os.path.join(bobDir, 'new'))
+        for name in names:
+            self.assertEqual(self.read(name), b'Subject: a todos\n\nhola\n')
+        self.assertEqual(os.stat(names[0]).st_ino, os.stat(names[1]).st_ino)
+        self.assertEqual(sorted(self.delivered), sorted([(anaDir, names[0]), (bobDir, names[1])]))
+        for inboxDir in (anaDir, bobDir):
+            self.assertEqual(os.listdir(os.path.join(inboxDir, 'tmp')), [])
+
+    def test_spoolAbortRemovesTemporaryFile(self):
+        anaDir = makeInbox(self.directory, 'ana')
+        spool = smtpserver.MaildirSpool()
+        message = smtpserver.SpooledMessage(lambda: anaDir, spool)
+        message.lineReceived(b'Subject: cortado')
+        message.connectionLost()
+        self.assertEqual(os.listdir(os.path.join(anaDir, 'tmp')), [])
+        self.assertEqual(os.listdir(os.path.join(anaDir, 'new')), [])
+
+
+def makeUser(address):
+    return smtp.User(address, None, None, None)
+
+
+class RecipientIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        diskio.diskPool.synchronous = True
+        self.addCleanup(setattr, diskio.diskPool, 'synchronous', False)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        makeInbox(self.directory, 'ana@example.com')
+
+    def index(self, requireMailbox=False):
+        recipients = smtpserver.RecipientIndex(self.directory, ['Example.com'], requireMailbox=requireMailbox)
+        smtpserver.deliveryObservers.append(recipients.deliveryReceived)
+        self.addCleanup(smtpserver.deliveryObservers.remove, recipients.deliveryReceived)
+        return recipients
+
+    def delivery(self, recipients):
+        return smtpserver.LocalDelivery(self.directory, None, recipients=recipients)
+
+    def test_unknownRecipientsAreRejected(self):
+        """
+        Con requireMailbox solo pasan los buzones existentes; un dominio remoto sin cola de salida nunca pasa.
+        """
+        delivery = self.delivery(self.index(requireMailbox=True))
+        delivery.validateTo(makeUser(b'ana@example.com'))
+        self.assertRaises(smtp.SMTPBadRcpt, delivery.validateTo, makeUser(b'bob@example.com'))
+        self.assertRaises(smtp.SMTPBadRcpt, delivery.validateTo, makeUser(b'ana@example.org'))
+
+    def test_reload(self):
+        recipients = self.index(requireMailbox=True)
+        self.assertFalse(recipients.accepts(makeUser(b'bob@example.com')))
+        makeInbox(self.directory, 'bob@example.com')
+        os.utime(self.directory, (0, recipients.mtime + 1))
+        self.successResultOf(recipients.checkReload())
+        self.assertEqual(recipients.reloads, 1)
+        self.assertTrue(recipients.accepts(makeUser(b'bob@example.com')))
+        self.successResultOf(recipients.checkReload())
+        self.assertEqual(recipients.reloads, 1)
+
+    @defer.inlineCallbacks
+    def test_newMailboxIsIndexedAfterDelivery(self):
+        """
+        El buzon se crea en el pool y entra al indice cuando la entrega llega al reactor.
+        """
+        disk = ManualDisk()
+        self.patch(smtpserver, 'deferToDisk', disk)
+        recipients = self.index()
+        message = self.delivery(recipients).validateTo(makeUser(b'bob@example.com'))()
+        message.lineReceived(b'Subject: hola')
+        delivered = message.eomReceived()
+        self.assertNotIn('bob@example.com', recipients.mailboxes)
+        disk.run()
+        newName = yield delivered
+        inboxDir = os.path.join(self.directory, 'bob@example.com', 'Inbox')
+        self.assertEqual(os.path.dirname(newName), os.path.join(inboxDir, 'new'))
+        self.assertEqual(recipients.mailboxes['bob@example.com'], inboxDir)